@@ -1,8 +1,14 @@
-from flask import Flask, request, jsonify, render_template_string
+from flask import Flask, request, jsonify, render_template_string, Response
 import base64, os, uuid
 from datetime import datetime
 import logging
-from simple_db import db
+from simple_db import db as sqlite_db
+from query_cache import CachedDatabase
+from detection import Detection
+from storage_backends import open_storage
+from storage_quota import StorageManager, StorageFull
+from idempotency import IdempotencyCache, event_id_for, DUPLICATES
+import export
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -10,11 +16,25 @@ load_dotenv()
 app = Flask(__name__)
 recent_events = []
 
+# Read-through cache in front of the dashboard / plate lookup queries
+db = CachedDatabase(sqlite_db)
+# Streaming exports bypass the cache and read straight from the adapter
+export.init_app(app, sqlite_db)
+# Camera resends of a TollgateInfo event are acked without re-processing
+seen_events = IdempotencyCache()
+seen_events.init_app(app)
+
 # Directories
 SAVE_DIR = "./downloads"
 LOG_DIR = "./logs"
 os.makedirs(SAVE_DIR, exist_ok=True)
 os.makedirs(LOG_DIR, exist_ok=True)
+image_store = open_storage(SAVE_DIR)
+
+# Quotas and free space: writes make room first instead of failing with ENOSPC
+storage = StorageManager([SAVE_DIR])
+storage.init_app(app)
+storage.start()
 
 # =========================
 # Webhook Logger (Separate File)
@@ -32,6 +52,15 @@ file_handler.setFormatter(formatter)
 if not webhook_logger.hasHandlers():
     webhook_logger.addHandler(file_handler)
 
+def save_file(store, key, data):
+    """Write through the quota manager; False (and logged) when no space could be freed"""
+    try:
+        storage.put(store, key, data)
+        return True
+    except StorageFull as e:
+        webhook_logger.error(f"Skipped {key}: {e}")
+        return False
+
 # =========================
 # Utility: detect image type
 # =========================
@@ -70,9 +99,8 @@ def webhook():
             img_b64 = data["Image"]
             img_ext = get_image_format(img_b64)
             img_file = f"{data.get('Plate','UNKNOWN')}_{ts}{img_ext}"
-            with open(os.path.join(SAVE_DIR, img_file), "wb") as f:
-                f.write(base64.b64decode(img_b64))
-            event["ImageSavedAs"] = img_file
+            if save_file(image_store, img_file, base64.b64decode(img_b64)):
+                event["ImageSavedAs"] = img_file
 
     # Non-JSON raw data
     else:
@@ -83,8 +111,8 @@ def webhook():
         event["Files"] = []
         for name, file in request.files.items():
             img_file = f"{name}_{ts}.jpg"
-            file.save(os.path.join(SAVE_DIR, img_file))
-            event["Files"].append({"field": name, "filename": file.filename, "saved_as": img_file})
+            if save_file(image_store, img_file, file.read()):
+                event["Files"].append({"field": name, "filename": file.filename, "saved_as": img_file})
 
     # Store event in memory
     recent_events.insert(0, event)
@@ -109,25 +137,19 @@ def webhook():
 
 @app.route("/NotificationInfo/TollgateInfo", methods=["POST"])
 def crossing():
-    # 1. Generate Unique Request ID
-    request_id = str(uuid.uuid4())
+    # 1. Derive the event ID from the camera's identity for the event and extract the fields we use, once
     data = request.get_json(force=True)
-    
-    # 2. Extract Metadata for folder naming/logging
-    # Safely navigate the nested structure
+    request_id = event_id_for(data)
+    ack = seen_events.claim(request_id)
+    if ack is not None:
+        DUPLICATES.inc(camera="tollgate")
+        return seen_events.duplicate_response(ack)
+    det = Detection.from_payload(data, "tollgate", request_id)
     picture_data = data.get("Picture", {})
-    plate_info = picture_data.get("Plate", {})
-    snap_info = picture_data.get("SnapInfo", {})
-    
-    plate_number = plate_info.get("PlateNumber", "UNKNOWN")
-    device_id = snap_info.get("DeviceID", "NO_ID")
     
-    # Create directory: downloads/PLATE_DEVICEID_UUID
-    folder_name = f"{plate_number}_{device_id}_{request_id[:8]}"
-    request_dir = os.path.join(SAVE_DIR, folder_name)
-    os.makedirs(request_dir, exist_ok=True)
-
-    saved_files = []
+    # 2. Create directory: downloads/PLATE_DEVICEID_UUID
+    folder_name = f"{det.plate}_{det.device_id or 'NO_ID'}_{request_id[:8]}"
+    det.image_dir = os.path.join(SAVE_DIR, folder_name)
 
     # 3. Helper to process specific picture objects
     def save_nested_image(pic_obj, prefix):
@@ -135,27 +157,25 @@ def crossing():
             content = pic_obj["Content"].replace('\\/', '/')
             # Use their filename or generate one
             filename = pic_obj.get("PicName") or f"{prefix}_{request_id[:8]}.jpg"
-            full_path = os.path.join(request_dir, filename)
-            
-            with open(full_path, "wb") as f:
-                f.write(base64.b64decode(content))
-            return filename
+            if save_file(image_store, f"{folder_name}/{filename}", base64.b64decode(content)):
+                return filename
         return None
 
     # 4. Save both Cutout and Normal pictures
     cutout = save_nested_image(picture_data.get("CutoutPic"), "cutout")
     normal = save_nested_image(picture_data.get("NormalPic"), "normal")
 
-    if cutout: saved_files.append(cutout)
-    if normal: saved_files.append(normal)
+    if cutout: det.images.append(cutout)
+    if normal: det.images.append(normal)
 
     # 5. Save detection to database
     try:
         db.add_vehicle_detection(
             event_id=request_id,
-            license_plate=plate_number,
+            license_plate=det.plate,
             detection_data=data,
-            image_url=folder_name
+            image_url=folder_name,
+            camera=det.camera
         )
         
         db.add_webhook_event(
@@ -168,17 +188,12 @@ def crossing():
         webhook_logger.error(f"Database error: {str(e)}")
     
     # 6. Log and Respond
-    response_data = {
-        "status": "success",
-        "request_id": request_id,
-        "folder": folder_name,
-        "saved_images": saved_files,
-        "plate": plate_number
-    }
-    
-    print(f"Processed Request {request_id}: Saved {len(saved_files)} images for {plate_number}")
+    print(f"Processed Request {request_id}: Saved {len(det.images)} images for {det.plate}")
     
-    return jsonify(response_data), 200
+    ack = dict(status="success", request_id=request_id, folder=folder_name,
+               saved_images=det.images, plate=det.plate)
+    seen_events.complete(request_id, ack)
+    return jsonify(ack), 200
 
 # =========================
 # GET Events (from database)
@@ -187,8 +202,8 @@ def crossing():
 def get_events():
     limit = request.args.get('limit', default=20, type=int)
     try:
-        events = db.get_webhook_events(limit=limit)
-        return jsonify(events)
+        _, body = db.get_webhook_events_json(limit=limit)
+        return Response(body, mimetype="application/json")
     except Exception as e:
         webhook_logger.error(f"Database error: {str(e)}")
         return jsonify(recent_events)  # Fall back to in-memory events
@@ -200,8 +215,8 @@ def get_events():
 def get_vehicle_detections():
     limit = request.args.get('limit', default=50, type=int)
     try:
-        detections = db.get_vehicle_detections(limit=limit)
-        return jsonify(detections)
+        _, body = db.get_vehicle_detections_json(limit=limit)
+        return Response(body, mimetype="application/json")
     except Exception as e:
         webhook_logger.error(f"Database error: {str(e)}")
         return jsonify({"error": str(e)}), 500
@@ -212,12 +227,19 @@ def get_vehicle_detections():
 @app.route("/vehicle-detections/<plate>", methods=["GET"])
 def get_vehicle_by_plate(plate):
     try:
-        detections = db.get_vehicle_by_plate(plate)
-        return jsonify(detections)
+        _, body = db.get_vehicle_by_plate_json(plate)
+        return Response(body, mimetype="application/json")
     except Exception as e:
         webhook_logger.error(f"Database error: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
+# =========================
+# Query cache stats
+# =========================
+@app.route("/cache/stats", methods=["GET"])
+def cache_stats():
+    return jsonify(db.cache_stats())
+
 # =========================
 # Health check
 # =========================
@@ -1,6 +1,7 @@
 from flask import Flask, request, jsonify
 import os, json, uuid, logging
 from datetime import datetime
+from storage_backends import open_storage
 
 app = Flask(__name__)
 
@@ -20,6 +21,7 @@ JSON_DIR = "./json_data"
 
 os.makedirs(LOG_DIR, exist_ok=True)
 os.makedirs(JSON_DIR, exist_ok=True)
+json_store = open_storage(JSON_DIR)
 
 # =========================
 # LOGGER FACTORY
@@ -58,9 +60,7 @@ def get_camera():
 
 def save_json(camera, data):
     ts = datetime.now().strftime("%Y%m%d_%H%M%S")
-    path = os.path.join(JSON_DIR, f"{camera}_{ts}.json")
-    with open(path, "w") as f:
-        json.dump(data, f, indent=2, default=str)
+    json_store.put(f"{camera}_{ts}.json", json.dumps(data, indent=2, default=str).encode("utf-8"))
 
 # =========================
 # SINGLE TOLLGATE ENDPOINT
@@ -1,10 +1,18 @@
 from flask import Flask, request, jsonify, render_template_string
 import base64, os, json
 from datetime import datetime
+from health import HealthMonitor, disk_probe
+from detection import Detection
+from storage_backends import open_storage
+from storage_quota import StorageManager, StorageFull
+from idempotency import IdempotencyCache, event_id_for, DUPLICATES
 
 app = Flask(__name__)
 recent_events = []
 vehicle_count = 0
+# Camera resends of a TollgateInfo event are acked without re-processing
+seen_events = IdempotencyCache()
+seen_events.init_app(app)
 
 # Directories
 SAVE_DIR = "./downloads"
@@ -13,6 +21,19 @@ JSON_DIR = "./json_data"
 os.makedirs(SAVE_DIR, exist_ok=True)
 os.makedirs(LOG_DIR, exist_ok=True)
 os.makedirs(JSON_DIR, exist_ok=True)
+image_store = open_storage(SAVE_DIR)
+json_store = open_storage(JSON_DIR, fsync=True)
+
+# Quotas and free space: writes make room first instead of failing with ENOSPC
+storage = StorageManager([SAVE_DIR, JSON_DIR])
+storage.init_app(app)
+storage.start()
+
+# Disk probe runs in the background; /health only reads the cached result
+monitor = HealthMonitor()
+monitor.add_probe("disk", disk_probe([SAVE_DIR, LOG_DIR, JSON_DIR]))
+monitor.init_app(app)
+monitor.start()
 
 # =========================
 # Webhook Logger (Separate File)
@@ -48,16 +69,22 @@ def log_event(message):
     except Exception as e:
         print(f"Log error: {e}")
 
+def save_file(store, key, data):
+    """Write through the quota manager; False (and logged) when no space could be freed"""
+    try:
+        storage.put(store, key, data)
+        return True
+    except StorageFull as e:
+        log_event(f"Skipped {key}: {e}")
+        return False
+
 # Function to save JSON data
 def save_json_data(data, prefix="vehicle"):
     try:
         ts = datetime.now().strftime("%Y%m%d_%H%M%S")
         filename = f"{prefix}_{ts}.json"
-        filepath = os.path.join(JSON_DIR, filename)
-        with open(filepath, 'w', encoding='utf-8') as f:
-            json.dump(data, f, indent=2, default=str)
-            f.flush()
-            os.fsync(f.fileno())
+        if not save_file(json_store, filename, json.dumps(data, indent=2, default=str).encode("utf-8")):
+            return None
         log_event(f"JSON saved: {filename}")
         return filename
     except Exception as e:
@@ -102,9 +129,8 @@ def webhook():
             img_b64 = data["Image"]
             img_ext = get_image_format(img_b64)
             img_file = f"{data.get('Plate','UNKNOWN')}_{ts}{img_ext}"
-            with open(os.path.join(SAVE_DIR, img_file), "wb") as f:
-                f.write(base64.b64decode(img_b64))
-            event["ImageSavedAs"] = img_file
+            if save_file(image_store, img_file, base64.b64decode(img_b64)):
+                event["ImageSavedAs"] = img_file
 
     # Non-JSON raw data
     else:
@@ -115,8 +141,8 @@ def webhook():
         event["Files"] = []
         for name, file in request.files.items():
             img_file = f"{name}_{ts}.jpg"
-            file.save(os.path.join(SAVE_DIR, img_file))
-            event["Files"].append({"field": name, "filename": file.filename, "saved_as": img_file})
+            if save_file(image_store, img_file, file.read()):
+                event["Files"].append({"field": name, "filename": file.filename, "saved_as": img_file})
 
     # Store event in memory
     recent_events.insert(0, event)
@@ -134,74 +160,58 @@ def webhook():
 # =========================
 @app.route("/NotificationInfo/TollgateInfo", methods=["POST"])
 def tollgate_info():
-    import uuid
-    request_id = str(uuid.uuid4())
-    
     try:
         data = request.get_json(force=True)
+        request_id = event_id_for(data)
+        ack = seen_events.claim(request_id)
+        if ack is not None:
+            DUPLICATES.inc(camera="tollgate")
+            return seen_events.duplicate_response(ack)
         
         # Extract info
+        det = Detection.from_payload(data, "tollgate", request_id)
         picture_data = data.get("Picture", {})
-        plate_info = picture_data.get("Plate", {})
-        snap_info = picture_data.get("SnapInfo", {})
-        
-        plate_number = plate_info.get("PlateNumber", "UNKNOWN")
-        device_id = snap_info.get("DeviceID", "NO_ID")
         
         # Create folder
-        folder_name = f"{plate_number}_{device_id}_{request_id[:8]}"
-        request_dir = os.path.join(SAVE_DIR, folder_name)
-        os.makedirs(request_dir, exist_ok=True)
-        
-        saved_files = []
+        folder_name = f"{det.plate}_{det.device_id or 'NO_ID'}_{request_id[:8]}"
+        det.image_dir = os.path.join(SAVE_DIR, folder_name)
+        saved_files = det.images
         
         # Save cutout picture
         cutout_pic = picture_data.get("CutoutPic", {})
         if cutout_pic and "Content" in cutout_pic:
             content = cutout_pic["Content"]
             filename = cutout_pic.get("PicName", "cutout.jpg")
-            full_path = os.path.join(request_dir, filename)
-            with open(full_path, "wb") as f:
-                f.write(base64.b64decode(content))
-            saved_files.append(filename)
+            if save_file(image_store, f"{folder_name}/{filename}", base64.b64decode(content)):
+                saved_files.append(filename)
         
         # Save normal picture
         normal_pic = picture_data.get("NormalPic", {})
         if normal_pic and "Content" in normal_pic:
             content = normal_pic["Content"]
             filename = normal_pic.get("PicName", "normal.jpg")
-            full_path = os.path.join(request_dir, filename)
-            with open(full_path, "wb") as f:
-                f.write(base64.b64decode(content))
-            saved_files.append(filename)
+            if save_file(image_store, f"{folder_name}/{filename}", base64.b64decode(content)):
+                saved_files.append(filename)
         
         # Increment vehicle count and log
         global vehicle_count
         vehicle_count += 1
-        log_msg = f"POST /NotificationInfo/TollgateInfo - VEHICLE #{vehicle_count} - Plate: {plate_number}, Saved: {len(saved_files)} images"
+        log_msg = f"POST /NotificationInfo/TollgateInfo - VEHICLE #{vehicle_count} - Plate: {det.plate}, Saved: {len(saved_files)} images"
         log_event(log_msg)
         
-        # Save complete data as JSON (including base64 images)
-        json_data = {
-            "vehicle_number": vehicle_count,
-            "plate": plate_number,
-            "device_id": device_id,
-            "timestamp": datetime.now().isoformat(),
-            "saved_images": saved_files,
-            "request_id": request_id,
-            "cutout_picture": cutout_pic,
-            "normal_picture": normal_pic
-        }
-        save_json_data(json_data, f"vehicle_{vehicle_count}")
+        # Archive the compact record; the images themselves are already in the image store
+        save_json_data(dict(det.to_dict(), vehicle_number=vehicle_count), f"vehicle_{vehicle_count}")
         
-        return jsonify({
+        ack = {
             "status": "success",
             "request_id": request_id,
             "folder": folder_name,
             "saved_images": saved_files,
-            "plate": plate_number,
+            "plate": det.plate,
             "total_count": vehicle_count
-        }), 200
+        }
+        seen_events.complete(request_id, ack)
+        return jsonify(ack), 200
     except Exception as e:
         log_event(f"Error processing tollgate: {str(e)}")
         return jsonify({"status": "error", "message": str(e)}), 400
@@ -229,8 +239,9 @@ def get_vehicle_count():
 # =========================
 @app.route("/health", methods=["GET", "POST"])
 def health_check():
-    log_event(f"POST/GET /health from {request.remote_addr}")
-    return jsonify({"status": "healthy"})
+    # No logging here: every probe used to append and fsync the webhook log
+    snap = monitor.snapshot()
+    return jsonify({"status": snap["status"]}), (200 if snap["ready"] else 503)
 
 # =========================
 # Catch 404s and log
@@ -4,11 +4,33 @@ Camera 1: /webhook, /health, /NotificationInfo/TollgateInfo
 Camera 2: /webhooks, /healths, /NotificationInfo/TollgateInfo1
 Database: PostgreSQL ONLY with vehicle_detection
 """
+from startup import StartupTimer
+startup = StartupTimer("anpr_server_combined")
 
 from flask import Flask, request, jsonify, render_template_string
+from dotenv import load_dotenv
+startup.mark("flask, dotenv", budgeted=False)
+
 import base64, os, json, uuid, logging
+from collections import deque
 from datetime import datetime
-from dotenv import load_dotenv
+from reconcile import StreamReconciler, wall_clock_ms
+import metrics
+from profiling import init_profiling
+from metrics import STAGE_SECONDS, BYTES_WRITTEN, DETECTIONS_TOTAL, Gauge
+from health import HealthMonitor, db_probe, disk_probe, backlog_probe
+from camera_monitor import CameraMonitor
+import export
+from image_tiering import ImageResolver, ImageTiering, IMAGE_TIERING
+from image_validation import ImageValidator, save_reports
+from storage_quota import StorageManager, StorageFull
+from storage_backends import open_storage
+from watchlist import Watchlist, WATCHLIST_FROM_DB
+from forwarder import Forwarder
+from detection import Detection
+from journeys import JourneyTracker
+from idempotency import IdempotencyCache, event_id_for, DUPLICATES
+startup.mark("imports")
 
 # =========================
 # ENV & DB INIT
@@ -18,22 +40,38 @@ load_dotenv()
 db = None
 db_type = "UNKNOWN"
 
-try:
-    from postgres_db import db as pg_db
-    db = pg_db
-    db_type = "PostgreSQL"
-except Exception as e:
-    print(f"PostgreSQL failed: {e}")
+# PostgreSQL writes that fail are spooled locally and replayed once the DB
+# is back, so an outage no longer needs the SQLite fallback; SQLite is only
+# used when chosen explicitly (DB_TYPE=sqlite) or psycopg2 is unavailable.
+# Neither connects here: the schema is migrated on first use / by the
+# background warm-up, and events arriving before that are spooled.
+if os.getenv("DB_TYPE", "postgres").lower() == "sqlite":
     from simple_db import db as sqlite_db
     db = sqlite_db
     db_type = "SQLite"
+else:
+    try:
+        from postgres_db import db as pg_db
+        db = pg_db
+        db_type = "PostgreSQL"
+    except Exception as e:
+        print(f"PostgreSQL failed: {e}")
+        from simple_db import db as sqlite_db
+        db = sqlite_db
+        db_type = "SQLite"
+
+startup.mark("db")
 
 app = Flask(__name__)
+metrics.init_app(app)
+init_profiling(app)
+export.init_app(app, db)
 
 vehicle_count = 0
 vehicle_count1 = 0
-recent_events = []
-recent_events1 = []
+# Last detections per camera as compact records, not payloads
+recent_events = deque(maxlen=20)
+recent_events1 = deque(maxlen=20)
 
 # =========================
 # DIRECTORIES
@@ -46,6 +84,32 @@ JSON_CAM2 = "./json_data/camera2"
 for d in [SAVE_DIR, LOG_DIR, JSON_CAM1, JSON_CAM2]:
     os.makedirs(d, exist_ok=True)
 
+# Usage ledger + quotas; writes make room first so the disk never fills up
+storage = StorageManager([SAVE_DIR, JSON_CAM1, JSON_CAM2])
+storage.init_app(app)
+storage.start()
+
+# Where images and JSON archives go (STORAGE_BACKEND: local files, segment packs or S3);
+# the quota ledger above only applies to the local-file backend
+image_store = open_storage(SAVE_DIR)
+json_stores = {"camera1": open_storage(JSON_CAM1, fsync=True), "camera2": open_storage(JSON_CAM2, fsync=True)}
+
+# Old event folders move to per-day cold segments; /images/... finds them in either tier
+ImageResolver(backends=[image_store]).init_app(app)
+if IMAGE_TIERING:
+    ImageTiering().start()
+
+# Saved images are checked (markers, size, sha256) in worker processes, off the ack path;
+# the reports are kept in the event folder as image_checks.json
+def on_image_report(det, name, report):
+    save_reports(image_store, det)
+
+def on_corrupt_image(det, name, report):
+    logger = cam2_logger if det.camera == "camera2" else cam1_logger
+    logger.error(f"CORRUPT IMAGE {det.camera} plate {det.plate} {name}: {report['error']}")
+
+validator = ImageValidator(on_report=on_image_report, on_corrupt=on_corrupt_image).start()
+
 # =========================
 # LOGGER SETUP
 # =========================
@@ -86,6 +150,96 @@ cam2_logger = create_logger(
 )
 
 
+# =========================
+# HEALTH PROBES
+# =========================
+# Probes run on a background thread; /health, /healths and /health/ready
+# only read the cached snapshot, so probing never touches disk or the DB
+def on_camera_stall(state, silent, limit):
+    logger = cam2_logger if state.camera == "camera2" else cam1_logger
+    logger.warning(f"STALL {state.camera} device {state.device_id} silent for {silent:.0f}s (expected under {limit:.0f}s)")
+
+def on_camera_recover(state, silent):
+    logger = cam2_logger if state.camera == "camera2" else cam1_logger
+    logger.info(f"RECOVERED {state.camera} device {state.device_id} after {silent:.0f}s")
+
+cameras = CameraMonitor(on_stall=on_camera_stall, on_recover=on_camera_recover)
+cameras.init_app(app)
+cameras.start()
+
+health = HealthMonitor()
+spooled = getattr(db, "spool", None) is not None
+# With a spool, a DB outage (or the startup warm-up) is absorbed locally: the
+# server stays ready for the cameras until the spool itself backs up
+health.add_probe("database", db_probe(db), critical=not spooled)
+health.add_probe("disk", disk_probe([SAVE_DIR, JSON_CAM1, JSON_CAM2, LOG_DIR]))
+if spooled:
+    health.add_probe("spool_backlog", backlog_probe(db.spool.backlog_bytes))
+health.add_probe("cameras", cameras.probe, critical=False)
+health.init_app(app)
+health.start()
+
+
+# =========================
+# WATCHLIST
+# =========================
+# check() is a dict lookup on the request thread; the alert is logged,
+# streamed and POSTed by the watchlist's dispatcher thread
+def on_watchlist_alert(alert):
+    logger = cam2_logger if alert["camera"] == "camera2" else cam1_logger
+    logger.warning(f"WATCHLIST {alert['list']} {alert['match']} plate {alert['plate']} "
+                   f"(listed {alert['matched']}) {alert['note'] or ''}")
+
+watchlist = Watchlist(db=db if WATCHLIST_FROM_DB and hasattr(db, "get_watchlist") else None)
+watchlist.bus.subscribe(on_watchlist_alert)
+watchlist.init_app(app)
+watchlist.start()
+
+
+# =========================
+# OUTBOUND FORWARDING (FORWARD_URLS)
+# =========================
+forwarder = Forwarder()
+forwarder.init_app(app)
+forwarder.start()
+
+
+# =========================
+# JOURNEYS (cam1 entry -> cam2 exit)
+# =========================
+journeys = JourneyTracker(db=db if hasattr(db, "add_journeys") else None)
+journeys.init_app(app)
+journeys.start()
+
+
+# =========================
+# CAMERA RETRIES
+# =========================
+# Event ids come from the camera's own identity for the event, so a resend
+# after an ack timeout is answered from here without touching disk or DB
+seen_events = IdempotencyCache()
+seen_events.init_app(app)
+
+
+# =========================
+# CAM1 / CAM2 RECONCILIATION
+# =========================
+def on_reconcile(outcome, event, other):
+    # A one-camera event means the other camera missed or misread the plate
+    if outcome == "cam1_only":
+        cam2_logger.warning(f"RECONCILE cam2 missed plate {event[1]} seen by cam1")
+    elif outcome == "cam2_only":
+        cam1_logger.warning(f"RECONCILE cam1 missed plate {event[1]} seen by cam2")
+
+reconciler = StreamReconciler(
+    window_ms=int(float(os.getenv("RECONCILE_WINDOW", "5")) * 1000),
+    on_result=on_reconcile,
+)
+
+Gauge("anpr_reconcile_pending", "Detections waiting for the other camera", ("camera",),
+      func=lambda: {(f"camera{c}",): len(q) for c, q in reconciler.pending.items()})
+
+
 # =========================
 # UTILITIES
 # =========================
@@ -104,24 +258,47 @@ def get_image_format(b64_data):
 def save_json(data, prefix, camera):
     ts = datetime.now().strftime("%Y%m%d_%H%M%S")
     filename = f"{prefix}_{ts}.json"
-    base = JSON_CAM1 if camera == "camera1" else JSON_CAM2
-    path = os.path.join(base, filename)
-
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(data, f, indent=2, default=str)
-        f.flush()
-        os.fsync(f.fileno())
+    store = json_stores[camera]
+    body = json.dumps(data, indent=2, default=str).encode("utf-8")
+    path = store.local_path(filename)
+
+    if path:
+        try:
+            storage.ensure(path, len(body), "json")
+        except StorageFull as e:
+            print(f"[ERROR] JSON archive skipped: {e}")
+            return None
+
+    with STAGE_SECONDS.time(stage="json_archive", camera=camera):
+        store.put(filename, body)
+    BYTES_WRITTEN.inc(len(body), kind="json", camera=camera)
+    if path:
+        storage.record(path, len(body))
 
     return filename
 
 
-def save_nested_image(pic_obj, folder, fallback):
+def save_nested_image(pic_obj, det, fallback, camera):
     if not pic_obj or "Content" not in pic_obj:
         return None
-    content = pic_obj["Content"].replace('\\/', '/')
     name = pic_obj.get("PicName") or fallback
-    with open(os.path.join(folder, name), "wb") as f:
-        f.write(base64.b64decode(content))
+    with STAGE_SECONDS.time(stage="base64_decode", camera=camera):
+        img = base64.b64decode(pic_obj["Content"].replace('\\/', '/'))
+    key = f"{os.path.basename(det.image_dir)}/{name}"
+    path = image_store.local_path(key)
+    if path:
+        try:
+            storage.ensure(path, len(img))
+        except StorageFull as e:
+            # Drop the image, keep the detection: the DB insert still runs
+            print(f"[ERROR] Image skipped: {e}")
+            return None
+    with STAGE_SECONDS.time(stage="image_write", camera=camera):
+        image_store.put(key, img)
+    BYTES_WRITTEN.inc(len(img), kind="image", camera=camera)
+    if path:
+        storage.record(path, len(img))
+    validator.submit(det, name, data=img, path=path)
     return name
 
 # =========================
@@ -148,45 +325,60 @@ def cam1_webhook():
 @app.route("/NotificationInfo/TollgateInfo", methods=["POST"])
 def cam1_tollgate():
     global vehicle_count
-    vehicle_count += 1
+    with STAGE_SECONDS.time(stage="json_parse", camera="camera1"):
+        data = request.get_json(force=True)
+    event_id = event_id_for(data)
+    ack = seen_events.claim(event_id)
+    if ack is not None:
+        DUPLICATES.inc(camera="camera1")
+        return seen_events.duplicate_response(ack)
 
-    data = request.get_json(force=True)
-    plate = data.get("Picture", {}).get("Plate", {}).get("PlateNumber", "UNKNOWN")
-    req_id = str(uuid.uuid4())
+    vehicle_count += 1
+    DETECTIONS_TOTAL.inc(camera="camera1")
+    det = Detection.from_payload(data, "camera1", event_id)
+    watchlist.check(det.plate, det.camera, det.event_id)
 
-    folder = os.path.join(SAVE_DIR, f"{plate}_CAM1_{req_id[:6]}")
-    os.makedirs(folder, exist_ok=True)
+    det.image_dir = os.path.join(SAVE_DIR, f"{det.plate}_CAM1_{det.event_id[:6]}")
 
     pic = data.get("Picture", {})
-    files = []
-
-    f1 = save_nested_image(pic.get("CutoutPic"), folder, "cutout.jpg")
-    f2 = save_nested_image(pic.get("NormalPic"), folder, "normal.jpg")
-
-    if f1: files.append(f1)
-    if f2: files.append(f2)
+    for key, fallback in (("CutoutPic", "cutout.jpg"), ("NormalPic", "normal.jpg")):
+        name = save_nested_image(pic.get(key), det, fallback, "camera1")
+        if name:
+            det.images.append(name)
 
     # ✅ CORRECT LOG (only once, before return)
-    cam1_logger.info(
-        f"POST /NotificationInfo/TollgateInfo (Camera 1) "
-        f"- VEHICLE #{vehicle_count} - Plate: {plate}"
-    )
+    with STAGE_SECONDS.time(stage="log", camera="camera1"):
+        cam1_logger.info(
+            f"POST /NotificationInfo/TollgateInfo (Camera 1) "
+            f"- VEHICLE #{vehicle_count} - Plate: {det.plate}"
+        )
+
+    reconciler.add(1, wall_clock_ms(), det.plate, det.event_id)
+    cameras.observe(det.device_id or "camera1", "camera1")
 
     try:
-        db.add_vehicle_detection(req_id, plate, data, folder)
+        with STAGE_SECONDS.time(stage="db_insert", camera="camera1"):
+            db.add_vehicle_detection(det.event_id, det.plate, data, det.image_dir, camera=det.camera)
     except Exception as e:
         cam1_logger.error(f"DB error: {e}")
+    # The payload (and its base64 images) is not needed past this point
+    del data, pic
+    forwarder.publish(det)
+    journeys.observe_detection(det)
+    recent_events.appendleft(det)
 
-    save_json({"plate": plate, "files": files}, "vehicle", "camera1")
+    save_json(det.to_dict(), "vehicle", "camera1")
 
-    return jsonify(status="success", plate=plate, camera="camera1")
+    ack = dict(status="success", plate=det.plate, camera="camera1")
+    seen_events.complete(det.event_id, ack)
+    return jsonify(ack)
 
 
 
 @app.route("/health")
 def cam1_health():
-    cam1_logger.info("Health check")
-    return jsonify(camera="camera1", status="healthy", count=vehicle_count)
+    snap = health.snapshot()
+    return jsonify(camera="camera1", status=snap["status"], count=vehicle_count), (200 if snap["ready"] else 503)
 
 
 # =========================
@@ -213,44 +405,59 @@ def cam2_webhook():
 @app.route("/NotificationInfo/TollgateInfo1", methods=["POST"])
 def cam2_tollgate():
     global vehicle_count1
-    vehicle_count1 += 1
+    with STAGE_SECONDS.time(stage="json_parse", camera="camera2"):
+        data = request.get_json(force=True)
+    event_id = event_id_for(data)
+    ack = seen_events.claim(event_id)
+    if ack is not None:
+        DUPLICATES.inc(camera="camera2")
+        return seen_events.duplicate_response(ack)
 
-    data = request.get_json(force=True)
-    plate = data.get("Picture", {}).get("Plate", {}).get("PlateNumber", "UNKNOWN")
-    req_id = str(uuid.uuid4())
+    vehicle_count1 += 1
+    DETECTIONS_TOTAL.inc(camera="camera2")
+    det = Detection.from_payload(data, "camera2", event_id)
+    watchlist.check(det.plate, det.camera, det.event_id)
 
-    folder = os.path.join(SAVE_DIR, f"{plate}_CAM2_{req_id[:6]}")
-    os.makedirs(folder, exist_ok=True)
+    det.image_dir = os.path.join(SAVE_DIR, f"{det.plate}_CAM2_{det.event_id[:6]}")
 
     pic = data.get("Picture", {})
-    files = []
-
-    f1 = save_nested_image(pic.get("CutoutPic"), folder, "cutout.jpg")
-    f2 = save_nested_image(pic.get("NormalPic"), folder, "normal.jpg")
-
-    if f1: files.append(f1)
-    if f2: files.append(f2)
+    for key, fallback in (("CutoutPic", "cutout.jpg"), ("NormalPic", "normal.jpg")):
+        name = save_nested_image(pic.get(key), det, fallback, "camera2")
+        if name:
+            det.images.append(name)
 
     # ✅ CORRECT, EXPLICIT LOG
-    cam2_logger.info(
-        f"POST /NotificationInfo/TollgateInfo1 (Camera 2) "
-        f"- VEHICLE #{vehicle_count1} - Plate: {plate}"
-    )
+    with STAGE_SECONDS.time(stage="log", camera="camera2"):
+        cam2_logger.info(
+            f"POST /NotificationInfo/TollgateInfo1 (Camera 2) "
+            f"- VEHICLE #{vehicle_count1} - Plate: {det.plate}"
+        )
+
+    reconciler.add(2, wall_clock_ms(), det.plate, det.event_id)
+    cameras.observe(det.device_id or "camera2", "camera2")
 
     try:
-        db.add_vehicle_detection(req_id, plate, data, folder)
+        with STAGE_SECONDS.time(stage="db_insert", camera="camera2"):
+            db.add_vehicle_detection(det.event_id, det.plate, data, det.image_dir, camera=det.camera)
     except Exception as e:
         cam2_logger.error(f"DB error: {e}")
+    # The payload (and its base64 images) is not needed past this point
+    del data, pic
+    forwarder.publish(det)
+    journeys.observe_detection(det)
+    recent_events1.appendleft(det)
 
-    save_json({"plate": plate, "files": files}, "vehicle", "camera2")
-    
-    return jsonify(status="success", plate=plate, camera="camera2")
+    save_json(det.to_dict(), "vehicle", "camera2")
+
+    ack = dict(status="success", plate=det.plate, camera="camera2")
+    seen_events.complete(det.event_id, ack)
+    return jsonify(ack)
 
 
 @app.route("/healths")
 def cam2_health():
-    cam2_logger.info("Health check")
-    return jsonify(camera="camera2", status="healthy", count=vehicle_count1)
+    snap = health.snapshot()
+    return jsonify(camera="camera2", status=snap["status"], count=vehicle_count1), (200 if snap["ready"] else 503)
 
 
 # =========================
@@ -266,11 +473,26 @@ def count():
     )
 
 
+@app.route("/vehicle/recent")
+def recent():
+    return jsonify(cam1=[d.to_dict() for d in recent_events], cam2=[d.to_dict() for d in recent_events1])
+
+
+@app.route("/reconcile/stats")
+def reconcile_stats():
+    reconciler.expire(wall_clock_ms())
+    return jsonify(reconciler.report())
+
+
 @app.route("/")
 def index():
     return "<h2>Multi-Camera ANPR Server Running</h2>"
 
 
+startup.mark("app")
+startup.done()
+
+
 if __name__ == "__main__":
     print("🚀 ANPR Server Started")
     app.run(host="0.0.0.0", port=5000, debug=False)
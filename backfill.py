@@ -0,0 +1,364 @@
+#!/usr/bin/env python3
+"""
+Bulk Backfill of Archived Detections into the DB
+Walks json_cam1/, json_data/camera1/ and downloads/, parses the files in a
+process pool, writes payload images into the image store and bulk-loads the
+rows in batches.
+
+Camera payloads get the event id live ingest gives them (idempotency.py),
+and summaries carry theirs, so a backfilled event already ingested live is
+not inserted twice. Payload images go through open_storage() and the quota
+ledger into the folder the live server would have used (images_cam1/ for
+json_cam1, downloads/<plate>_CAM1_<id> otherwise). An image folder takes the
+id of the payload or summary that names it, or of the DB row whose
+image_url it is; only folders with neither get an id derived from plate and
+snap time. Finished files, and the folders backfill wrote, are appended to
+a checkpoint file, so an interrupted run resumes and a re-run does not pick
+its own folders up as new units.
+
+    python backfill.py                      # all default sources
+    python backfill.py --sources json_cam1 --workers 8 --batch 1000
+    python backfill.py --dry-run
+"""
+import argparse
+import base64
+import json
+import os
+import re
+import sys
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from functools import partial
+
+from idempotency import event_id_for, event_identity
+
+DEFAULT_SOURCES = ["json_cam1", "json_data/camera1", "downloads"]
+DEFAULT_IMAGE_DIR = "./downloads"
+# cam1_server keeps json_cam1 payload images here, as <plate>_<id>
+CAM1_IMAGE_DIR = "./images_cam1"
+DEFAULT_CHECKPOINT = "./backfill.checkpoint"
+DEFAULT_BATCH = 500
+
+EVENT_NAMESPACE = uuid.UUID("6f0c6a52-5d4e-4d0b-9a51-7e3b0c2f1d11")
+PIC_KEYS = ("CutoutPic", "NormalPic", "VehiclePic")
+# MH48AG4553-20260206125658-plate.jpg, ACPPL05-20260204152015.jpg
+PIC_NAME_RE = re.compile(r'^(?P<plate>.+?)-(?P<ts>\d{14})(?:-|\.)')
+# <plate>_CAM2_<id> folders of the combined server
+FOLDER_CAMERA_RE = re.compile(r'_CAM(\d)_', re.IGNORECASE)
+
+
+def derive_event_id(plate, snap_time):
+    """Stable event id for a detection: same plate and second -> same id"""
+    return str(uuid.uuid5(EVENT_NAMESPACE, f"{plate}|{snap_time.strftime('%Y%m%d%H%M%S')}"))
+
+
+def _parse_snap_time(value):
+    try:
+        return datetime.strptime(value, "%Y-%m-%d %H:%M:%S")
+    except (TypeError, ValueError):
+        return None
+
+
+def _time_from_pic_names(names):
+    for name in names:
+        m = PIC_NAME_RE.match(name or "")
+        if m:
+            return datetime.strptime(m.group("ts"), "%Y%m%d%H%M%S")
+    return None
+
+
+def _row(plate, snap_time, data, image_url, vehicle_type=None, confidence=None, event_id=None, camera=None):
+    return {
+        "event_id": event_id or derive_event_id(plate, snap_time),
+        "license_plate": plate,
+        "vehicle_type": vehicle_type,
+        "confidence": confidence,
+        "detection_data": data,
+        "image_url": image_url,
+        "camera": camera,
+        "created_at": snap_time,
+    }
+
+
+def image_layout(path, image_dir):
+    """(image root, folder format) the live server used for the payload archived at path"""
+    if os.path.basename(os.path.dirname(os.path.abspath(path))) == "json_cam1":
+        return os.path.abspath(CAM1_IMAGE_DIR), "{plate}_{id}"
+    return image_dir, "{plate}_CAM1_{id}"
+
+
+# =========================
+# WORKERS (run in the pool)
+# =========================
+def parse_payload(data, path, image_dir, keep_content):
+    """(row, images) for a full camera payload ({"Picture": {...}})
+
+    images are (root, key, bytes) for the driver to store; none when
+    image_dir is None.
+    """
+    pic = data.get("Picture") or {}
+    plate_info = pic.get("Plate") or {}
+    plate = plate_info.get("PlateNumber")
+    plate = "UNKNOWN" if plate is None or plate == "" else str(plate)
+    snap = pic.get("SnapInfo") or {}
+    snap_time = (_parse_snap_time(snap.get("SnapTime"))
+                 or _time_from_pic_names((pic.get(k) or {}).get("PicName") for k in PIC_KEYS)
+                 or datetime.fromtimestamp(os.path.getmtime(path)))
+    # Same id as when the payload was ingested live
+    event_id = event_id_for(data) if event_identity(data) else derive_event_id(plate, snap_time)
+    images = []
+    if image_dir:
+        root, folder_format = image_layout(path, image_dir)
+        folder = folder_format.format(plate=plate, id=event_id[:6])
+
+    for key in PIC_KEYS:
+        obj = pic.get(key)
+        if not obj or "Content" not in obj or not image_dir:
+            continue
+        name = obj.get("PicName") or f"{key.lower()}.jpg"
+        images.append((root, f"{folder}/{name}", base64.b64decode(obj["Content"].replace('\\/', '/'))))
+        if not keep_content:
+            # The image now lives in the store; keep the JSONB row small
+            obj = dict(obj)
+            del obj["Content"]
+            pic = dict(pic, **{key: obj})
+    if not keep_content:
+        data = dict(data, Picture=pic)
+
+    vehicle = pic.get("Vehicle") or {}
+    row = _row(plate, snap_time, data, os.path.join(root, folder) if images else None,
+               vehicle.get("VehicleType"), plate_info.get("Confidence"), event_id, "camera1")
+    return row, images
+
+
+def parse_json_file(path, image_dir, keep_content):
+    """(rows, images) for one archived JSON file (payload, or a {"plate", "files"/"images"} summary)"""
+    with open(path, "rb") as f:
+        data = json.load(f)
+    if not isinstance(data, dict):
+        return [], []
+    if "Picture" in data:
+        row, images = parse_payload(data, path, image_dir, keep_content)
+        return [row], images
+    files = data.get("files", data.get("images"))
+    if "plate" in data and files is not None:
+        snap_time = _time_from_pic_names(files) or datetime.fromtimestamp(os.path.getmtime(path))
+        # Detection.to_dict() summaries name the live folder under downloads/
+        folder = data.get("image_url")
+        image_url = os.path.join(image_dir or DEFAULT_IMAGE_DIR, folder) if folder else None
+        return [_row(data["plate"], snap_time, data, image_url, event_id=data.get("event_id"),
+                     camera=data.get("camera"))], []
+    # webhook_*.json holds device info, not detections
+    return [], []
+
+
+def parse_download_folder(path):
+    """Row for one downloads/<plate>_<camera or device>_<id> folder"""
+    name = os.path.basename(path.rstrip("/"))
+    plate = name.split("_", 1)[0] or "UNKNOWN"
+    files = sorted(e.name for e in os.scandir(path) if e.is_file())
+    if not files:
+        return []
+    snap_time = _time_from_pic_names(files)
+    if snap_time is None:
+        oldest = min(os.path.getmtime(os.path.join(path, f)) for f in files)
+        snap_time = datetime.fromtimestamp(int(oldest))
+    m = FOLDER_CAMERA_RE.search(name)
+    return [_row(plate, snap_time, {"source": "downloads", "files": files}, path,
+                 camera=f"camera{m.group(1)}" if m else None)]
+
+
+def parse_source(path, image_dir=DEFAULT_IMAGE_DIR, keep_content=False):
+    """(path, rows, images, error) for one unit"""
+    try:
+        if os.path.isdir(path):
+            return path, parse_download_folder(path), [], None
+        return (path, *parse_json_file(path, image_dir, keep_content), None)
+    except Exception as e:
+        return path, [], [], f"{type(e).__name__}: {e}"
+
+
+# =========================
+# DRIVER
+# =========================
+def find_sources(sources):
+    """Backfill units in a stable order: JSON files, then download folders"""
+    units = []
+    for source in sources:
+        if not os.path.isdir(source):
+            print(f"[SKIP] {source}: not a directory")
+            continue
+        for entry in sorted(os.scandir(source), key=lambda e: e.name):
+            if entry.is_dir():
+                units.append(entry.path)
+            elif entry.name.endswith(".json"):
+                units.append(entry.path)
+    return units
+
+
+def load_checkpoint(path):
+    """Finished units, as absolute paths"""
+    try:
+        with open(path, encoding="utf-8") as f:
+            return {os.path.abspath(line.rstrip("\n")) for line in f if line.strip()}
+    except OSError:
+        return set()
+
+
+def live_event_id(db, plate, folder):
+    """Event id of the stored detection this folder belongs to, if any
+
+    Matched on image_url, else on the event id prefix the servers put last
+    in the folder name (<plate>_CAM1_<id[:6]>, <plate>_<id[:6]>).
+    """
+    prefix = folder.rsplit("_", 1)[-1]
+    by_prefix = None
+    for row in db.get_vehicle_by_plate(plate) or ():
+        if os.path.basename((row.get("image_url") or "").rstrip("/\\")) == folder:
+            return row["event_id"]
+        if by_prefix is None and len(prefix) >= 6 and str(row["event_id"]).startswith(prefix):
+            by_prefix = row["event_id"]
+    return by_prefix
+
+
+class ImageWriter:
+    """Stores payload images for the driver: one store per root, quota-checked when local"""
+
+    def __init__(self, roots):
+        from storage_backends import open_storage
+        from storage_quota import StorageManager
+        self._open = open_storage
+        self.stores = {}
+        self.quota = StorageManager(roots)
+        self._scanned = False
+        self.skipped = 0
+
+    def write(self, images):
+        """Store images not already there; returns the local folders written to"""
+        from storage_quota import StorageFull
+        folders = set()
+        for root, key, img in images:
+            store = self.stores.get(root)
+            if store is None:
+                store = self.stores[root] = self._open(root)
+            path = store.local_path(key)
+            if path:
+                folders.add(os.path.dirname(path))
+            if store.exists(key):
+                continue
+            if path:
+                if not self._scanned:
+                    # The ledger starts empty in this process; take stock once, before the first write
+                    self.quota.scan()
+                    self._scanned = True
+                try:
+                    self.quota.ensure(path, len(img))
+                except StorageFull as e:
+                    self.skipped += 1
+                    print(f"[SKIP] {key}: {e}")
+                    continue
+            store.put(key, img)
+            if path:
+                self.quota.record(path, len(img))
+        return folders
+
+    def flush(self):
+        for store in self.stores.values():
+            store.flush()
+
+
+def append_checkpoint(path, done):
+    with open(path, "a", encoding="utf-8") as f:
+        f.write("".join(p + "\n" for p in done))
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def backfill(db, sources=DEFAULT_SOURCES, image_dir=DEFAULT_IMAGE_DIR, checkpoint=DEFAULT_CHECKPOINT,
+             batch_size=DEFAULT_BATCH, workers=None, keep_content=False, dry_run=False):
+    """Load every unfinished source unit; returns (units, rows, errors)"""
+    done = load_checkpoint(checkpoint) if checkpoint else set()
+    units = [u for u in find_sources(sources) if os.path.abspath(u) not in done]
+    print(f"[OK] {len(units)} files/folders to backfill ({len(done)} already done)")
+
+    seen = set()
+    folder_ids = {}   # image folder name -> event id, from this run's payloads and summaries
+    writer = None if dry_run else ImageWriter([image_dir, CAM1_IMAGE_DIR])
+    pending_rows, pending_units = [], []
+    total_rows = errors = 0
+    start = time.perf_counter()
+
+    def flush():
+        nonlocal total_rows
+        if pending_rows and not dry_run:
+            db.add_vehicle_detections_bulk(pending_rows)
+        if checkpoint and pending_units and not dry_run:
+            append_checkpoint(checkpoint, pending_units)
+        total_rows += len(pending_rows)
+        pending_rows.clear()
+        pending_units.clear()
+
+    worker = partial(parse_source, image_dir=None if dry_run else image_dir, keep_content=keep_content)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for i, (path, rows, images, error) in enumerate(pool.map(worker, units, chunksize=8), 1):
+            if error:
+                errors += 1
+                print(f"[ERROR] {path}: {error}")
+                continue
+            if images:
+                # Folders backfill fills are not new units the next time around
+                pending_units.extend(writer.write(images))
+            # find_sources lists JSON files before folders, so a folder's payload came first
+            is_folder = os.path.isdir(path)
+            for row in rows:
+                folder = os.path.basename((row["image_url"] or "").rstrip("/\\"))
+                if is_folder:
+                    event_id = folder_ids.get(folder) or (db and live_event_id(db, row["license_plate"], folder))
+                    if event_id:
+                        row["event_id"] = event_id
+                elif folder:
+                    folder_ids[folder] = row["event_id"]
+                if row["event_id"] not in seen:
+                    seen.add(row["event_id"])
+                    pending_rows.append(row)
+            pending_units.append(path)
+            if len(pending_rows) >= batch_size:
+                flush()
+                print(f"[OK] {i}/{len(units)} units, {total_rows} rows, "
+                      f"{total_rows / (time.perf_counter() - start):.0f} rows/s")
+    flush()
+    if writer is not None:
+        writer.flush()
+        if writer.skipped:
+            print(f"[ERROR] {writer.skipped} images skipped for lack of space")
+    print(f"[OK] Backfilled {total_rows} rows from {len(units) - errors} units "
+          f"in {time.perf_counter() - start:.1f}s ({errors} errors)")
+    return len(units), total_rows, errors
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Backfill the DB from archived JSON and download folders")
+    parser.add_argument('--sources', nargs='*', default=DEFAULT_SOURCES)
+    parser.add_argument('--image-dir', default=DEFAULT_IMAGE_DIR, help="image root for payloads outside json_cam1")
+    parser.add_argument('--checkpoint', default=DEFAULT_CHECKPOINT, help="resume file ('' to disable)")
+    parser.add_argument('--batch', type=int, default=DEFAULT_BATCH, help="rows per bulk insert")
+    parser.add_argument('--workers', type=int, default=None, help="parser processes (default: CPU count)")
+    parser.add_argument('--keep-content', action='store_true', help="keep base64 images in detection_data")
+    parser.add_argument('--dry-run', action='store_true', help="parse and count only; no DB or checkpoint writes")
+    args = parser.parse_args(argv)
+
+    db = None
+    if not args.dry_run:
+        if os.getenv('DB_TYPE', 'postgres').lower() == 'sqlite':
+            from simple_db import db
+        else:
+            from postgres_db import db
+    _, _, errors = backfill(db, args.sources, args.image_dir, args.checkpoint or None,
+                            args.batch, args.workers, args.keep_content, args.dry_run)
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,12 +1,33 @@
+from startup import StartupTimer
+startup = StartupTimer("cam1_server")
+
 from flask import Flask, request, jsonify
-import os, json, uuid, base64
-from datetime import datetime
 from dotenv import load_dotenv
+startup.mark("flask, dotenv", budgeted=False)
+
+import os, json, base64
+from datetime import datetime
 
 load_dotenv()
 from postgres_db import db
+import metrics
+from profiling import init_profiling
+from metrics import STAGE_SECONDS, BYTES_WRITTEN, DETECTIONS_TOTAL
+from health import HealthMonitor, db_probe, disk_probe, backlog_probe
+from camera_monitor import CameraMonitor
+from image_tiering import ImageResolver, ImageTiering, IMAGE_TIERING
+from image_validation import ImageValidator, save_reports
+from storage_quota import StorageManager, StorageFull
+from storage_backends import open_storage
+from watchlist import Watchlist, WATCHLIST_FROM_DB
+from forwarder import Forwarder
+from detection import Detection
+from idempotency import IdempotencyCache, event_id_for, DUPLICATES
+startup.mark("imports")
 
 app = Flask(__name__)
+metrics.init_app(app)
+init_profiling(app)
 
 BASE = os.getcwd()
 LOG_DIR = os.path.join(BASE, "logs")
@@ -16,6 +37,68 @@ IMG_DIR = os.path.join(BASE, "images_cam1")
 for d in [LOG_DIR, JSON_DIR, IMG_DIR]:
     os.makedirs(d, exist_ok=True)
 
+storage = StorageManager([JSON_DIR, IMG_DIR])
+storage.init_app(app)
+storage.start()
+
+# STORAGE_BACKEND picks local files, segment packs or S3; quotas only cover local files
+json_store = open_storage(JSON_DIR)
+image_store = open_storage(IMG_DIR)
+
+ImageResolver(backends=[image_store]).init_app(app)
+if IMAGE_TIERING:
+    ImageTiering().start()
+
+# Corrupt / truncated images are flagged by worker processes, never on the request thread
+def on_image_report(det, name, report):
+    save_reports(image_store, det)   # image_checks.json in the event folder
+
+def on_corrupt_image(det, name, report):
+    write_log(f"cam1 CORRUPT IMAGE plate {det.plate} {name}: {report['error']}")
+
+validator = ImageValidator(on_report=on_image_report, on_corrupt=on_corrupt_image).start()
+
+# =====================
+# HEALTH PROBES (background thread, endpoints read the cached result)
+# =====================
+def on_camera_stall(state, silent, limit):
+    write_log(f"cam1 STALL device {state.device_id} silent for {silent:.0f}s (expected under {limit:.0f}s)")
+
+def on_camera_recover(state, silent):
+    write_log(f"cam1 RECOVERED device {state.device_id} after {silent:.0f}s")
+
+cameras = CameraMonitor(on_stall=on_camera_stall, on_recover=on_camera_recover)
+cameras.init_app(app)
+cameras.start()
+
+monitor = HealthMonitor()
+# DB writes spool while Postgres is down, so only a backed-up spool makes the server unready
+monitor.add_probe("database", db_probe(db), critical=False)
+monitor.add_probe("disk", disk_probe([LOG_DIR, JSON_DIR, IMG_DIR]))
+monitor.add_probe("spool_backlog", backlog_probe(db.spool.backlog_bytes))
+monitor.add_probe("cameras", cameras.probe, critical=False)
+monitor.init_app(app)
+monitor.start()
+
+# =====================
+# WATCHLIST (alerts are delivered off the request thread)
+# =====================
+def on_watchlist_alert(alert):
+    write_log(f"cam1 WATCHLIST {alert['list']} {alert['match']} plate {alert['plate']} (listed {alert['matched']})")
+
+watchlist = Watchlist(db=db if WATCHLIST_FROM_DB else None)
+watchlist.bus.subscribe(on_watchlist_alert)
+watchlist.init_app(app)
+watchlist.start()
+
+forwarder = Forwarder()   # no-op unless FORWARD_URLS is set
+forwarder.init_app(app)
+forwarder.start()
+
+# Camera resends (same DeviceID/time/plate/UploadNum) are acked without any I/O
+seen_events = IdempotencyCache()
+seen_events.init_app(app)
+
 # =====================
 # LOG FILE (ONE PER START)
 # =====================
@@ -34,63 +117,110 @@ def write_log(text):
     ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S,%f")[:-3]
     line = f"{ts} - {text}\n"
 
-    with open(log_file, "a", encoding="utf-8") as f:
-        f.write(line)
-        f.flush()
-        os.fsync(f.fileno())
+    with STAGE_SECONDS.time(stage="log", camera="camera1"):
+        with open(log_file, "a", encoding="utf-8") as f:
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+    BYTES_WRITTEN.inc(len(line), kind="log", camera="camera1")
 
 # =====================
 def save_json(data):
     ts = datetime.now().strftime("%Y%m%d_%H%M%S")
-    with open(os.path.join(JSON_DIR, f"{ts}.json"), "w") as f:
-        json.dump(data, f, indent=2)
-
-def save_image(pic, folder, name):
+    filename = f"{ts}.json"
+    body = json.dumps(data, indent=2).encode("utf-8")
+    path = json_store.local_path(filename)
+    if path:
+        try:
+            storage.ensure(path, len(body), "json")
+        except StorageFull as e:
+            print("JSON archive skipped:", e)
+            return
+    with STAGE_SECONDS.time(stage="json_archive", camera="camera1"):
+        json_store.put(filename, body)
+    BYTES_WRITTEN.inc(len(body), kind="json", camera="camera1")
+    if path:
+        storage.record(path, len(body))
+
+def save_image(pic, det, name):
     if not pic or "Content" not in pic:
-        return
-    img = base64.b64decode(pic["Content"])
-    with open(os.path.join(folder, name), "wb") as f:
-        f.write(img)
+        return None
+    with STAGE_SECONDS.time(stage="base64_decode", camera="camera1"):
+        img = base64.b64decode(pic["Content"])
+    key = f"{os.path.basename(det.image_dir)}/{name}"
+    path = image_store.local_path(key)
+    if path:
+        try:
+            storage.ensure(path, len(img))
+        except StorageFull as e:
+            print("Image skipped:", e)
+            return None
+    with STAGE_SECONDS.time(stage="image_write", camera="camera1"):
+        image_store.put(key, img)
+    BYTES_WRITTEN.inc(len(img), kind="image", camera="camera1")
+    if path:
+        storage.record(path, len(img))
+    validator.submit(det, name, data=img, path=path)
+    return name
 
 # =====================
 @app.route("/NotificationInfo/TollgateInfo", methods=["POST"])
 def vehicle():
     global vehicle_count
-    vehicle_count += 1
 
     # handle ANY camera payload
-    try:
-        data = request.get_json(force=True, silent=True)
-        if not data:
-            data = json.loads(request.data.decode("utf-8"))
-    except:
-        data = {}
+    with STAGE_SECONDS.time(stage="json_parse", camera="camera1"):
+        try:
+            data = request.get_json(force=True, silent=True)
+            if not data:
+                data = json.loads(request.data.decode("utf-8"))
+        except:
+            data = {}
+
+    event_id = event_id_for(data)
+    ack = seen_events.claim(event_id)
+    if ack is not None:
+        DUPLICATES.inc(camera="camera1")
+        return seen_events.duplicate_response(ack)
 
-    plate = data.get("Picture", {}).get("Plate", {}).get("PlateNumber", "UNKNOWN")
-    event_id = str(uuid.uuid4())
+    vehicle_count += 1
+    DETECTIONS_TOTAL.inc(camera="camera1")
+    det = Detection.from_payload(data, "camera1", event_id)
+    watchlist.check(det.plate, det.camera, det.event_id)
 
-    folder = os.path.join(IMG_DIR, f"{plate}_{event_id[:6]}")
-    os.makedirs(folder, exist_ok=True)
+    det.image_dir = os.path.join(IMG_DIR, f"{det.plate}_{det.event_id[:6]}")
 
     pic = data.get("Picture", {})
-    save_image(pic.get("CutoutPic"), folder, "cutout.jpg")
-    save_image(pic.get("NormalPic"), folder, "normal.jpg")
+    for key, fallback in (("CutoutPic", "cutout.jpg"), ("NormalPic", "normal.jpg")):
+        name = save_image(pic.get(key), det, fallback)
+        if name:
+            det.images.append(name)
 
-    write_log(f"cam1 VEHICLE #{vehicle_count} Plate:{plate}")
-    print(f"CAM1 COUNT {vehicle_count} PLATE {plate}")
+    write_log(f"cam1 VEHICLE #{vehicle_count} Plate:{det.plate}")
+    print(f"CAM1 COUNT {vehicle_count} PLATE {det.plate}")
+    cameras.observe(det.device_id or "camera1", "camera1")
 
     try:
-        db.add_vehicle_detection(event_id, plate, data, folder)
+        with STAGE_SECONDS.time(stage="db_insert", camera="camera1"):
+            db.add_vehicle_detection(det.event_id, det.plate, data, det.image_dir, camera=det.camera)
     except Exception as e:
         print("DB error:", e)
+    forwarder.publish(det)
 
+    # json_cam1 keeps the raw payload on purpose: it is what backfill.py replays
     save_json(data)
-    return jsonify(status="ok", count=vehicle_count)
+    ack = dict(status="ok", count=vehicle_count)
+    seen_events.complete(det.event_id, ack)
+    return jsonify(ack)
 
 # =====================
 @app.route("/health", methods=["GET","POST"])
 def health():
-    return jsonify(cam1_count=vehicle_count)
+    snap = monitor.snapshot()
+    return jsonify(cam1_count=vehicle_count, status=snap["status"]), (200 if snap["ready"] else 503)
+
+startup.mark("app")
+startup.done()
 
 # =====================
 if __name__ == "__main__":
@@ -0,0 +1,262 @@
+"""
+Camera Heartbeat and Stall Detection
+Tracks last-seen time per SnapInfo.DeviceID and learns the usual gap between
+detections as an EWMA per hour of day, so a camera that is quiet at 3 AM is
+not flagged while the same silence at 6 PM is.
+observe() is O(1) and runs inline in the ingest handlers; a background
+thread checks for stalls and reports them via log line, metric and callback.
+"""
+import json
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+from metrics import Counter, Gauge
+
+CAMERA_EWMA_ALPHA = float(os.getenv('CAMERA_EWMA_ALPHA', '0.1'))
+CAMERA_STALL_FACTOR = float(os.getenv('CAMERA_STALL_FACTOR', '5'))
+CAMERA_STALL_MIN_SECONDS = float(os.getenv('CAMERA_STALL_MIN_SECONDS', '120'))
+CAMERA_STALL_DEFAULT_SECONDS = float(os.getenv('CAMERA_STALL_DEFAULT_SECONDS', '900'))
+CAMERA_MAX_GAP_SECONDS = float(os.getenv('CAMERA_MAX_GAP_SECONDS', str(6 * 3600)))
+CAMERA_CHECK_INTERVAL = float(os.getenv('CAMERA_CHECK_INTERVAL', '30'))
+CAMERA_STATE_FILE = os.getenv('CAMERA_STATE_FILE', './camera_state.json')
+
+CAMERA_STALLS = Counter("anpr_camera_stalls_total", "Camera stalls detected", ("device", "camera"))
+
+
+class CameraState:
+    __slots__ = ("device_id", "camera", "first_seen", "last_seen", "count", "ewma", "stalled", "stalls")
+
+    def __init__(self, device_id, camera=None):
+        self.device_id = device_id
+        self.camera = camera
+        self.first_seen = None
+        self.last_seen = None
+        self.count = 0
+        self.ewma = [None] * 24   # expected seconds between detections, per hour of day
+        self.stalled = False
+        self.stalls = 0
+
+
+class CameraMonitor:
+    """Per-device heartbeat tracker
+
+    on_stall(state, silent_seconds, threshold) and on_recover(state,
+    silent_seconds) are called from the checker thread and from observe()
+    respectively.
+    """
+
+    def __init__(self, alpha=CAMERA_EWMA_ALPHA, stall_factor=CAMERA_STALL_FACTOR,
+                 min_stall_seconds=CAMERA_STALL_MIN_SECONDS, default_stall_seconds=CAMERA_STALL_DEFAULT_SECONDS,
+                 state_file=CAMERA_STATE_FILE, on_stall=None, on_recover=None):
+        self.alpha = alpha
+        self.stall_factor = stall_factor
+        self.min_stall_seconds = min_stall_seconds
+        self.default_stall_seconds = default_stall_seconds
+        self.state_file = state_file
+        self.on_stall = on_stall
+        self.on_recover = on_recover
+        self.devices = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        if state_file:
+            self.load(state_file)
+
+    def observe(self, device_id, camera=None, ts=None):
+        """Record one detection; O(1)"""
+        ts = ts or time.time()
+        recovered = None
+        with self._lock:
+            state = self.devices.get(device_id)
+            if state is None:
+                state = self.devices[device_id] = CameraState(device_id, camera)
+                state.first_seen = ts
+            elif state.last_seen is not None and ts > state.last_seen:
+                gap = min(ts - state.last_seen, CAMERA_MAX_GAP_SECONDS)
+                hour = time.localtime(ts).tm_hour
+                prev = state.ewma[hour]
+                state.ewma[hour] = gap if prev is None else prev + self.alpha * (gap - prev)
+                if state.stalled:
+                    state.stalled = False
+                    recovered = ts - state.last_seen
+            if camera:
+                state.camera = camera
+            if state.last_seen is None or ts > state.last_seen:
+                state.last_seen = ts
+            state.count += 1
+        if recovered is not None and self.on_recover:
+            self.on_recover(state, recovered)
+
+    def learn(self, device_id, timestamps, camera=None):
+        """Seed the hourly EWMA from historic detection times (unix seconds)"""
+        for ts in sorted(timestamps):
+            self.observe(device_id, camera, ts)
+        with self._lock:
+            state = self.devices.get(device_id)
+            if state is not None:
+                state.stalled = False
+
+    def threshold(self, state, now=None):
+        """Seconds of silence after which this device counts as stalled"""
+        expected = state.ewma[time.localtime(now or time.time()).tm_hour]
+        if expected is None:
+            learned = [v for v in state.ewma if v is not None]
+            if not learned:
+                return self.default_stall_seconds
+            expected = max(learned)
+        return max(self.min_stall_seconds, self.stall_factor * expected)
+
+    def check(self, now=None):
+        """Flag newly stalled devices; returns the currently stalled ones"""
+        now = now or time.time()
+        newly, stalled = [], []
+        with self._lock:
+            for state in self.devices.values():
+                silent = now - state.last_seen
+                limit = self.threshold(state, now)
+                if silent > limit:
+                    stalled.append(state)
+                    if not state.stalled:
+                        state.stalled = True
+                        state.stalls += 1
+                        CAMERA_STALLS.inc(device=state.device_id, camera=state.camera or "")
+                        newly.append((state, silent, limit))
+        if self.on_stall:
+            for state, silent, limit in newly:
+                self.on_stall(state, silent, limit)
+        return stalled
+
+    def status(self, now=None):
+        now = now or time.time()
+        hour = time.localtime(now).tm_hour
+        states = self.snapshot()
+        cameras = []
+        for s in states:
+            expected = s.ewma[hour]
+            cameras.append({
+                "device_id": s.device_id,
+                "camera": s.camera,
+                "status": "stalled" if s.stalled else "ok",
+                "count": s.count,
+                "last_seen": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(s.last_seen)),
+                "seconds_since_seen": round(now - s.last_seen, 1),
+                "expected_gap_seconds": round(expected, 1) if expected is not None else None,
+                "stall_after_seconds": round(self.threshold(s, now), 1),
+                "stalls": s.stalls,
+            })
+        return {"hour": hour, "cameras": cameras}
+
+    def snapshot(self):
+        """The device states, copied out under the lock"""
+        with self._lock:
+            return list(self.devices.values())
+
+    def probe(self):
+        """Health probe: (ok, detail), not ok while any device is stalled"""
+        states = self.snapshot()
+        if not states:
+            return True, "no camera seen yet"
+        stalled = [s.camera or s.device_id for s in states if s.stalled]
+        return not stalled, {"devices": len(states), "stalled": stalled}
+
+    # =========================
+    # PERSISTENCE
+    # =========================
+    def save(self, path=None):
+        path = path or self.state_file
+        with self._lock:
+            data = {s.device_id: {"camera": s.camera, "last_seen": s.last_seen, "count": s.count,
+                                  "ewma": s.ewma, "stalls": s.stalls} for s in self.devices.values()}
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        os.replace(tmp, path)
+
+    def load(self, path):
+        try:
+            with open(path, encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        with self._lock:
+            for device_id, d in data.items():
+                state = CameraState(device_id, d.get("camera"))
+                state.first_seen = state.last_seen = d.get("last_seen")
+                state.count = d.get("count", 0)
+                state.ewma = (d.get("ewma") or [None] * 24)[:24]
+                state.stalls = d.get("stalls", 0)
+                if state.last_seen is not None:
+                    self.devices[device_id] = state
+
+    # =========================
+    # CHECKER THREAD
+    # =========================
+    def start(self, interval=CAMERA_CHECK_INTERVAL):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, args=(interval,), name="camera-monitor", daemon=True)
+            self._thread.start()
+        return self
+
+    def _run(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self.check()
+                if self.state_file:
+                    self.save()
+            except Exception as e:
+                print(f"[ERROR] Camera monitor: {e}")
+
+    def init_app(self, app):
+        """Add /cameras/status to a Flask app"""
+        from flask import jsonify
+
+        Gauge("anpr_camera_seconds_since_seen", "Seconds since the last detection per device",
+              ("device", "camera"),
+              func=lambda: {(s.device_id, s.camera or ""): round(time.time() - s.last_seen, 1)
+                            for s in self.snapshot()})
+
+        @app.route("/cameras/status")
+        def cameras_status():
+            self.check()
+            return jsonify(self.status())
+
+        return app
+
+
+def history_from_db(db, days=28):
+    """{device_id: [unix seconds]} from the last days of vehicle_detections rows"""
+    history = {}
+    since = datetime.now() - timedelta(days=days)
+    for (data,) in db.iter_vehicle_detections(since=since, columns=("detection_data",), batch_size=500):
+        if isinstance(data, str):
+            try:
+                data = json.loads(data)
+            except ValueError:
+                continue
+        snap = (data or {}).get("Picture", {}).get("SnapInfo", {})
+        device_id = snap.get("DeviceID")
+        snap_time = snap.get("SnapTime")
+        if not device_id or not snap_time:
+            continue
+        try:
+            ts = datetime.strptime(snap_time, "%Y-%m-%d %H:%M:%S").timestamp()
+        except ValueError:
+            continue
+        history.setdefault(device_id, []).append(ts)
+    return history
+
+
+if __name__ == "__main__":
+    # Seed the state file from the DB so a fresh install starts with learned rates
+    if os.getenv('DB_TYPE', 'postgres').lower() == 'sqlite':
+        from simple_db import db
+    else:
+        from postgres_db import db
+    monitor = CameraMonitor()
+    for device_id, times in history_from_db(db).items():
+        monitor.learn(device_id, times)
+        print(f"[OK] {device_id}: {len(times)} detections")
+    monitor.save()
+    print(f"[OK] Saved {CAMERA_STATE_FILE}")
@@ -0,0 +1,140 @@
+"""
+Compact Detection Record
+The fields the pipeline actually uses, pulled out of a TollgateInfo payload
+once: plate, camera, device, snap metadata and references to the saved
+images, never the base64 content. Logger, archive, counters, recent events,
+forwarding, journeys and the watchlist all take a Detection instead of
+re-walking (and keeping alive) the full payload.
+
+checks holds the image validation reports (image_validation.py), filled
+in asynchronously, usually after the detection has been archived and
+forwarded, so neither to_dict() nor the binary encoding carries it; the
+servers store them in the event folder as image_checks.json.
+
+to_bytes()/from_bytes() is a length-prefixed binary encoding for spools and
+IPC: half the size of the JSON form and quicker to encode and decode.
+"""
+import math
+import os
+import struct
+import time
+
+# version | received_at | confidence (NaN = none) | image count, then one
+# uint16 byte length per text field and image name (0xFFFF = None), then the UTF-8 text
+_HEADER = struct.Struct('<BddB')
+_NONE = 0xFFFF
+VERSION = 1
+
+_TEXT_FIELDS = ("event_id", "camera", "plate", "device_id", "snap_time", "plate_color",
+                "vehicle_type", "direction", "lane", "image_dir")
+_LENGTHS = {}
+
+
+def _lengths(count):
+    fmt = _LENGTHS.get(count)
+    if fmt is None:
+        fmt = _LENGTHS[count] = struct.Struct(f'<{count}H')
+    return fmt
+
+
+def _text(value):
+    return None if value is None else str(value)
+
+
+class Detection:
+    __slots__ = _TEXT_FIELDS + ("confidence", "received_at", "images", "checks")
+
+    def __init__(self, event_id, camera, plate, device_id=None, snap_time=None, plate_color=None,
+                 vehicle_type=None, direction=None, lane=None, image_dir=None, confidence=None,
+                 received_at=None, images=None):
+        self.event_id = event_id
+        self.camera = camera
+        self.plate = plate
+        self.device_id = device_id
+        self.snap_time = snap_time
+        self.plate_color = plate_color
+        self.vehicle_type = vehicle_type
+        self.direction = direction
+        self.lane = lane
+        self.image_dir = image_dir
+        self.confidence = confidence
+        self.received_at = received_at if received_at is not None else time.time()
+        self.images = images if images is not None else []
+        self.checks = None
+
+    @classmethod
+    def from_payload(cls, data, camera, event_id, received_at=None):
+        """Extract the record from a TollgateInfo payload ({"Picture": {...}})"""
+        pic = (data or {}).get("Picture") or {}
+        plate_info = pic.get("Plate") or {}
+        snap = pic.get("SnapInfo") or {}
+        vehicle = pic.get("Vehicle") or {}
+        confidence = plate_info.get("Confidence")
+        try:
+            confidence = float(confidence) if confidence is not None else None
+        except (TypeError, ValueError):
+            confidence = None
+        return cls(event_id, camera, _text(plate_info.get("PlateNumber")) or "UNKNOWN",
+                   device_id=_text(snap.get("DeviceID")),
+                   snap_time=_text(snap.get("SnapTime") or snap.get("Timestamp")),
+                   plate_color=_text(plate_info.get("Color")),
+                   vehicle_type=_text(vehicle.get("VehicleType")),
+                   direction=_text(snap.get("Direction")),
+                   lane=_text(snap.get("LanNo")),
+                   confidence=confidence, received_at=received_at)
+
+    def to_dict(self):
+        """JSON-ready form, as archived, forwarded and listed in recent events"""
+        return {
+            "event_id": self.event_id,
+            "plate": self.plate,
+            "camera": self.camera,
+            "device_id": self.device_id,
+            "snap_time": self.snap_time,
+            "plate_color": self.plate_color,
+            "confidence": self.confidence,
+            "vehicle_type": self.vehicle_type,
+            "direction": self.direction,
+            "lane": self.lane,
+            "image_url": os.path.basename(self.image_dir) if self.image_dir else None,
+            "images": list(self.images),
+            "ts": self.received_at,
+        }
+
+    # =========================
+    # BINARY ENCODING
+    # =========================
+    def to_bytes(self):
+        confidence = self.confidence if self.confidence is not None else math.nan
+        values = [getattr(self, f) for f in _TEXT_FIELDS] + self.images
+        raw = [v.encode("utf-8") if v is not None else b"" for v in values]
+        lengths = [len(r) if v is not None else _NONE for v, r in zip(values, raw)]
+        return b"".join([_HEADER.pack(VERSION, self.received_at, confidence, len(self.images)),
+                         _lengths(len(values)).pack(*lengths)] + raw)
+
+    @classmethod
+    def from_bytes(cls, data):
+        version, received_at, confidence, n_images = _HEADER.unpack_from(data, 0)
+        if version != VERSION:
+            raise ValueError(f"unsupported detection record version {version}")
+        fmt = _lengths(len(_TEXT_FIELDS) + n_images)
+        lengths = fmt.unpack_from(data, _HEADER.size)
+        offset = _HEADER.size + fmt.size
+        values = []
+        for length in lengths:
+            if length == _NONE:
+                values.append(None)
+            else:
+                values.append(str(data[offset:offset + length], "utf-8"))
+                offset += length
+        det = cls.__new__(cls)
+        for name, value in zip(_TEXT_FIELDS, values):
+            setattr(det, name, value)
+        det.confidence = None if math.isnan(confidence) else confidence
+        det.received_at = received_at
+        det.images = values[len(_TEXT_FIELDS):]
+        det.checks = None
+        return det
+
+    def __repr__(self):
+        return f"Detection({self.camera} {self.plate} {self.event_id})"
@@ -0,0 +1,188 @@
+"""
+Streaming Export of Vehicle Detections
+NDJSON, CSV and (with pyarrow installed) Parquet, generated batch by batch
+from the adapters' iter_vehicle_detections, so memory stays flat however
+large the export is.
+  GET /export/vehicle-detections.ndjson?since=2026-02-01&until=2026-03-01&columns=license_plate,created_at
+  optional filters: camera=1|2, plate=MH12AB1234
+A DB error part way through ends an NDJSON export with an {"error": ...}
+line and a CSV one with a "# export failed" line, and the connection is
+then dropped, so a cut-short file never looks complete.
+"""
+import csv
+import io
+import json
+import os
+from datetime import datetime
+
+from records import DETECTION_COLUMNS, camera_number
+
+EXPORT_BATCH_SIZE = int(os.getenv('EXPORT_BATCH_SIZE', '1000'))
+
+MIMETYPES = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+
+def _plain(value):
+    """JSON-safe value: datetimes as ISO strings"""
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+def _batches(rows, size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def ndjson_stream(rows, columns, batch_size=EXPORT_BATCH_SIZE):
+    json_col = columns.index('detection_data') if 'detection_data' in columns else None
+    for batch in _batches(rows, batch_size):
+        out = []
+        for row in batch:
+            values = [_plain(v) for v in row]
+            if json_col is not None and isinstance(values[json_col], str):
+                try:
+                    values[json_col] = json.loads(values[json_col])
+                except ValueError:
+                    pass
+            out.append(json.dumps(dict(zip(columns, values)), default=str))
+        yield ("\n".join(out) + "\n").encode("utf-8")
+
+
+def csv_stream(rows, columns, batch_size=EXPORT_BATCH_SIZE):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(columns)
+    for batch in _batches(rows, batch_size):
+        for row in batch:
+            writer.writerow([json.dumps(v, default=str) if isinstance(v, (dict, list)) else _plain(v)
+                             for v in row])
+        yield buf.getvalue().encode("utf-8")
+        buf.seek(0)
+        buf.truncate()
+    if buf.tell():
+        yield buf.getvalue().encode("utf-8")
+
+
+class _ChunkSink:
+    """Write-only file object that hands written bytes back to the generator"""
+
+    def __init__(self):
+        self.chunks = []
+        self.closed = False
+        self.pos = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.pos += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.pos
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def parquet_stream(rows, columns, batch_size=EXPORT_BATCH_SIZE):
+    """One Parquet row group per batch; every value written as a string"""
+    if pa is None:
+        raise RuntimeError("Parquet export needs pyarrow")
+    schema = pa.schema([(c, pa.string()) for c in columns])
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(sink, schema)
+    for batch in _batches(rows, batch_size):
+        cols = list(zip(*batch))
+        arrays = [pa.array([None if v is None else (json.dumps(v, default=str) if isinstance(v, (dict, list))
+                                                     else str(_plain(v))) for v in col], pa.string())
+                  for col in cols]
+        writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+        data = sink.drain()
+        if data:
+            yield data
+    writer.close()
+    yield sink.drain()
+
+
+STREAMERS = {"ndjson": ndjson_stream, "csv": csv_stream, "parquet": parquet_stream}
+
+# Parquet has no trailer: a stream cut before the footer is unreadable anyway
+ERROR_TRAILERS = {
+    "ndjson": lambda e: (json.dumps({"error": f"export failed: {e}"}) + "\n").encode("utf-8"),
+    "csv": lambda e: f"# export failed: {e}\n".encode("utf-8"),
+}
+
+
+def guarded_stream(chunks, fmt):
+    """Pass chunks through; on an error mid-stream, send the format's error trailer and re-raise"""
+    try:
+        yield from chunks
+    except Exception as e:
+        print(f"[ERROR] Export failed mid-stream: {e}")
+        trailer = ERROR_TRAILERS.get(fmt)
+        if trailer is not None:
+            yield trailer(e)
+        raise
+
+
+def parse_time(value):
+    """YYYY-MM-DD or ISO datetime query arg, or None"""
+    if not value:
+        return None
+    return datetime.fromisoformat(value)
+
+
+def init_app(app, db):
+    """Add /export/vehicle-detections.<fmt> to a Flask app"""
+    from flask import Response, jsonify, request, stream_with_context
+
+    @app.route("/export/vehicle-detections.<fmt>", methods=["GET"])
+    def export_vehicle_detections(fmt):
+        if fmt not in STREAMERS:
+            return jsonify(error=f"unknown format {fmt}", formats=sorted(STREAMERS)), 400
+        if fmt == "parquet" and pa is None:
+            return jsonify(error="parquet export needs pyarrow installed"), 501
+        try:
+            since = parse_time(request.args.get("since"))
+            until = parse_time(request.args.get("until"))
+            camera = camera_number(request.args.get("camera"))
+        except ValueError as e:
+            return jsonify(error=str(e)), 400
+        requested = request.args.get("columns")
+        columns = [c for c in requested.split(",") if c in DETECTION_COLUMNS] if requested else list(DETECTION_COLUMNS)
+        if not columns:
+            return jsonify(error="no valid columns", columns=DETECTION_COLUMNS), 400
+        batch_size = max(1, min(request.args.get("batch_size", default=EXPORT_BATCH_SIZE, type=int), 10000))
+
+        rows = db.iter_vehicle_detections(since=since, until=until, camera=camera, batch_size=batch_size,
+                                          columns=columns, plate=request.args.get("plate") or None)
+        filename = f"vehicle_detections_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{fmt}"
+        return Response(stream_with_context(guarded_stream(STREAMERS[fmt](rows, columns, batch_size), fmt)),
+                        mimetype=MIMETYPES[fmt],
+                        headers={"Content-Disposition": f"attachment; filename={filename}"})
+
+    return app
@@ -0,0 +1,403 @@
+#!/usr/bin/env python3
+"""
+Outbound Event Forwarding
+Pushes the compact record of every detection (detection.Detection, no
+image data) to the HTTP endpoints in FORWARD_URLS instead of having consumers poll
+/vehicle-detections.
+
+  FORWARD_URLS="billing=http://billing:8080/anpr/events,agg=https://agg.example/ingest"
+
+Events are group-committed to one durable spool per destination, so a
+destination that is down only builds a local backlog; it never slows the
+camera ack or the other destinations. One sender per destination POSTs
+the backlog in order as JSON batches ({"events": [...]}) of up to
+FORWARD_BATCH_SIZE events, collected for at most FORWARD_BATCH_MS, over
+a keep-alive connection, retrying with exponential backoff.
+
+    python forwarder.py stub [--port 8099] [--fail-rate 0.2]   local test receiver
+"""
+import http.client
+import json
+import os
+import queue
+import random
+import sys
+import threading
+import time
+from urllib.parse import urlsplit
+
+from detection import Detection
+from metrics import Counter, Gauge, Histogram
+from spool import Spool
+
+FORWARD_URLS = os.getenv('FORWARD_URLS', '')
+FORWARD_BATCH_SIZE = int(os.getenv('FORWARD_BATCH_SIZE', '200'))
+FORWARD_BATCH_MS = int(os.getenv('FORWARD_BATCH_MS', '250'))
+FORWARD_TIMEOUT = float(os.getenv('FORWARD_TIMEOUT', '5'))
+FORWARD_POOL_SIZE = int(os.getenv('FORWARD_POOL_SIZE', '2'))
+FORWARD_MAX_BACKOFF = float(os.getenv('FORWARD_MAX_BACKOFF', '60'))
+FORWARD_SPOOL_DIR = os.getenv('FORWARD_SPOOL_DIR', './spool_forward')
+FORWARD_AUTH_HEADER = os.getenv('FORWARD_AUTH_HEADER', '')   # e.g. "Bearer abc123"
+# Statuses worth retrying; any other 4xx means the batch itself is refused
+RETRY_STATUSES = (408, 425, 429)
+
+FORWARDED = Counter("anpr_forward_events_total", "Events forwarded", ("destination", "outcome"))
+FORWARD_REQUESTS = Counter("anpr_forward_requests_total", "Forwarding POSTs", ("destination", "status"))
+FORWARD_LATENCY = Histogram("anpr_forward_delivery_seconds", "Detection to acknowledged delivery",
+                            ("destination",), buckets=(0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0,
+                                                       60.0, 300.0, 900.0, 3600.0))
+
+
+def parse_destinations(spec):
+    """[(name, url)] from "name=url,url2"; unnamed destinations are named by host"""
+    destinations = []
+    for item in spec.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        name, url = item.split("=", 1) if "=" in item.split("://", 1)[0] else (None, item)
+        url = url.strip()
+        destinations.append(((name or urlsplit(url).hostname or url).strip(), url))
+    return destinations
+
+
+def encode_event(event):
+    """Spool payload: the binary Detection record, or JSON for plain dicts"""
+    if isinstance(event, Detection):
+        return event.to_bytes()
+    return json.dumps(event, default=str).encode("utf-8")
+
+
+def encode_events(events):
+    """Spool payloads for events; one that cannot be encoded is logged and skipped, not the batch"""
+    payloads = []
+    for event in events:
+        try:
+            payloads.append(encode_event(event))
+        except Exception as e:
+            print(f"[ERROR] Forward: cannot encode {event!r}, skipped: {e}")
+    return payloads
+
+
+def decode_event(payload):
+    """Forwarded dict from a spool payload (older spools hold JSON)"""
+    if payload[:1] == b"{":
+        return json.loads(payload)
+    return Detection.from_bytes(payload).to_dict()
+
+
+# =========================
+# HTTP CONNECTION POOL
+# =========================
+class HTTPPool:
+    """Keep-alive http.client connections to one origin"""
+
+    def __init__(self, url, size=FORWARD_POOL_SIZE, timeout=FORWARD_TIMEOUT):
+        parts = urlsplit(url)
+        if parts.scheme not in ("http", "https"):
+            raise ValueError(f"unsupported URL {url!r}")
+        self.scheme = parts.scheme
+        self.host = parts.hostname
+        self.port = parts.port
+        self.netloc = parts.netloc
+        self.path = (parts.path or "/") + (f"?{parts.query}" if parts.query else "")
+        self.timeout = timeout
+        self._idle = queue.LifoQueue(maxsize=size)
+
+    def _connect(self):
+        cls = http.client.HTTPSConnection if self.scheme == "https" else http.client.HTTPConnection
+        return cls(self.host, self.port, timeout=self.timeout)
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait(), True
+        except queue.Empty:
+            return self._connect(), False
+
+    def _release(self, conn):
+        try:
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def post(self, body, headers=None):
+        """(status, response body) of a JSON POST to the pool's URL"""
+        headers = dict(headers or {}, **{"Content-Type": "application/json"})
+        status, _, data = self.request("POST", self.path, body, headers)
+        return status, data
+
+    def request(self, method, path, body=None, headers=None):
+        """(status, response headers, response body); raises OSError / HTTPException on transport errors"""
+        headers = dict(headers or {}, Connection="keep-alive")
+        while True:
+            conn, reused = self._acquire()
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                resp = conn.getresponse()
+                data = resp.read()
+            except (http.client.HTTPException, OSError):
+                conn.close()
+                if reused:
+                    continue   # the server closed an idle keep-alive connection; retry on a fresh one
+                raise
+            if resp.will_close:
+                conn.close()
+            else:
+                self._release(conn)
+            return resp.status, dict(resp.getheaders()), data
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+# =========================
+# DESTINATIONS
+# =========================
+class Destination:
+    """One endpoint: its own spool, connection pool and sender thread"""
+
+    def __init__(self, name, url, spool_dir=FORWARD_SPOOL_DIR, batch_size=FORWARD_BATCH_SIZE,
+                 max_backoff=FORWARD_MAX_BACKOFF, pool_size=FORWARD_POOL_SIZE, timeout=FORWARD_TIMEOUT):
+        self.name = name
+        self.url = url
+        self.batch_size = batch_size
+        self.max_backoff = max_backoff
+        self.pool = HTTPPool(url, pool_size, timeout)
+        self.spool = Spool(os.path.join(spool_dir, name))
+        self.rejected_file = self.spool.rejected_file
+        self.headers = {"Authorization": FORWARD_AUTH_HEADER} if FORWARD_AUTH_HEADER else {}
+        self.delivered = 0
+        self.failures = 0
+        self.last_error = None
+        self.last_delivered_at = None
+        self.head_ts = None   # detection time of the oldest undelivered event
+        self._wake = threading.Event()
+        self._thread = None
+
+    def wake(self):
+        self._wake.set()
+
+    def lag(self):
+        """Seconds the oldest undelivered event has been waiting (0 when caught up)"""
+        return max(0.0, time.time() - self.head_ts) if self.head_ts else 0.0
+
+    def send_once(self):
+        """POST one batch from the spool; returns the number of events consumed, raises on failure"""
+        payloads, position = self.spool.read_batch(self.batch_size)
+        if not payloads:
+            self.head_ts = None
+            return 0
+        events, kept, undecodable, error = [], [], [], None
+        for payload in payloads:
+            try:
+                events.append(decode_event(payload))
+                kept.append(payload)
+            except Exception as e:
+                undecodable.append(payload)
+                error = e
+        if undecodable:
+            # Would fail the same way on every retry; keep it for inspection instead
+            self.spool.reject(undecodable)
+            print(f"[ERROR] Forward {self.name}: {len(undecodable)} undecodable events set aside in "
+                  f"{self.rejected_file}: {error}")
+            FORWARDED.inc(len(undecodable), destination=self.name, outcome="rejected")
+        if not events:
+            self.spool.commit(position)
+            return len(payloads)
+        self.head_ts = events[0].get("ts")
+        body = json.dumps({"events": events}, default=str).encode("utf-8")
+        status, data = self.pool.post(body, self.headers)
+        FORWARD_REQUESTS.inc(destination=self.name, status=str(status))
+        if status >= 500 or status in RETRY_STATUSES:
+            raise IOError(f"HTTP {status}: {data[:200]!r}")
+        if status >= 400:
+            # Retrying a refused batch would block the queue forever; keep it for inspection
+            self.spool.reject(kept)
+            print(f"[ERROR] Forward {self.name}: HTTP {status}, {len(events)} events set aside in {self.rejected_file}")
+            FORWARDED.inc(len(events), destination=self.name, outcome="rejected")
+        else:
+            now = time.time()
+            for event in events:
+                if event.get("ts"):
+                    FORWARD_LATENCY.observe(now - event["ts"], destination=self.name)
+            FORWARDED.inc(len(events), destination=self.name, outcome="delivered")
+            self.delivered += len(events)
+            self.last_delivered_at = now
+        self.spool.commit(position)
+        return len(payloads)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name=f"forward-{self.name}", daemon=True)
+            self._thread.start()
+        return self
+
+    def _run(self):
+        backoff = 0.5
+        while True:
+            try:
+                if self.send_once():
+                    backoff = 0.5
+                    continue
+            except Exception as e:
+                self.failures += 1
+                self.last_error = str(e)
+                # Jitter keeps several servers from hammering a recovering endpoint in step
+                delay = backoff * random.uniform(0.5, 1.0)
+                print(f"[ERROR] Forward {self.name} failed, retrying in {delay:.1f}s: {e}")
+                time.sleep(delay)
+                backoff = min(backoff * 2, self.max_backoff)
+                continue
+            self._wake.wait(5.0)
+            self._wake.clear()
+
+    def status(self):
+        return {
+            "url": self.url,
+            "delivered": self.delivered,
+            "backlog_bytes": self.spool.backlog_bytes(),
+            "lag_seconds": round(self.lag(), 3),
+            "failures": self.failures,
+            "last_error": self.last_error,
+            "last_delivered_at": self.last_delivered_at,
+        }
+
+
+class Forwarder:
+    """Fans detections out to every destination; publish() never blocks on the network"""
+
+    def __init__(self, destinations=None, batch_size=FORWARD_BATCH_SIZE, batch_ms=FORWARD_BATCH_MS,
+                 spool_dir=FORWARD_SPOOL_DIR):
+        if destinations is None:
+            destinations = parse_destinations(FORWARD_URLS)
+        self.batch_size = batch_size
+        self.batch_ms = batch_ms
+        self.destinations = [Destination(name, url, spool_dir, batch_size) for name, url in destinations]
+        self._incoming = queue.Queue(maxsize=10000)
+        self._thread = None
+
+    @property
+    def enabled(self):
+        return bool(self.destinations)
+
+    def publish(self, event):
+        """Queue one Detection (or JSON-serializable dict) for every destination"""
+        if not self.destinations:
+            return
+        try:
+            self._incoming.put_nowait(event)
+        except queue.Full:
+            # Journal thread is behind on fsync: write through rather than drop
+            self._commit(encode_events([event]))
+
+    def _commit(self, payloads):
+        for dest in self.destinations:
+            try:
+                dest.spool.append_many(payloads)
+            except Exception as e:
+                print(f"[ERROR] Forward spool {dest.name}: {e}")
+                continue
+            dest.wake()
+
+    def _collect(self):
+        """Block for one event, then gather more until batch_size or batch_ms elapses"""
+        batch = [self._incoming.get()]
+        deadline = time.monotonic() + self.batch_ms / 1000.0
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._incoming.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _journal(self):
+        while True:
+            batch = self._collect()
+            try:
+                self._commit(encode_events(batch))
+            except Exception as e:
+                print(f"[ERROR] Forward journal: {e}")
+
+    def start(self):
+        if self.destinations and self._thread is None:
+            self._thread = threading.Thread(target=self._journal, name="forward-journal", daemon=True)
+            self._thread.start()
+            for dest in self.destinations:
+                dest.start()
+        return self
+
+    def status(self):
+        return {d.name: d.status() for d in self.destinations}
+
+    def init_app(self, app):
+        """Add /forward/status and per-destination lag / backlog gauges to a Flask app"""
+        from flask import jsonify
+
+        Gauge("anpr_forward_lag_seconds", "Age of the oldest undelivered event", ("destination",),
+              func=lambda: {(d.name,): d.lag() for d in self.destinations})
+        Gauge("anpr_forward_backlog_bytes", "Spooled bytes not yet delivered", ("destination",),
+              func=lambda: {(d.name,): d.spool.backlog_bytes() for d in self.destinations})
+
+        @app.route("/forward/status")
+        def forward_status():
+            return jsonify(self.status())
+
+        return app
+
+
+# =========================
+# LOCAL STUB RECEIVER
+# =========================
+def run_stub(port, fail_rate=0.0):
+    """Print each received batch; fail_rate of requests get a 503 to exercise retries"""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"   # keep-alive, like a real receiver
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            status = 503 if random.random() < fail_rate else 200
+            if status == 200:
+                events = json.loads(body).get("events", [])
+                print(f"[OK] {len(events)} events, first {events[0].get('plate') if events else None}")
+            else:
+                print("[SKIP] answered 503")
+            self.send_response(status)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("0.0.0.0", port), StubHandler)
+    print(f"Forwarding stub listening on {port}")
+    server.serve_forever()
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="Detection forwarding tools")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    stub = sub.add_parser("stub", help="run a local receiver for testing")
+    stub.add_argument('--port', type=int, default=8099)
+    stub.add_argument('--fail-rate', type=float, default=0.0)
+    sub.add_parser("status", help="show backlog per destination")
+    args = parser.parse_args(argv)
+
+    if args.cmd == "stub":
+        run_stub(args.port, args.fail_rate)
+    else:
+        print(json.dumps(Forwarder().status(), indent=2, default=str))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,125 @@
+"""
+Deep Health Checks with Cached Dependency Probes
+Probes (DB connectivity, disk space, queue backlog, camera stalls) run on
+a background thread; the HTTP endpoints only read the cached result.
+  /health/live   process is up
+  /health/ready  every critical probe passed on its last run
+"""
+import os
+import shutil
+import threading
+import time
+from datetime import datetime
+
+HEALTH_INTERVAL = float(os.getenv('HEALTH_INTERVAL', '5'))
+HEALTH_MIN_FREE_MB = int(os.getenv('HEALTH_MIN_FREE_MB', '1024'))
+HEALTH_MAX_BACKLOG_BYTES = int(os.getenv('HEALTH_MAX_BACKLOG_BYTES', str(512 * 1024 * 1024)))
+
+
+class HealthMonitor:
+    """Runs registered probes every interval and caches their results
+
+    A probe is a callable returning (ok, detail) and may raise; critical
+    probes decide readiness, the others are reported as warnings only.
+    """
+
+    def __init__(self, interval=HEALTH_INTERVAL):
+        self.interval = interval
+        self.probes = []
+        self.started_at = datetime.now()
+        self._snapshot = {"status": "starting", "ready": False, "checks": {}, "checked_at": None}
+        self._thread = None
+
+    def add_probe(self, name, func, critical=True):
+        self.probes.append((name, func, critical))
+        return self
+
+    def run_once(self):
+        checks = {}
+        ready = True
+        degraded = False
+        for name, func, critical in self.probes:
+            start = time.perf_counter()
+            try:
+                ok, detail = func()
+            except Exception as e:
+                ok, detail = False, str(e)
+            checks[name] = {
+                "ok": bool(ok),
+                "critical": critical,
+                "detail": detail,
+                "ms": round((time.perf_counter() - start) * 1000, 2),
+            }
+            if not ok:
+                if critical:
+                    ready = False
+                else:
+                    degraded = True
+        status = "healthy" if ready and not degraded else ("degraded" if ready else "unhealthy")
+        # Replace the whole dict so readers never see a half-updated snapshot
+        self._snapshot = {"status": status, "ready": ready, "checks": checks,
+                          "checked_at": datetime.now().isoformat()}
+        return self._snapshot
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="health-probes", daemon=True)
+            self._thread.start()
+        return self
+
+    def _run(self):
+        while True:
+            self.run_once()
+            time.sleep(self.interval)
+
+    def snapshot(self):
+        return self._snapshot
+
+    def is_ready(self):
+        return self._snapshot["ready"]
+
+    def init_app(self, app):
+        """Add /health/live and /health/ready to a Flask app"""
+        from flask import jsonify
+
+        @app.route("/health/live")
+        def health_live():
+            return jsonify(status="alive", started_at=self.started_at.isoformat())
+
+        @app.route("/health/ready")
+        def health_ready():
+            snap = self._snapshot
+            return jsonify(snap), (200 if snap["ready"] else 503)
+
+        return app
+
+
+# =========================
+# STANDARD PROBES
+# =========================
+def db_probe(db):
+    def probe():
+        start = time.perf_counter()
+        db.ping()
+        return True, f"ok in {(time.perf_counter() - start) * 1000:.1f} ms"
+    return probe
+
+
+def disk_probe(paths, min_free_mb=HEALTH_MIN_FREE_MB):
+    def probe():
+        detail = {}
+        ok = True
+        for path in paths:
+            usage = shutil.disk_usage(path if os.path.exists(path) else ".")
+            free_mb = usage.free // (1024 * 1024)
+            detail[path] = {"free_mb": free_mb, "used_pct": round(usage.used * 100 / usage.total, 1)}
+            ok = ok and free_mb >= min_free_mb
+        return ok, detail
+    return probe
+
+
+def backlog_probe(func, max_bytes=HEALTH_MAX_BACKLOG_BYTES):
+    def probe():
+        backlog = func()
+        return backlog <= max_bytes, {"backlog_bytes": backlog}
+    return probe
@@ -0,0 +1,140 @@
+"""
+Idempotent Ingest
+Cameras resend a TollgateInfo event when the ack times out, and every
+retry used to get a fresh uuid4, so a new image folder, JSON archive and
+DB rows. The event id is now derived from what the camera says about the
+event: uuid5 over (DeviceID, AccurateTime or SnapTime, PlateNumber,
+UploadNum). A retry gets the same id, so:
+  - a bounded LRU of recent ids acks it with the original response before
+    any disk or DB I/O;
+  - past the cache (restart, another worker) the unique event key in the
+    DB drops the duplicate rows, and the image folder, named after the id,
+    is simply rewritten.
+A retry arriving while the first delivery is still being processed gets a
+409 with Retry-After rather than an ack: if that first delivery fails, the
+camera must still resend.
+Payloads without a DeviceID or a time keep a random id; there is nothing
+to tell a retry from a new vehicle by.
+"""
+import os
+import threading
+import uuid
+from collections import OrderedDict
+
+from metrics import Counter
+
+IDEMPOTENCY_CACHE_SIZE = int(os.getenv('IDEMPOTENCY_CACHE_SIZE', '50000'))
+IDEMPOTENCY_RETRY_AFTER = int(os.getenv('IDEMPOTENCY_RETRY_AFTER', '2'))
+# Fixed, so the same camera event maps to the same id on every server and after restarts
+EVENT_NAMESPACE = uuid.UUID("0b7a8f3e-2c41-5d69-8e1f-4a6c9d2b7e53")
+
+DUPLICATES = Counter("anpr_duplicate_events_total", "Camera retries acknowledged without re-processing",
+                     ("camera",))
+
+# claim() result for an event whose first delivery has not finished yet
+PENDING = object()
+
+
+def event_identity(data):
+    """(DeviceID, AccurateTime or SnapTime, PlateNumber, UploadNum), or None without device / time"""
+    if not isinstance(data, dict):
+        return None
+    pic = data.get("Picture") or {}
+    snap = pic.get("SnapInfo") or {}
+    plate = pic.get("Plate") or {}
+    device = snap.get("DeviceID")
+    when = snap.get("AccurateTime") or snap.get("SnapTime")
+    if not device or not when:
+        return None
+    upload = plate.get("UploadNum")
+    return (str(device), str(when), str(plate.get("PlateNumber") or ""), "" if upload is None else str(upload))
+
+
+def event_id_for(data):
+    """Stable event id for a camera payload (random when it carries no identity)"""
+    identity = event_identity(data)
+    if identity is None:
+        return str(uuid.uuid4())
+    return str(uuid.uuid5(EVENT_NAMESPACE, "|".join(identity)))
+
+
+class IdempotencyCache:
+    """Bounded LRU of recently accepted event ids and the ack each one got
+
+    claim() marks an id as in progress; complete() stores the ack to repeat.
+    A claim that is never completed (the handler raised or returned an
+    error) is released at the end of the request by init_app's teardown,
+    so the camera's next retry is processed instead of acked.
+    """
+
+    def __init__(self, size=IDEMPOTENCY_CACHE_SIZE):
+        self.size = size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def claim(self, event_id):
+        """None if event_id is new and now claimed by the caller, else the stored ack or PENDING
+
+        Answer anything but None with duplicate_response().
+        """
+        with self._lock:
+            ack = self._entries.get(event_id)
+            if ack is not None:
+                self._entries.move_to_end(event_id)
+                return ack
+            self._entries[event_id] = PENDING
+            if len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+        self._track(event_id)
+        return None
+
+    def complete(self, event_id, ack):
+        with self._lock:
+            self._entries[event_id] = ack
+        self._untrack(event_id)
+
+    def release(self, event_id):
+        """Forget a claim whose processing failed"""
+        with self._lock:
+            if self._entries.get(event_id) is PENDING:
+                del self._entries[event_id]
+
+    def duplicate_response(self, ack):
+        """Flask response for a claim() that was not None"""
+        from flask import jsonify
+        if ack is PENDING:
+            # Not acked: the first delivery may still fail and be released
+            return (jsonify(status="in_progress"), 409,
+                    {"Retry-After": str(IDEMPOTENCY_RETRY_AFTER)})
+        return jsonify(ack), 200
+
+    def __len__(self):
+        return len(self._entries)
+
+    # Claims made during a Flask request, released by the teardown if left pending
+    def _track(self, event_id):
+        try:
+            from flask import g, has_request_context
+        except ImportError:
+            return
+        if has_request_context():
+            g.setdefault("idempotency_claims", set()).add(event_id)
+
+    def _untrack(self, event_id):
+        try:
+            from flask import g, has_request_context
+        except ImportError:
+            return
+        if has_request_context():
+            g.get("idempotency_claims", set()).discard(event_id)
+
+    def init_app(self, app):
+        """Release uncompleted claims at the end of each request"""
+        from flask import g
+
+        @app.teardown_request
+        def release_idempotency_claims(exc=None):
+            for event_id in g.pop("idempotency_claims", ()):
+                self.release(event_id)
+
+        return app
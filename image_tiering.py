@@ -0,0 +1,382 @@
+#!/usr/bin/env python3
+"""
+Hot/Cold Image Tiering
+Event folders (and loose image files, as anpr_server writes them) in
+downloads/ and images_cam1/ older than IMAGE_TIER_AGE_DAYS
+are packed into zip segments under IMAGE_COLD_DIR (one per day and run,
+never appended to once written) and removed from the hot disk. An append-only index maps each folder to its segment,
+so ImageResolver finds an image wherever it lives and image_url values in
+the DB stay valid.
+
+JPEGs are stored uncompressed in the zip (they do not deflate); set
+IMAGE_TIER_JPEG_QUALITY to re-encode them smaller when Pillow is installed.
+The mover is throttled to IMAGE_TIER_MAX_BYTES_PER_SEC so it never competes
+with ingest I/O.
+
+    python image_tiering.py run [--age-days 7] [--dry-run]
+    python image_tiering.py resolve downloads/MH12AB1234_CAM1_1a2b3c
+"""
+import io
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+import zipfile
+from datetime import datetime
+
+from metrics import Counter
+
+IMAGE_HOT_DIRS = [d for d in os.getenv('IMAGE_HOT_DIRS', './downloads,./images_cam1').split(',') if d]
+IMAGE_COLD_DIR = os.getenv('IMAGE_COLD_DIR', './cold_images')
+IMAGE_TIER_AGE_DAYS = float(os.getenv('IMAGE_TIER_AGE_DAYS', '7'))
+IMAGE_TIER_JPEG_QUALITY = int(os.getenv('IMAGE_TIER_JPEG_QUALITY', '0'))
+IMAGE_TIER_MAX_BYTES_PER_SEC = int(os.getenv('IMAGE_TIER_MAX_BYTES_PER_SEC', str(4 * 1024 * 1024)))
+IMAGE_TIER_INTERVAL = float(os.getenv('IMAGE_TIER_INTERVAL', '3600'))
+IMAGE_TIERING = os.getenv('IMAGE_TIERING', '0') == '1'   # run the mover inside the server process
+INDEX_FILE = "index.jsonl"
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.webp')
+
+TIERED_FOLDERS = Counter("anpr_image_tier_folders_total", "Event folders moved to cold storage")
+TIERED_BYTES = Counter("anpr_image_tier_bytes_total", "Image bytes read from the hot dirs into cold storage")
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+def folder_key(path):
+    """Index key of an event folder or loose image: its name (names embed a unique id)"""
+    return os.path.basename(os.path.normpath(path))
+
+
+class RateLimiter:
+    """Token bucket over bytes; take() sleeps when the budget is spent"""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+
+    def take(self, amount):
+        if self.rate <= 0:
+            return
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= amount
+        if self.tokens < 0:
+            time.sleep(-self.tokens / self.rate)
+
+
+class ColdIndex:
+    """folder key -> segment file name, persisted as append-only JSON lines"""
+
+    def __init__(self, cold_dir=IMAGE_COLD_DIR):
+        self.cold_dir = cold_dir
+        self.path = os.path.join(cold_dir, INDEX_FILE)
+        self.entries = {}
+        self._lock = threading.Lock()
+        self._mtime = None
+        self.reload()
+
+    def reload(self):
+        """Re-read the index if another process (the CLI job) appended to it"""
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            return
+        if mtime == self._mtime:
+            return
+        entries = {}
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    continue   # torn last line after a crash
+                entries[rec["folder"]] = rec["segment"]
+        with self._lock:
+            self.entries = entries
+            self._mtime = mtime
+
+    def add(self, records):
+        os.makedirs(self.cold_dir, exist_ok=True)
+        with open(self.path, "a", encoding="utf-8") as f:
+            for folder, segment in records:
+                f.write(json.dumps({"folder": folder, "segment": segment}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        with self._lock:
+            for folder, segment in records:
+                self.entries[folder] = segment
+
+    def get(self, folder):
+        return self.entries.get(folder)
+
+
+class ImageTiering:
+    """Moves old event folders from the hot dirs into per-day zip segments"""
+
+    def __init__(self, hot_dirs=IMAGE_HOT_DIRS, cold_dir=IMAGE_COLD_DIR, age_days=IMAGE_TIER_AGE_DAYS,
+                 jpeg_quality=IMAGE_TIER_JPEG_QUALITY, max_bytes_per_sec=IMAGE_TIER_MAX_BYTES_PER_SEC):
+        self.hot_dirs = hot_dirs
+        self.cold_dir = cold_dir
+        self.age_days = age_days
+        self.jpeg_quality = jpeg_quality if Image is not None else 0
+        self.limiter = RateLimiter(max_bytes_per_sec)
+        self.index = ColdIndex(cold_dir)
+        self._thread = None
+
+    def candidates(self, now=None):
+        """{day: [paths]} of event folders / loose images whose newest file is past the age threshold"""
+        cutoff = (now or time.time()) - self.age_days * 86400
+        by_day = {}
+        for hot in self.hot_dirs:
+            try:
+                entries = list(os.scandir(hot))
+            except OSError:
+                continue
+            for entry in entries:
+                try:
+                    if entry.is_dir():
+                        newest = max((f.stat().st_mtime for f in os.scandir(entry.path) if f.is_file()),
+                                     default=entry.stat().st_mtime)
+                    elif entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                        newest = entry.stat().st_mtime
+                    else:
+                        continue
+                except OSError:
+                    continue
+                if newest < cutoff:
+                    day = datetime.fromtimestamp(newest).strftime("%Y%m%d")
+                    by_day.setdefault(day, []).append(entry.path)
+        return by_day
+
+    def _recompress(self, data):
+        if not self.jpeg_quality or not data.startswith(b'\xff\xd8'):
+            return data
+        try:
+            out = io.BytesIO()
+            Image.open(io.BytesIO(data)).save(out, "JPEG", quality=self.jpeg_quality, optimize=True)
+            smaller = out.getvalue()
+            return smaller if len(smaller) < len(data) else data
+        except Exception:
+            return data   # leave images Pillow cannot read untouched
+
+    def tier_day(self, day, folders, dry_run=False):
+        """Pack folders into a new segment for the day, index them, then delete the hot copies
+
+        Each run writes its own segment through a temp file renamed into
+        place, so a crash mid-write never touches images packed earlier.
+        """
+        if dry_run:
+            return len(folders)
+        os.makedirs(self.cold_dir, exist_ok=True)
+        segment = f"{day}_{datetime.now().strftime('%H%M%S')}_{os.getpid()}.zip"
+        seg_path = os.path.join(self.cold_dir, segment)
+        tmp_path = seg_path + ".tmp"
+        done = []
+        try:
+            with zipfile.ZipFile(tmp_path, "w", compression=zipfile.ZIP_STORED) as zf:
+                for folder in folders:
+                    key = folder_key(folder)
+                    if os.path.isdir(folder):
+                        files = [(f"{key}/{e.name}", e.path)
+                                 for e in sorted(os.scandir(folder), key=lambda e: e.name) if e.is_file()]
+                    else:
+                        files = [(key, folder)]
+                    for member, path in files:
+                        with open(path, "rb") as f:
+                            data = f.read()
+                        self.limiter.take(len(data))
+                        zf.writestr(member, self._recompress(data))
+                        TIERED_BYTES.inc(len(data))
+                    done.append((key, segment))
+            with open(tmp_path, "rb+") as f:
+                os.fsync(f.fileno())
+            os.replace(tmp_path, seg_path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+        dir_fd = os.open(self.cold_dir, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+        # Segment durable, then index, then delete: a crash in between leaves a duplicate, never a loss
+        self.index.add(done)
+        for folder in folders:
+            if os.path.isdir(folder):
+                shutil.rmtree(folder, ignore_errors=True)
+            else:
+                os.remove(folder)
+        TIERED_FOLDERS.inc(len(done))
+        return len(done)
+
+    def _remove_stale_temp(self, max_age=86400):
+        """Drop temp segments left by a run that was killed mid-write"""
+        try:
+            entries = list(os.scandir(self.cold_dir))
+        except OSError:
+            return
+        for entry in entries:
+            try:
+                if entry.name.endswith(".zip.tmp") and time.time() - entry.stat().st_mtime > max_age:
+                    os.remove(entry.path)
+            except OSError:
+                pass
+
+    def run_once(self, dry_run=False):
+        moved = 0
+        if not dry_run:
+            self._remove_stale_temp()
+        for day, folders in sorted(self.candidates().items()):
+            moved += self.tier_day(day, folders, dry_run)
+        if moved:
+            print(f"[OK] Tiered {moved} event folders to {self.cold_dir}" + (" (dry run)" if dry_run else ""))
+        return moved
+
+    def start(self, interval=IMAGE_TIER_INTERVAL):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, args=(interval,), name="image-tiering", daemon=True)
+            self._thread.start()
+        return self
+
+    def _run(self, interval):
+        while True:
+            try:
+                self.run_once()
+            except Exception as e:
+                print(f"[ERROR] Image tiering: {e}")
+            time.sleep(interval)
+
+
+class ImageResolver:
+    """Finds an event folder or loose image in the hot dirs or in a cold segment
+
+    Only the last path component of image_url is used, so absolute paths
+    stored in the DB and bare folder names both work. backends are
+    storage_backends stores (segment packs, S3) searched last.
+    """
+
+    def __init__(self, hot_dirs=IMAGE_HOT_DIRS, cold_dir=IMAGE_COLD_DIR, index=None, backends=()):
+        self.hot_dirs = hot_dirs
+        self.cold_dir = cold_dir
+        self.index = index or ColdIndex(cold_dir)
+        self.backends = [b for b in backends if b.kind != "local"]   # local stores are the hot dirs
+
+    def resolve(self, image_url):
+        """('hot', path), ('cold', segment path) or ('store', backend), or None if unknown"""
+        key = folder_key(image_url or "")
+        if key in ("", ".", ".."):
+            return None
+        for hot in self.hot_dirs:
+            path = os.path.join(hot, key)
+            if os.path.exists(path):
+                return "hot", path
+        self.index.reload()
+        segment = self.index.get(key)
+        if segment:
+            return "cold", os.path.join(self.cold_dir, segment)
+        for backend in self.backends:
+            if backend.exists(key) or backend.list(key + "/"):
+                return "store", backend
+        return None
+
+    def list(self, image_url):
+        """File names of an event folder ([name] for a loose image)"""
+        where = self.resolve(image_url)
+        if where is None:
+            return []
+        key = folder_key(image_url)
+        if where[0] == "hot":
+            if os.path.isfile(where[1]):
+                return [key]
+            return sorted(e.name for e in os.scandir(where[1]) if e.is_file())
+        if where[0] == "store":
+            names = where[1].list(key + "/")
+            return [n[len(key) + 1:] for n in names] if names else [key]
+        try:
+            with zipfile.ZipFile(where[1]) as zf:
+                names = zf.namelist()
+        except (OSError, zipfile.BadZipFile):
+            return []
+        if key in names:
+            return [key]
+        prefix = key + "/"
+        return sorted(n[len(prefix):] for n in names if n.startswith(prefix))
+
+    def read(self, image_url, name=None):
+        """Bytes of file name in an event folder (or of a loose image when name is None)"""
+        if name is not None and (os.path.basename(name) != name or name in ("", ".", "..")):
+            return None
+        where = self.resolve(image_url)
+        if where is None:
+            return None
+        key = folder_key(image_url)
+        try:
+            if where[0] == "hot":
+                path = where[1] if name is None or os.path.isfile(where[1]) else os.path.join(where[1], name)
+                with open(path, "rb") as f:
+                    return f.read()
+            if where[0] == "store":
+                return where[1].get(key if name is None else f"{key}/{name}")
+            with zipfile.ZipFile(where[1]) as zf:
+                return zf.read(key if name is None else f"{key}/{name}")
+        except (OSError, KeyError, zipfile.BadZipFile):
+            return None
+
+    def init_app(self, app):
+        """Add /images/<folder> (listing) and /images/<folder>/<name> to a Flask app"""
+        from flask import Response, abort, jsonify
+
+        @app.route("/images/<folder>")
+        def image_list(folder):
+            where = self.resolve(folder)
+            if where is None:
+                abort(404)
+            if folder.lower().endswith(IMAGE_EXTENSIONS):
+                data = self.read(folder)
+                if data is None:
+                    abort(404)
+                return Response(data, mimetype="image/png" if data.startswith(b'\x89PNG') else "image/jpeg")
+            return jsonify(folder=folder, tier=where[0], files=self.list(folder))
+
+        @app.route("/images/<folder>/<name>")
+        def image_file(folder, name):
+            data = self.read(folder, name)
+            if data is None:
+                abort(404)
+            mimetype = "image/png" if data.startswith(b'\x89PNG') else "image/jpeg"
+            return Response(data, mimetype=mimetype)
+
+        return app
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="Move old event images to cold storage")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    run = sub.add_parser("run", help="tier folders past the age threshold once")
+    run.add_argument('--age-days', type=float, default=IMAGE_TIER_AGE_DAYS)
+    run.add_argument('--dry-run', action='store_true')
+    res = sub.add_parser("resolve", help="show where an image_url lives")
+    res.add_argument('image_url')
+    args = parser.parse_args(argv)
+
+    if args.cmd == "run":
+        ImageTiering(age_days=args.age_days).run_once(args.dry_run)
+    else:
+        resolver = ImageResolver()
+        print(resolver.resolve(args.image_url), resolver.list(args.image_url))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
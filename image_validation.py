@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+"""
+Image Validation on a Process Pool
+Cameras occasionally send truncated or corrupt JPEGs, which
+get_image_format() happily calls ".jpg" and the handlers store as-is.
+Every saved image is now checked off the request thread, in worker
+processes (the checks are CPU-bound, so threads would share one core):
+  - JPEG: SOI, marker segments intact up to the scan, SOF present, EOI at the end
+  - PNG:  signature, chunk lengths and CRCs, IHDR, IEND
+  - GIF / WebP: header, trailer / RIFF length
+  - width and height, sha256 and size
+  - a full decode as well when IMAGE_VALIDATION_DECODE=1 and Pillow is installed
+The result lands in Detection.checks[name] when the worker finishes; the
+camera ack never waits for it, so by then the detection is already in the
+DB and the archive. The reports are kept with the images instead: the
+servers' on_report writes every report of an event so far to
+<event folder>/image_checks.json (save_reports), keyed by event_id.
+Images already on local disk are passed by path, so the worker reads them
+itself instead of the bytes being pickled across.
+
+    python image_validation.py downloads/MH12AB1234_CAM1_1a2b3c/*.jpg
+"""
+import hashlib
+import io
+import json
+import os
+import struct
+import sys
+import threading
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+from metrics import Counter, Gauge
+
+IMAGE_VALIDATION = os.getenv('IMAGE_VALIDATION', '1') == '1'
+IMAGE_VALIDATION_WORKERS = int(os.getenv('IMAGE_VALIDATION_WORKERS', '0'))   # 0 = one per core
+# Checks queued beyond this are skipped (and counted) rather than held in memory
+IMAGE_VALIDATION_MAX_PENDING = int(os.getenv('IMAGE_VALIDATION_MAX_PENDING', '500'))
+IMAGE_VALIDATION_DECODE = os.getenv('IMAGE_VALIDATION_DECODE', '0') == '1'
+REPORT_KEY = "image_checks.json"
+
+VALIDATED = Counter("anpr_images_validated_total", "Saved images checked by the validation pool",
+                    ("format", "outcome"))
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# SOF0-SOF15 carry the frame size; C4 (DHT), C8 (JPG) and CC (DAC) share the range
+_JPEG_SOF = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+_JPEG_STANDALONE = frozenset(range(0xD0, 0xD8)) | {0x01, 0xD8}
+
+
+# =========================
+# CHECKS (run in the workers)
+# =========================
+def _check_jpeg(data):
+    """(width, height, error) from the marker segments of a JPEG"""
+    n = len(data)
+    if data[:2] != b'\xff\xd8':
+        return None, None, "missing SOI"
+    width = height = None
+    i = 2
+    while True:
+        if i >= n:
+            return width, height, "truncated before the scan"
+        if data[i] != 0xFF:
+            return width, height, f"bad marker at {i}"
+        while i < n and data[i] == 0xFF:
+            i += 1
+        if i >= n:
+            return width, height, "truncated before the scan"
+        marker = data[i]
+        i += 1
+        if marker in _JPEG_STANDALONE:
+            continue
+        if marker == 0xD9:
+            return width, height, "EOI before any scan"
+        if i + 2 > n:
+            return width, height, "truncated segment header"
+        length = (data[i] << 8) | data[i + 1]
+        if length < 2 or i + length > n:
+            return width, height, f"segment {marker:02X} runs past the end"
+        if marker in _JPEG_SOF and length >= 7:
+            height, width = struct.unpack_from('>HH', data, i + 3)
+        i += length
+        if marker == 0xDA:
+            break
+    if width is None:
+        return None, None, "no frame header"
+    # Some cameras pad after EOI; a cut-off upload has no EOI at all
+    if not data[-64:].rstrip(b'\x00').endswith(b'\xff\xd9'):
+        return width, height, "missing EOI (truncated)"
+    return width, height, None
+
+
+def _check_png(data):
+    if len(data) < 33 or data[16 - 4:16] != b'IHDR':
+        return None, None, "missing IHDR"
+    width, height = struct.unpack_from('>II', data, 16)
+    i = len(PNG_SIGNATURE)
+    while i + 12 <= len(data):
+        length, kind = struct.unpack_from('>I4s', data, i)
+        end = i + 12 + length
+        if end > len(data):
+            return width, height, f"chunk {kind!r} runs past the end"
+        crc, = struct.unpack_from('>I', data, end - 4)
+        if zlib.crc32(data[i + 4:end - 4]) != crc:
+            return width, height, f"bad CRC in chunk {kind!r}"
+        if kind == b'IEND':
+            return width, height, None
+        i = end
+    return width, height, "missing IEND (truncated)"
+
+
+def _check_gif(data):
+    if len(data) < 10:
+        return None, None, "truncated header"
+    width, height = struct.unpack_from('<HH', data, 6)
+    if not data.rstrip(b'\x00').endswith(b'\x3b'):
+        return width, height, "missing trailer (truncated)"
+    return width, height, None
+
+
+def _check_webp(data):
+    size, = struct.unpack_from('<I', data, 4)
+    if size + 8 > len(data):
+        return None, None, "RIFF length runs past the end"
+    return None, None, None
+
+
+def inspect_image(data=None, path=None, decode=IMAGE_VALIDATION_DECODE):
+    """Integrity report for image bytes (or a file): format, width, height, sha256, size, ok, error"""
+    if data is None:
+        with open(path, "rb") as f:
+            data = f.read()
+    if data.startswith(b'\xff\xd8'):
+        fmt, check = "jpeg", _check_jpeg
+    elif data.startswith(PNG_SIGNATURE):
+        fmt, check = "png", _check_png
+    elif data[:6] in (b'GIF87a', b'GIF89a'):
+        fmt, check = "gif", _check_gif
+    elif data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        fmt, check = "webp", _check_webp
+    else:
+        fmt, check = "unknown", lambda _: (None, None, "not a JPEG, PNG, GIF or WebP")
+    width, height, error = check(data)
+    if error is None and decode and Image is not None:
+        try:
+            with Image.open(io.BytesIO(data)) as img:
+                img.load()
+                width, height = img.size
+        except Exception as e:
+            error = f"decode failed: {e}"
+    return {
+        "ok": error is None,
+        "format": fmt,
+        "width": width,
+        "height": height,
+        "size": len(data),
+        "sha256": hashlib.sha256(data).hexdigest(),
+        "error": error,
+    }
+
+
+def save_reports(store, det):
+    """Write det's reports so far to store, in its event folder; returns the key"""
+    key = f"{os.path.basename(det.image_dir)}/{REPORT_KEY}"
+    record = {"event_id": det.event_id, "camera": det.camera, "plate": det.plate,
+              "images": dict(det.checks or {})}
+    store.put(key, json.dumps(record, indent=2).encode("utf-8"))
+    return key
+
+
+# =========================
+# POOL
+# =========================
+class ImageValidator:
+    """Runs inspect_image on a process pool and attaches each report to its Detection"""
+
+    def __init__(self, workers=IMAGE_VALIDATION_WORKERS, max_pending=IMAGE_VALIDATION_MAX_PENDING,
+                 on_report=None, on_corrupt=None, enabled=IMAGE_VALIDATION):
+        self.workers = workers or os.cpu_count() or 1
+        self.max_pending = max_pending
+        self.on_report = on_report
+        self.on_corrupt = on_corrupt
+        self.enabled = enabled
+        self._pool = None
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    def start(self):
+        if self.enabled and self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers)
+            # Fork the workers before requests arrive, but off the import path
+            threading.Thread(target=self._pool.submit, args=(int,), name="image-validation-start",
+                             daemon=True).start()
+            Gauge("anpr_image_validation_pending", "Images waiting for or in validation",
+                  func=lambda: self._pending)
+        return self
+
+    def submit(self, det, name, data=None, path=None):
+        """Queue a check of one saved image; pass path for a local file, data otherwise"""
+        if self._pool is None:
+            return False
+        with self._lock:
+            if self._pending >= self.max_pending:
+                VALIDATED.inc(format="unknown", outcome="skipped")
+                return False
+            self._pending += 1
+        try:
+            future = self._pool.submit(inspect_image, None if path else data, path)
+        except Exception as e:
+            # a worker died and broke the pool; checks stop, ingest does not
+            with self._lock:
+                self._pending -= 1
+            print(f"[ERROR] Image validation unavailable: {e}")
+            return False
+        future.add_done_callback(lambda f: self._attach(det, name, f))
+        return True
+
+    def _attach(self, det, name, future):
+        with self._lock:
+            self._pending -= 1
+        try:
+            report = future.result()
+        except Exception as e:
+            report = {"ok": False, "format": "unknown", "error": f"validation failed: {e}"}
+        if det.checks is None:
+            det.checks = {}
+        det.checks[name] = report
+        VALIDATED.inc(format=report["format"], outcome="ok" if report["ok"] else "corrupt")
+        if self.on_report is not None:
+            try:
+                self.on_report(det, name, report)
+            except Exception as e:
+                print(f"[ERROR] on_report: {e}")
+        if not report["ok"]:
+            print(f"[ERROR] Corrupt image {det.camera} {det.plate} {name}: {report['error']}")
+            if self.on_corrupt is not None:
+                try:
+                    self.on_corrupt(det, name, report)
+                except Exception as e:
+                    print(f"[ERROR] on_corrupt: {e}")
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+
+
+def main(argv=None):
+    paths = sys.argv[1:] if argv is None else argv
+    if not paths:
+        print(__doc__)
+        return 2
+    bad = 0
+    with ProcessPoolExecutor(max_workers=IMAGE_VALIDATION_WORKERS or None) as pool:
+        for path, report in zip(paths, pool.map(inspect_image, [None] * len(paths), paths, chunksize=16)):
+            tag = "[OK]" if report["ok"] else "[ERROR]"
+            bad += not report["ok"]
+            print(f"{tag} {path} {report['format']} {report['width']}x{report['height']} "
+                  f"{report['sha256'][:12]} {report['error'] or ''}".rstrip())
+    return 1 if bad else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
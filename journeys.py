@@ -0,0 +1,345 @@
+"""
+Vehicle Journeys from Entry/Exit Camera Pairs
+Pairs each exit sighting with the open entry session of the same plate
+(one OCR edit tolerated) and records the dwell time, all in memory: open
+sessions are indexed by folded plate and by one-deletion variants, so a
+sighting costs a few dict lookups and never touches vehicle_detections.
+
+Roles come from the camera (JOURNEY_ROLES="camera1=entry,camera2=exit"),
+or from SnapInfo.Direction when JOURNEY_DIRECTIONS maps its values
+(e.g. "0=entry,1=exit").
+
+Sessions with no exit after JOURNEY_TTL_HOURS, or pushed out when more
+than JOURNEY_MAX_OPEN are open, close as "no_exit"; an exit with no
+matching entry is stored as "no_entry". Closed journeys are written to the
+journeys table in batches by a background thread.
+"""
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+from metrics import Counter, Gauge, Histogram
+from reconcile import normalize_plate, plate_distance
+
+JOURNEY_ROLES = os.getenv('JOURNEY_ROLES', 'camera1=entry,camera2=exit')
+JOURNEY_DIRECTIONS = os.getenv('JOURNEY_DIRECTIONS', '')
+JOURNEY_TTL_HOURS = float(os.getenv('JOURNEY_TTL_HOURS', '24'))
+JOURNEY_MAX_OPEN = int(os.getenv('JOURNEY_MAX_OPEN', '200000'))
+# Repeat reads of the same plate by one camera within this window are one sighting
+JOURNEY_DEDUP_SECONDS = float(os.getenv('JOURNEY_DEDUP_SECONDS', '60'))
+JOURNEY_FUZZY = os.getenv('JOURNEY_FUZZY', '1') != '0'
+JOURNEY_FLUSH_INTERVAL = float(os.getenv('JOURNEY_FLUSH_INTERVAL', '1'))
+JOURNEY_STATE_FILE = os.getenv('JOURNEY_STATE_FILE', './journey_state.json')
+JOURNEY_SAVE_INTERVAL = float(os.getenv('JOURNEY_SAVE_INTERVAL', '60'))
+# Shorter plates have too many one-edit neighbours to match fuzzily
+FUZZY_MIN_LENGTH = 5
+
+JOURNEYS_CLOSED = Counter("anpr_journeys_total", "Journeys closed", ("status",))
+DWELL_SECONDS = Histogram("anpr_journey_dwell_seconds", "Entry to exit time of complete journeys",
+                          buckets=(60, 300, 900, 1800, 3600, 7200, 14400, 28800, 86400))
+
+
+def parse_roles(spec):
+    """{"camera1": "entry", ...} from "camera1=entry,camera2=exit" """
+    roles = {}
+    for item in spec.split(","):
+        if "=" in item:
+            key, role = item.split("=", 1)
+            role = role.strip().lower()
+            if role in ("entry", "exit"):
+                roles[key.strip()] = role
+    return roles
+
+
+def _deletes(norm):
+    return {norm[:i] + norm[i + 1:] for i in range(len(norm))}
+
+
+class Session:
+    """An entry sighting waiting for its exit"""
+    __slots__ = ("norm", "plate", "event_id", "device", "time")
+
+    def __init__(self, norm, plate, event_id, device, ts):
+        self.norm = norm
+        self.plate = plate
+        self.event_id = event_id
+        self.device = device
+        self.time = ts
+
+
+class JourneyTracker:
+    def __init__(self, db=None, ttl_hours=JOURNEY_TTL_HOURS, max_open=JOURNEY_MAX_OPEN,
+                 dedup_seconds=JOURNEY_DEDUP_SECONDS, fuzzy=JOURNEY_FUZZY, state_file=JOURNEY_STATE_FILE,
+                 roles=None, directions=None):
+        self.db = db
+        self.ttl = ttl_hours * 3600
+        self.max_open = max_open
+        self.dedup_seconds = dedup_seconds
+        self.fuzzy = fuzzy
+        self.state_file = state_file
+        self.roles = roles if roles is not None else parse_roles(JOURNEY_ROLES)
+        self.directions = directions if directions is not None else parse_roles(JOURNEY_DIRECTIONS)
+        self.open = OrderedDict()     # entry event_id -> Session, oldest first
+        self.by_norm = {}             # folded plate -> [Session]
+        self.by_variant = {}          # one-deletion variant -> {folded plate}
+        self.recent_exits = OrderedDict()   # folded plate -> exit time, for de-duplication
+        self.pending = []             # closed journeys waiting for the writer
+        self.write_errors = 0
+        self._lock = threading.Lock()
+        self._thread = None
+        if state_file:
+            self.load(state_file)
+
+    # =========================
+    # SESSION INDEX
+    # =========================
+    def _add(self, session):
+        self.open[session.event_id] = session
+        sessions = self.by_norm.get(session.norm)
+        if sessions is None:
+            self.by_norm[session.norm] = [session]
+            if self.fuzzy and len(session.norm) >= FUZZY_MIN_LENGTH:
+                for v in _deletes(session.norm):
+                    self.by_variant.setdefault(v, set()).add(session.norm)
+        else:
+            sessions.append(session)
+
+    def _remove(self, session):
+        self.open.pop(session.event_id, None)
+        sessions = self.by_norm.get(session.norm)
+        if sessions is None:
+            return
+        sessions.remove(session)
+        if not sessions:
+            del self.by_norm[session.norm]
+            if self.fuzzy and len(session.norm) >= FUZZY_MIN_LENGTH:
+                for v in _deletes(session.norm):
+                    norms = self.by_variant.get(v)
+                    if norms is not None:
+                        norms.discard(session.norm)
+                        if not norms:
+                            del self.by_variant[v]
+
+    def _find(self, norm):
+        """(latest open session for norm or a one-edit neighbour, distance) or (None, None)"""
+        sessions = self.by_norm.get(norm)
+        if sessions:
+            return sessions[-1], 0
+        if not self.fuzzy or len(norm) < FUZZY_MIN_LENGTH - 1:
+            return None, None
+        # One edit apart <=> both share a one-deletion variant, or one is a deletion of the other
+        candidates = set(self.by_variant.get(norm, ()))
+        for v in _deletes(norm):
+            if v in self.by_norm:
+                candidates.add(v)
+            candidates.update(self.by_variant.get(v, ()))
+        best = None
+        for other in candidates:
+            if plate_distance(norm, other, 1) <= 1:
+                session = self.by_norm[other][-1]
+                if best is None or session.time > best.time:
+                    best = session
+        return (best, 1) if best else (None, None)
+
+    # =========================
+    # SIGHTINGS
+    # =========================
+    def role_of(self, camera, direction=None):
+        """"entry" / "exit" / None for a sighting"""
+        if direction is not None and direction in self.directions:
+            return self.directions[direction]
+        return self.roles.get(camera)
+
+    def observe_detection(self, det):
+        """Feed one detection.Detection; returns the journey it closed, if any"""
+        role = self.role_of(det.camera, det.direction)
+        if role is None:
+            return None
+        return self.observe(role, det.plate, det.event_id, det.device_id or det.camera, det.received_at)
+
+    def observe(self, role, plate, event_id, device=None, ts=None):
+        """Record an entry or exit sighting; returns the journey row it closed, if any"""
+        if not plate or plate == "UNKNOWN":
+            return None
+        norm = normalize_plate(plate)
+        if not norm:
+            return None
+        ts = ts if ts is not None else time.time()
+        with self._lock:
+            session, distance = self._find(norm)
+            if role == "entry":
+                if session is None or distance != 0:
+                    # A one-edit neighbour at the entry is another vehicle, not a misread
+                    session = None
+                elif ts - session.time < self.dedup_seconds:
+                    return None   # the same vehicle read twice at the gate
+                closed = None
+                if session is not None:
+                    # A second entry means the exit was missed
+                    self._remove(session)
+                    closed = self._close("no_exit", session, None, ts)
+                self._add(Session(norm, plate, event_id, device, ts))
+                self._evict_overflow(ts)
+                return closed
+            if session is not None:
+                self._remove(session)
+                self.recent_exits[norm] = ts
+                self.recent_exits.move_to_end(norm)
+                return self._close("complete", session, (plate, event_id, device, ts), ts, distance)
+            last_exit = self.recent_exits.get(norm)
+            if last_exit is not None and ts - last_exit < self.dedup_seconds:
+                return None
+            return self._close("no_entry", None, (plate, event_id, device, ts), ts)
+
+    def _close(self, status, session, exit_sighting, ended, distance=None):
+        exit_plate, exit_event_id, exit_device, exit_ts = exit_sighting or (None, None, None, None)
+        row = {
+            "journey_id": session.event_id if session else exit_event_id,
+            "plate": session.plate if session else exit_plate,
+            "plate_key": session.norm if session else normalize_plate(exit_plate),
+            "status": status,
+            "entry_event_id": session.event_id if session else None,
+            "exit_event_id": exit_event_id,
+            "entry_plate": session.plate if session else None,
+            "exit_plate": exit_plate,
+            "entry_device": session.device if session else None,
+            "exit_device": exit_device,
+            "entry_time": datetime.fromtimestamp(session.time) if session else None,
+            "exit_time": datetime.fromtimestamp(exit_ts) if exit_ts else None,
+            "ended_at": datetime.fromtimestamp(ended),
+            "dwell_seconds": round(exit_ts - session.time, 3) if session and exit_ts else None,
+            "match_distance": distance,
+        }
+        self.pending.append(row)
+        JOURNEYS_CLOSED.inc(status=status)
+        if row["dwell_seconds"] is not None:
+            DWELL_SECONDS.observe(row["dwell_seconds"])
+        return row
+
+    def _evict_overflow(self, now):
+        while len(self.open) > self.max_open:
+            session = next(iter(self.open.values()))
+            self._remove(session)
+            self._close("no_exit", session, None, now)
+
+    def expire(self, now=None):
+        """Close sessions older than the TTL; returns how many were closed"""
+        now = now or time.time()
+        cutoff = now - self.ttl
+        closed = 0
+        with self._lock:
+            while self.open:
+                session = next(iter(self.open.values()))
+                if session.time >= cutoff:
+                    break
+                self._remove(session)
+                self._close("no_exit", session, None, session.time + self.ttl)
+                closed += 1
+            while self.recent_exits:
+                norm, ts = next(iter(self.recent_exits.items()))
+                if now - ts < self.dedup_seconds:
+                    break
+                del self.recent_exits[norm]
+        return closed
+
+    def open_sessions(self, plate=None, limit=100):
+        with self._lock:
+            if plate:
+                sessions = list(self.by_norm.get(normalize_plate(plate), ()))
+            else:
+                sessions = list(self.open.values())[-limit:]
+        return [{"plate": s.plate, "entry_event_id": s.event_id, "entry_device": s.device,
+                 "entry_time": datetime.fromtimestamp(s.time).isoformat(),
+                 "open_seconds": round(time.time() - s.time, 1)} for s in sessions]
+
+    # =========================
+    # PERSISTENCE
+    # =========================
+    def flush(self):
+        """Write closed journeys to the DB; kept for the next flush if that fails"""
+        with self._lock:
+            rows, self.pending = self.pending, []
+        if not rows or self.db is None:
+            return 0
+        try:
+            self.db.add_journeys(rows)
+        except Exception as e:
+            self.write_errors += 1
+            print(f"[ERROR] Journey write failed ({len(rows)} rows): {e}")
+            with self._lock:
+                self.pending[:0] = rows[-self.max_open:]
+            return 0
+        return len(rows)
+
+    def save(self, path=None):
+        """Snapshot open sessions so a restart does not turn them all into no_entry exits"""
+        path = path or self.state_file
+        with self._lock:
+            data = [[s.plate, s.event_id, s.device, s.time] for s in self.open.values()]
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        os.replace(tmp, path)
+
+    def load(self, path):
+        try:
+            with open(path, encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        with self._lock:
+            for plate, event_id, device, ts in data:
+                norm = normalize_plate(plate)
+                if norm and event_id not in self.open:
+                    self._add(Session(norm, plate, event_id, device, ts))
+
+    def start(self, interval=JOURNEY_FLUSH_INTERVAL):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, args=(interval,), name="journeys", daemon=True)
+            self._thread.start()
+        return self
+
+    def _run(self, interval):
+        last_save = time.monotonic()
+        while True:
+            time.sleep(interval)
+            try:
+                self.expire()
+                self.flush()
+                if self.state_file and time.monotonic() - last_save >= JOURNEY_SAVE_INTERVAL:
+                    self.save()
+                    last_save = time.monotonic()
+            except Exception as e:
+                print(f"[ERROR] Journey tracker: {e}")
+
+    def init_app(self, app):
+        """Add /journeys (stored journeys) and /journeys/open to a Flask app"""
+        from flask import jsonify, request
+        from export import parse_time
+
+        Gauge("anpr_journeys_open", "Entry sessions waiting for an exit", func=lambda: len(self.open))
+
+        @app.route("/journeys")
+        def journeys_list():
+            if self.db is None:
+                return jsonify(error="no database configured"), 503
+            try:
+                since = parse_time(request.args.get("since"))
+                until = parse_time(request.args.get("until"))
+            except ValueError as e:
+                return jsonify(error=str(e)), 400
+            plate = request.args.get("plate")
+            limit = max(1, min(request.args.get("limit", default=100, type=int), 10000))
+            rows = self.db.get_journeys(since, until, normalize_plate(plate) if plate else None,
+                                        request.args.get("status") or None, limit)
+            return jsonify(count=len(rows), journeys=rows)
+
+        @app.route("/journeys/open")
+        def journeys_open():
+            limit = max(1, min(request.args.get("limit", default=100, type=int), 10000))
+            return jsonify(open=len(self.open), sessions=self.open_sessions(request.args.get("plate"), limit))
+
+        return app
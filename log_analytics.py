@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+"""
+Camera Log Analytics
+Indexes the "<ts> - camN VEHICLE #n Plate:XXX" camera logs into compact
+columnar sidecar files (<log>.idx) and answers count / plate / reconcile
+queries from them.
+
+Usage:
+    python log_analytics.py index [paths...]
+    python log_analytics.py count --by hour [--camera 1] [--since 2026-02-07]
+    python log_analytics.py plate MH15HH3596 [--prefix]
+    python log_analytics.py reconcile --by hour
+"""
+import argparse
+import calendar
+import glob
+import mmap
+import os
+import re
+import struct
+import sys
+from array import array
+from bisect import bisect_left
+from datetime import datetime
+
+DEFAULT_PATHS = ["test", "logs"]
+
+# cam1_server / cam2_server:  2026-02-07 19:28:23,083 - cam1 VEHICLE #1 Plate:MH16CD4299
+# anpr_server_combined:       2026-02-07 19:28:23,083 - INFO - POST /NotificationInfo/TollgateInfo (Camera 1) - VEHICLE #1 - Plate: MH16CD4299
+LINE_RE = re.compile(
+    rb'^(\d{4}-\d\d-\d\d) (\d\d):(\d\d):(\d\d),(\d{3}) - (?:[A-Z]+ - )?'
+    rb'(?:cam(\d+) |.*?\(Camera (\d+)\) - )VEHICLE #(\d+)(?: -)? Plate: ?([^\s,]*)',
+    re.MULTILINE,
+)
+
+# Sidecar layout: header, then the columns back to back
+#   ts    int64 ms since epoch (log wall-clock time, no timezone)
+#   cam   uint8
+#   seq   uint32
+#   poff  uint32 x (rows + 1) offsets into the plate blob
+#   plate blob of concatenated plate strings
+IDX_MAGIC = b'LGIDX1\x00\x00'
+IDX_HEADER = struct.Struct('<8sQdII')   # magic, indexed source bytes, source mtime, rows, plate blob bytes
+
+
+class LogIndex:
+    """Columnar rows for one log file"""
+
+    def __init__(self, path):
+        self.path = path
+        self.indexed_bytes = 0
+        self.ts = array('q')
+        self.cam = array('B')
+        self.seq = array('I')
+        self.poff = array('I', [0])
+        self.plates = bytearray()
+
+    def __len__(self):
+        return len(self.ts)
+
+    def plate(self, i):
+        return self.plates[self.poff[i]:self.poff[i + 1]].decode('ascii', 'replace')
+
+    @property
+    def sidecar(self):
+        return self.path + '.idx'
+
+    def load(self):
+        """Read the sidecar if present; returns False when a rebuild is needed
+
+        The log may only have grown since the sidecar was written: it is
+        rebuilt when the log is shorter, older or rewritten at the same size,
+        or no longer ends a line where the index stopped.
+        """
+        try:
+            with open(self.sidecar, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                magic, indexed, mtime, rows, blob = IDX_HEADER.unpack_from(mm, 0)
+                if magic != IDX_MAGIC or not self._extends(indexed, mtime):
+                    return False
+                pos = IDX_HEADER.size
+                for col, width, count in ((self.ts, 8, rows), (self.cam, 1, rows),
+                                          (self.seq, 4, rows), (self.poff, 4, rows + 1)):
+                    del col[:]
+                    col.frombytes(mm[pos:pos + width * count])
+                    pos += width * count
+                self.plates = bytearray(mm[pos:pos + blob])
+                self.indexed_bytes = indexed
+                return True
+        except (OSError, ValueError, struct.error):
+            return False
+
+    def _extends(self, indexed, mtime):
+        """Whether the log is still the one indexed up to `indexed` bytes at `mtime`"""
+        st = os.stat(self.path)
+        if st.st_size < indexed or st.st_mtime < mtime or (st.st_size == indexed and st.st_mtime != mtime):
+            return False
+        if not indexed:
+            return True
+        with open(self.path, 'rb') as f:
+            f.seek(indexed - 1)
+            return f.read(1) == b'\n'
+
+    def save(self):
+        tmp = self.sidecar + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(IDX_HEADER.pack(IDX_MAGIC, self.indexed_bytes, os.path.getmtime(self.path),
+                                    len(self.ts), len(self.plates)))
+            for col in (self.ts, self.cam, self.seq, self.poff):
+                col.tofile(f)
+            f.write(self.plates)
+        os.replace(tmp, self.sidecar)
+
+    def update(self):
+        """Index bytes appended since the last run; rebuild if the log was replaced"""
+        size = os.path.getsize(self.path)
+        if not self.load():
+            self.__init__(self.path)
+        if size == self.indexed_bytes:
+            return 0
+        default_cam = _camera_from_name(self.path)
+        added = 0
+        days = {}
+        with open(self.path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            # Only index up to the last complete line; a partial line is picked up next run
+            end = mm.rfind(b'\n', self.indexed_bytes) + 1
+            if end <= self.indexed_bytes:
+                return 0
+            for m in LINE_RE.finditer(mm, self.indexed_bytes, end):
+                day, hh, mi, ss, ms, cam_a, cam_b, seq, plate = m.groups()
+                base = days.get(day)
+                if base is None:
+                    base = days[day] = calendar.timegm(datetime.strptime(day.decode(), '%Y-%m-%d').timetuple())
+                self.ts.append((base + int(hh) * 3600 + int(mi) * 60 + int(ss)) * 1000 + int(ms))
+                self.cam.append(int(cam_a or cam_b or default_cam))
+                self.seq.append(int(seq))
+                self.plates += plate
+                self.poff.append(len(self.plates))
+                added += 1
+            self.indexed_bytes = end
+        self.save()
+        return added
+
+
+def _camera_from_name(path):
+    m = re.search(r'camera(\d+)', os.path.basename(path))
+    return int(m.group(1)) if m else 0
+
+
+def find_logs(paths):
+    files = []
+    for p in paths or DEFAULT_PATHS:
+        if os.path.isdir(p):
+            files.extend(glob.glob(os.path.join(p, 'camera*.log')))
+        elif os.path.isfile(p):
+            files.append(p)
+    return sorted(files)
+
+
+def load_indexes(paths, update=True):
+    indexes = []
+    for path in find_logs(paths):
+        idx = LogIndex(path)
+        if update:
+            idx.update()
+        else:
+            idx.load()
+        indexes.append(idx)
+    return indexes
+
+
+def iter_rows(indexes, camera=None, since=None, until=None):
+    """Yield (ts_ms, cam, seq, plate, path) across indexes"""
+    for idx in indexes:
+        for i in range(len(idx)):
+            ts = idx.ts[i]
+            if camera is not None and idx.cam[i] != camera:
+                continue
+            if since is not None and ts < since:
+                continue
+            if until is not None and ts >= until:
+                continue
+            yield ts, idx.cam[i], idx.seq[i], idx.plate(i), idx.path
+
+
+def format_ts(ts_ms):
+    return datetime.utcfromtimestamp(ts_ms / 1000).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def bucket_key(ts_ms, by):
+    ts = datetime.utcfromtimestamp(ts_ms // 1000)
+    if by == 'day':
+        return ts.strftime('%Y-%m-%d')
+    return ts.strftime('%Y-%m-%d %H:00')
+
+
+def count_by(indexes, by='hour', camera=None, since=None, until=None):
+    """{bucket: {cam: count}}"""
+    step = 86400000 if by == 'day' else 3600000
+    counts = {}
+    for idx in indexes:
+        for i in range(len(idx)):
+            ts = idx.ts[i]
+            cam = idx.cam[i]
+            if (camera is not None and cam != camera) or (since is not None and ts < since) \
+                    or (until is not None and ts >= until):
+                continue
+            key = ts - ts % step
+            per_cam = counts.setdefault(key, {})
+            per_cam[cam] = per_cam.get(cam, 0) + 1
+    return {bucket_key(k, by): v for k, v in sorted(counts.items())}
+
+
+def find_plate(indexes, plate, prefix=False):
+    """Yield (ts_ms, cam, seq, plate, path) rows whose plate matches"""
+    try:
+        needle = plate.upper().encode('ascii')
+    except UnicodeEncodeError:
+        return      # plates are indexed as ASCII, so nothing can match
+    for idx in indexes:
+        blob = bytes(idx.plates)
+        pos = blob.find(needle)
+        while pos != -1:
+            # Map the blob offset back to its row, then check the match is anchored
+            row = bisect_left(idx.poff, pos + 1) - 1
+            start, end = idx.poff[row], idx.poff[row + 1]
+            if pos == start and (prefix or end - start == len(needle)):
+                yield idx.ts[row], idx.cam[row], idx.seq[row], idx.plate(row), idx.path
+            pos = blob.find(needle, max(pos + 1, end))
+
+
+def parse_day(value):
+    if value is None:
+        return None
+    fmt = '%Y-%m-%d %H:%M' if ' ' in value else '%Y-%m-%d'
+    return calendar.timegm(datetime.strptime(value, fmt).timetuple()) * 1000
+
+
+# =========================
+# CLI
+# =========================
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Index and query hourly camera logs")
+    parser.add_argument('--paths', nargs='*', default=None, help="log files or directories (default: test/ logs/)")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p_index = sub.add_parser('index', help="build or update sidecar indexes")
+    p_index.add_argument('files', nargs='*')
+
+    p_count = sub.add_parser('count', help="vehicles per hour/day per camera")
+    p_count.add_argument('--by', choices=['hour', 'day'], default='hour')
+    p_count.add_argument('--camera', type=int)
+    p_count.add_argument('--since')
+    p_count.add_argument('--until')
+
+    p_plate = sub.add_parser('plate', help="look up a plate")
+    p_plate.add_argument('plate')
+    p_plate.add_argument('--prefix', action='store_true')
+
+    p_rec = sub.add_parser('reconcile', help="cam1 vs cam2 counts")
+    p_rec.add_argument('--by', choices=['hour', 'day'], default='hour')
+    p_rec.add_argument('--since')
+    p_rec.add_argument('--until')
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'index':
+        for path in find_logs(args.files or args.paths):
+            added = LogIndex(path).update()
+            print(f"{path}: +{added} rows")
+        return 0
+
+    indexes = load_indexes(args.paths)
+
+    if args.command == 'count':
+        counts = count_by(indexes, args.by, args.camera, parse_day(args.since), parse_day(args.until))
+        cams = sorted({c for v in counts.values() for c in v})
+        print("bucket".ljust(18) + "".join(f"cam{c}".rjust(8) for c in cams) + "total".rjust(8))
+        for bucket, per_cam in counts.items():
+            print(bucket.ljust(18) + "".join(str(per_cam.get(c, 0)).rjust(8) for c in cams)
+                  + str(sum(per_cam.values())).rjust(8))
+
+    elif args.command == 'plate':
+        for ts, cam, seq, plate, path in sorted(find_plate(indexes, args.plate, args.prefix)):
+            print(f"{format_ts(ts)}  cam{cam}  #{seq:<5} {plate:<14} {path}")
+
+    elif args.command == 'reconcile':
+        counts = count_by(indexes, args.by, None, parse_day(args.since), parse_day(args.until))
+        print("bucket".ljust(18) + "cam1".rjust(8) + "cam2".rjust(8) + "delta".rjust(8))
+        for bucket, per_cam in counts.items():
+            c1, c2 = per_cam.get(1, 0), per_cam.get(2, 0)
+            flag = "  <-- mismatch" if c1 != c2 else ""
+            print(bucket.ljust(18) + str(c1).rjust(8) + str(c2).rjust(8) + str(c1 - c2).rjust(8) + flag)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
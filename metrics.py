@@ -0,0 +1,205 @@
+"""
+Prometheus-style Metrics for the ANPR Servers
+Counters, gauges and histograms rendered in the text exposition format
+on /metrics. Recording is a dict lookup and an add under a lock.
+"""
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# Seconds; tuned for a per-stage latency budget from ~100us to a few seconds
+DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+def _fmt_labels(names, values, extra=None):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help_text, labels=(), registry=None):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def _key(self, labels):
+        return tuple(labels.get(n, "") for n in self.label_names)
+
+    def header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def render(self):
+        lines = self.header()
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            lines.append(f"{self.name}{_fmt_labels(self.label_names, key)} {value}")
+        return lines
+
+
+class Gauge(Metric):
+    """Gauge set explicitly, or read from func() at scrape time"""
+    kind = "gauge"
+
+    def __init__(self, name, help_text, labels=(), registry=None, func=None):
+        super().__init__(name, help_text, labels, registry)
+        self.func = func
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def render(self):
+        lines = self.header()
+        if self.func is not None:
+            try:
+                values = self.func()
+            except Exception:
+                return lines
+            # func returns a number, or {label values tuple: number}
+            items = values.items() if isinstance(values, dict) else [((), values)]
+        else:
+            with self._lock:
+                items = list(self._values.items())
+        for key, value in items:
+            lines.append(f"{self.name}{_fmt_labels(self.label_names, key)} {value}")
+        return lines
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels=(), registry=None, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels, registry)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # per-bucket (non-cumulative) counts + overflow, sum, count
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][i] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self):
+        lines = self.header()
+        with self._lock:
+            items = [(k, (list(v[0]), v[1], v[2])) for k, v in self._values.items()]
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                le = _fmt_labels(self.label_names, key, 'le="%s"' % bound)
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            le = _fmt_labels(self.label_names, key, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{le} {count}")
+            lines.append(f"{self.name}_sum{_fmt_labels(self.label_names, key)} {total}")
+            lines.append(f"{self.name}_count{_fmt_labels(self.label_names, key)} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics[metric.name] = metric
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    def render(self):
+        lines = []
+        with self._lock:
+            metrics = list(self._metrics.values())
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# =========================
+# SHARED INGEST METRICS
+# =========================
+REQUEST_SECONDS = Histogram(
+    "anpr_request_seconds", "HTTP request latency by endpoint", ("endpoint", "method", "status"))
+STAGE_SECONDS = Histogram(
+    "anpr_stage_seconds", "Ingest stage latency (json_parse, base64_decode, image_write, json_archive, log, db_insert)",
+    ("stage", "camera"))
+DETECTIONS_TOTAL = Counter("anpr_detections_total", "Detections received", ("camera",))
+BYTES_WRITTEN = Counter("anpr_bytes_written_total", "Bytes written to disk", ("kind", "camera"))
+DB_CONNECTIONS_OPENED = Counter("anpr_db_connections_opened_total", "DB connections opened", ("backend",))
+DB_ERRORS = Counter("anpr_db_errors_total", "Failed DB operations", ("backend", "op"))
+
+
+def init_app(app):
+    """Time every request of a Flask app and serve /metrics"""
+    from flask import Response, g, request
+
+    @app.before_request
+    def _metrics_start():
+        g._metrics_start = time.perf_counter()
+
+    @app.after_request
+    def _metrics_observe(response):
+        start = getattr(g, "_metrics_start", None)
+        if start is not None:
+            endpoint = request.url_rule.rule if request.url_rule else "<unmatched>"
+            REQUEST_SECONDS.observe(time.perf_counter() - start, endpoint=endpoint,
+                                    method=request.method, status=response.status_code)
+        return response
+
+    @app.route("/metrics")
+    def metrics():
+        return Response(REGISTRY.render(), mimetype=CONTENT_TYPE)
+
+    return app
@@ -0,0 +1,370 @@
+"""
+Versioned Schema Migrations for Vehicle Detection
+Applies only pending migrations, recorded in schema_version. Never drops data.
+"""
+from datetime import datetime
+
+# Arbitrary key for pg_advisory_xact_lock so concurrently starting servers
+# apply migrations one at a time
+MIGRATION_LOCK_KEY = 7420051
+
+# Rows stored before the camera column existed: recover it from the
+# <plate>_CAMn_<id> folder naming where the server used it
+_CAMERA_FROM_IMAGE_URL = r'''
+    UPDATE vehicle_detections SET camera = CASE
+        WHEN UPPER(image_url) LIKE '%\_CAM2\_%' ESCAPE '\' THEN 'camera2'
+        WHEN UPPER(image_url) LIKE '%\_CAM1\_%' ESCAPE '\' THEN 'camera1'
+    END
+    WHERE camera IS NULL
+'''
+
+# =========================
+# POSTGRESQL
+# =========================
+def _pg_table_kind(cursor, table):
+    """'r' for a plain table, 'p' for a partitioned one, None if missing"""
+    cursor.execute('''
+        SELECT c.relkind FROM pg_class c
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE c.relname = %s AND n.nspname = current_schema()
+    ''', (table,))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def _pg_initial_schema(cursor):
+    # Tables created by the old DROP/CREATE init_db are plain heap tables;
+    # keep them as *_legacy and copy their rows into the partitioned tables
+    legacy = []
+    for table in ('webhook_events', 'vehicle_detections'):
+        if _pg_table_kind(cursor, table) == 'r':
+            cursor.execute(f'ALTER TABLE {table} RENAME TO {table}_legacy')
+            legacy.append(table)
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS webhook_events (
+            id BIGSERIAL,
+            event_id VARCHAR(255) NOT NULL,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            event_type VARCHAR(100),
+            data JSONB,
+            image_filename VARCHAR(255),
+            vehicle_data JSONB,
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (id, created_at),
+            UNIQUE (event_id, created_at)
+        ) PARTITION BY RANGE (created_at)
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS vehicle_detections (
+            id BIGSERIAL,
+            event_id VARCHAR(255) NOT NULL,
+            license_plate VARCHAR(50),
+            vehicle_type VARCHAR(100),
+            confidence FLOAT,
+            detection_data JSONB,
+            image_url VARCHAR(255),
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (id, created_at)
+        ) PARTITION BY RANGE (created_at)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_vehicle_detections_plate
+        ON vehicle_detections (license_plate, created_at DESC)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_vehicle_detections_created
+        ON vehicle_detections (created_at DESC)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_webhook_events_created
+        ON webhook_events (created_at DESC)
+    ''')
+    # Catch-all partitions so rows outside the pre-created ranges are never rejected
+    for table in ('webhook_events', 'vehicle_detections'):
+        cursor.execute(f'CREATE TABLE IF NOT EXISTS {table}_default PARTITION OF {table} DEFAULT')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS system_logs (
+            id SERIAL PRIMARY KEY,
+            level VARCHAR(20) NOT NULL,
+            message TEXT NOT NULL,
+            endpoint VARCHAR(255),
+            status_code INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    if 'webhook_events' in legacy:
+        cursor.execute('''
+            INSERT INTO webhook_events (event_id, timestamp, event_type, data, image_filename, vehicle_data, created_at)
+            SELECT event_id, timestamp, event_type, data, image_filename, vehicle_data,
+                   COALESCE(created_at, timestamp, CURRENT_TIMESTAMP)
+            FROM webhook_events_legacy
+            ON CONFLICT DO NOTHING
+        ''')
+    if 'vehicle_detections' in legacy:
+        cursor.execute('''
+            INSERT INTO vehicle_detections (event_id, license_plate, vehicle_type, confidence, detection_data, image_url, created_at)
+            SELECT event_id, license_plate, vehicle_type, confidence, detection_data, image_url,
+                   COALESCE(created_at, CURRENT_TIMESTAMP)
+            FROM vehicle_detections_legacy
+        ''')
+
+
+def _pg_detection_event_key(cursor):
+    # Lets spool replays insert with ON CONFLICT DO NOTHING (exactly-once on event_id)
+    cursor.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS uq_vehicle_detections_event
+        ON vehicle_detections (event_id, created_at)
+    ''')
+
+
+def _pg_watchlist(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS watchlist (
+            id SERIAL PRIMARY KEY,
+            plate VARCHAR(50) UNIQUE NOT NULL,
+            list_type VARCHAR(20) NOT NULL DEFAULT 'black',
+            note TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+
+def _pg_journeys(cursor):
+    # journey_id is the entry event_id (the exit event_id for an exit with no
+    # entry), so re-inserting a journey after a spool replay is a no-op
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS journeys (
+            id SERIAL PRIMARY KEY,
+            journey_id VARCHAR(100) UNIQUE NOT NULL,
+            plate VARCHAR(50),
+            plate_key VARCHAR(50),
+            status VARCHAR(20) NOT NULL,
+            entry_event_id VARCHAR(100),
+            exit_event_id VARCHAR(100),
+            entry_plate VARCHAR(50),
+            exit_plate VARCHAR(50),
+            entry_device VARCHAR(100),
+            exit_device VARCHAR(100),
+            entry_time TIMESTAMP,
+            exit_time TIMESTAMP,
+            ended_at TIMESTAMP NOT NULL,
+            dwell_seconds DOUBLE PRECISION,
+            match_distance INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_journeys_ended ON journeys (ended_at)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_journeys_plate ON journeys (plate_key, ended_at)')
+
+
+def _pg_ingest_keys(cursor):
+    # Unique event keys across partitions: the partitioned tables can only be
+    # unique on (event_id, created_at), and a camera resend has a new created_at
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS ingest_keys (
+            event_id VARCHAR(255) NOT NULL,
+            kind VARCHAR(30) NOT NULL,
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (event_id, kind)
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_ingest_keys_created ON ingest_keys (created_at)')
+
+
+def _pg_detection_camera(cursor):
+    cursor.execute('ALTER TABLE vehicle_detections ADD COLUMN IF NOT EXISTS camera VARCHAR(20)')
+    cursor.execute(_CAMERA_FROM_IMAGE_URL)
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_vehicle_detections_camera
+        ON vehicle_detections (camera, created_at DESC)
+    ''')
+
+
+POSTGRES_MIGRATIONS = [
+    (1, "partitioned webhook_events/vehicle_detections, system_logs", _pg_initial_schema),
+    (2, "unique (event_id, created_at) on vehicle_detections", _pg_detection_event_key),
+    (3, "watchlist", _pg_watchlist),
+    (4, "journeys", _pg_journeys),
+    (5, "ingest_keys (cross-partition event uniqueness)", _pg_ingest_keys),
+    (6, "vehicle_detections camera column", _pg_detection_camera),
+]
+
+# =========================
+# SQLITE
+# =========================
+def _sqlite_initial_schema(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS webhook_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            event_id TEXT UNIQUE NOT NULL,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+            event_type TEXT,
+            data TEXT,
+            image_filename TEXT,
+            vehicle_data TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS vehicle_detections (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            event_id TEXT NOT NULL,
+            license_plate TEXT,
+            vehicle_type TEXT,
+            confidence REAL,
+            detection_data TEXT,
+            image_url TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS server_logs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            level TEXT NOT NULL,
+            message TEXT NOT NULL,
+            endpoint TEXT,
+            status_code INTEGER,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+
+def _sqlite_indexes(cursor):
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_vehicle_detections_plate
+        ON vehicle_detections (license_plate, created_at)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_vehicle_detections_created
+        ON vehicle_detections (created_at)
+    ''')
+
+
+def _sqlite_detection_event_key(cursor):
+    # Lets bulk loads use INSERT OR IGNORE (exactly-once on event_id); any
+    # duplicates already present keep their oldest row
+    cursor.execute('''
+        DELETE FROM vehicle_detections
+        WHERE id NOT IN (SELECT MIN(id) FROM vehicle_detections GROUP BY event_id)
+    ''')
+    cursor.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS uq_vehicle_detections_event
+        ON vehicle_detections (event_id)
+    ''')
+
+
+def _sqlite_watchlist(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS watchlist (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            plate TEXT UNIQUE NOT NULL,
+            list_type TEXT NOT NULL DEFAULT 'black',
+            note TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+
+def _sqlite_journeys(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS journeys (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            journey_id TEXT UNIQUE NOT NULL,
+            plate TEXT,
+            plate_key TEXT,
+            status TEXT NOT NULL,
+            entry_event_id TEXT,
+            exit_event_id TEXT,
+            entry_plate TEXT,
+            exit_plate TEXT,
+            entry_device TEXT,
+            exit_device TEXT,
+            entry_time DATETIME,
+            exit_time DATETIME,
+            ended_at DATETIME NOT NULL,
+            dwell_seconds REAL,
+            match_distance INTEGER,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_journeys_ended ON journeys (ended_at)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_journeys_plate ON journeys (plate_key, ended_at)')
+
+
+def _sqlite_detection_camera(cursor):
+    cursor.execute('ALTER TABLE vehicle_detections ADD COLUMN camera TEXT')
+    cursor.execute(_CAMERA_FROM_IMAGE_URL)
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_vehicle_detections_camera
+        ON vehicle_detections (camera, created_at)
+    ''')
+
+
+SQLITE_MIGRATIONS = [
+    (1, "webhook_events, vehicle_detections, server_logs", _sqlite_initial_schema),
+    (2, "vehicle_detections plate/created_at indexes", _sqlite_indexes),
+    (3, "unique event_id on vehicle_detections", _sqlite_detection_event_key),
+    (4, "watchlist", _sqlite_watchlist),
+    (5, "journeys", _sqlite_journeys),
+    (6, "vehicle_detections camera column", _sqlite_detection_camera),
+]
+
+# =========================
+# RUNNER
+# =========================
+def current_version(cursor, dialect):
+    if dialect == 'postgres':
+        cursor.execute("SELECT to_regclass('schema_version')")
+        if cursor.fetchone()[0] is None:
+            return 0
+    else:
+        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='schema_version'")
+        if cursor.fetchone() is None:
+            return 0
+    cursor.execute('SELECT COALESCE(MAX(version), 0) FROM schema_version')
+    return cursor.fetchone()[0]
+
+
+def run_migrations(conn, migrations, dialect):
+    """Apply pending migrations, each committed with its schema_version row
+
+    Returns the list of versions applied; an up-to-date schema costs one
+    catalog lookup and one MAX() query.
+    """
+    latest = migrations[-1][0] if migrations else 0
+    cursor = conn.cursor()
+    if current_version(cursor, dialect) >= latest:
+        conn.commit()
+        return []
+
+    param = '%s' if dialect == 'postgres' else '?'
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.commit()
+
+    applied = []
+    for version, description, migrate in migrations:
+        if dialect == 'postgres':
+            cursor.execute('SELECT pg_advisory_xact_lock(%s)', (MIGRATION_LOCK_KEY,))
+        # Re-check under the lock: another server may have just applied it
+        cursor.execute(f'SELECT 1 FROM schema_version WHERE version = {param}', (version,))
+        if cursor.fetchone():
+            conn.commit()
+            continue
+        started = datetime.now()
+        migrate(cursor)
+        cursor.execute(f'INSERT INTO schema_version (version, description) VALUES ({param}, {param})',
+                       (version, description))
+        conn.commit()
+        applied.append(version)
+        print(f"[OK] Applied migration {version}: {description} "
+              f"({(datetime.now() - started).total_seconds():.2f}s)")
+    return applied
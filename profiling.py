@@ -0,0 +1,175 @@
+"""
+Opt-in Request Profiling for the Flask Apps
+  PROFILE_SAMPLE_RATE=N  cProfile every Nth request (.prof, open with pstats/snakeviz)
+  PROFILE_SLOW_MS=T      stack-sample in-flight requests and keep the samples of
+                         those slower than T ms (.folded, for flamegraph.pl/speedscope)
+With both unset no request hooks are installed, so it costs nothing.
+Profiles go to PROFILE_DIR, keeping the newest PROFILE_MAX_FILES.
+/admin/profiles needs PROFILE_ADMIN_TOKEN; without one it only answers localhost.
+"""
+import cProfile
+import itertools
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+PROFILE_SAMPLE_RATE = int(os.getenv('PROFILE_SAMPLE_RATE', '0'))
+PROFILE_SLOW_MS = float(os.getenv('PROFILE_SLOW_MS', '0'))
+PROFILE_DIR = os.getenv('PROFILE_DIR', './profiles')
+PROFILE_MAX_FILES = int(os.getenv('PROFILE_MAX_FILES', '50'))
+PROFILE_SAMPLE_INTERVAL = float(os.getenv('PROFILE_SAMPLE_INTERVAL', '0.005'))
+PROFILE_ADMIN_TOKEN = os.getenv('PROFILE_ADMIN_TOKEN', '')
+
+
+def _profile_path(endpoint, elapsed_ms, ext):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    safe = "".join(ch if ch.isalnum() else "_" for ch in endpoint).strip("_") or "root"
+    ts = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+    return os.path.join(PROFILE_DIR, f"{ts}_{safe}_{int(elapsed_ms)}ms{ext}")
+
+
+def _rotate():
+    try:
+        files = sorted((e for e in os.scandir(PROFILE_DIR) if e.is_file()),
+                       key=lambda e: e.stat().st_mtime)
+    except OSError:
+        return
+    for entry in files[:max(0, len(files) - PROFILE_MAX_FILES)]:
+        try:
+            os.remove(entry.path)
+        except OSError:
+            pass
+
+
+def list_profiles():
+    try:
+        entries = [e for e in os.scandir(PROFILE_DIR) if e.is_file()]
+    except OSError:
+        return []
+    entries.sort(key=lambda e: e.stat().st_mtime, reverse=True)
+    return [{"name": e.name, "bytes": e.stat().st_size,
+             "created": datetime.fromtimestamp(e.stat().st_mtime).isoformat()} for e in entries]
+
+
+class StackSampler:
+    """Samples the stacks of threads currently serving a request
+
+    Requests register on start and collect their samples on finish; the
+    sampler thread only runs while something is registered.
+    """
+
+    def __init__(self, interval=PROFILE_SAMPLE_INTERVAL):
+        self.interval = interval
+        self._inflight = {}   # thread ident -> Counter of collapsed stacks
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def begin(self, ident):
+        with self._lock:
+            self._inflight[ident] = Counter()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+                self._thread.start()
+        self._wake.set()
+
+    def end(self, ident):
+        with self._lock:
+            return self._inflight.pop(ident, None)
+
+    def _run(self):
+        me = threading.get_ident()
+        while True:
+            if not self._inflight:
+                self._wake.clear()
+                self._wake.wait(1.0)
+                continue
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self._lock:
+                for ident, samples in self._inflight.items():
+                    frame = frames.get(ident)
+                    if frame is None or ident == me:
+                        continue
+                    stack = []
+                    while frame is not None:
+                        code = frame.f_code
+                        stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                        frame = frame.f_back
+                    samples[";".join(reversed(stack))] += 1
+
+
+def init_profiling(app, sample_rate=PROFILE_SAMPLE_RATE, slow_ms=PROFILE_SLOW_MS):
+    """Install the sampling hooks (if enabled) and the /admin/profiles endpoints"""
+    from flask import abort, g, jsonify, request, send_from_directory
+
+    def check_token():
+        if not PROFILE_ADMIN_TOKEN:
+            if request.remote_addr not in ("127.0.0.1", "::1"):
+                abort(403)
+        elif request.headers.get("X-Admin-Token", request.args.get("token")) != PROFILE_ADMIN_TOKEN:
+            abort(403)
+
+    @app.route("/admin/profiles")
+    def profiles_index():
+        check_token()
+        return jsonify(enabled=bool(sample_rate or slow_ms), sample_rate=sample_rate,
+                       slow_ms=slow_ms, profiles=list_profiles())
+
+    @app.route("/admin/profiles/<name>")
+    def profiles_download(name):
+        check_token()
+        if os.path.basename(name) != name:
+            abort(404)
+        return send_from_directory(os.path.abspath(PROFILE_DIR), name, as_attachment=True)
+
+    if not sample_rate and not slow_ms:
+        return app
+
+    counter = itertools.count(1)
+    sampler = StackSampler() if slow_ms else None
+    write_lock = threading.Lock()
+
+    @app.before_request
+    def _profile_start():
+        if request.path.startswith("/admin/profiles"):
+            return
+        g._profile_start = time.perf_counter()
+        if sample_rate and next(counter) % sample_rate == 0:
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError:
+                pass    # another profiler is already active (Python 3.12+); skip this sample
+            else:
+                g._profiler = profiler
+        if sampler:
+            sampler.begin(threading.get_ident())
+
+    @app.teardown_request
+    def _profile_finish(exc):
+        start = g.pop("_profile_start", None)
+        if start is None:
+            return
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        endpoint = request.url_rule.rule if request.url_rule else request.path
+        profiler = g.pop("_profiler", None)
+        samples = sampler.end(threading.get_ident()) if sampler else None
+        try:
+            with write_lock:
+                if profiler is not None:
+                    profiler.disable()
+                    profiler.dump_stats(_profile_path(endpoint, elapsed_ms, ".prof"))
+                if samples and elapsed_ms >= slow_ms:
+                    with open(_profile_path(endpoint, elapsed_ms, ".folded"), "w", encoding="utf-8") as f:
+                        for stack, count in samples.most_common():
+                            f.write(f"{stack} {count}\n")
+                if profiler is not None or (samples and elapsed_ms >= slow_ms):
+                    _rotate()
+        except Exception as e:
+            print(f"[PROFILE] Could not write profile: {e}")
+
+    return app
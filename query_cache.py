@@ -0,0 +1,210 @@
+"""
+Read-through Query Cache for Vehicle Detection
+TTL + LRU result cache in front of the database adapters
+"""
+import copy
+import json
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+CACHE_TTL = float(os.getenv('QUERY_CACHE_TTL', '30'))
+CACHE_MAX_BYTES = int(os.getenv('QUERY_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+CACHE_MAX_ENTRY_BYTES = int(os.getenv('QUERY_CACHE_MAX_ENTRY_BYTES', str(8 * 1024 * 1024)))
+# Tags whose invalidation count is remembered; past this the counts restart under a new epoch
+CACHE_MAX_GENERATIONS = 10000
+
+
+def object_size(value):
+    """Approximate memory held by a result: the containers and everything in them"""
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(object_size(k) + object_size(v) for k, v in value.items())
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        size += sum(object_size(item) for item in value)
+    return size
+
+
+class QueryCache:
+    """LRU cache with per-entry TTL, a total byte budget and tag invalidation"""
+
+    def __init__(self, ttl=CACHE_TTL, max_bytes=CACHE_MAX_BYTES, max_entry_bytes=CACHE_MAX_ENTRY_BYTES):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self._entries = OrderedDict()   # key -> (expires_at, size, tags, value, body)
+        self._tags = {}                 # tag -> set of keys
+        self._generations = {}          # tag -> times invalidated
+        self._epoch = 0
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        """Return the cached (value, body) pair, or None on miss"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry[0] < time.monotonic():
+                self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[3], entry[4]
+
+    def generation(self, tags):
+        """Snapshot to take before loading a result for tags; see put()"""
+        with self._lock:
+            return self._epoch, tuple(self._generations.get(tag, 0) for tag in tags)
+
+    def put(self, key, value, body, tags=(), generation=None):
+        """Store a result; the entry size is its serialized JSON body plus the value's objects
+
+        With the generation() taken before the load, a result that one of its
+        tags was invalidated during is dropped instead of cached stale.
+        """
+        size = len(body) + object_size(value)
+        if size > self.max_entry_bytes or size > self.max_bytes:
+            return
+        with self._lock:
+            if generation is not None and generation != (
+                    self._epoch, tuple(self._generations.get(tag, 0) for tag in tags)):
+                return
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + self.ttl, size, tuple(tags), value, body)
+            self._bytes += size
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+            while self._bytes > self.max_bytes and self._entries:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, *tags):
+        """Drop every entry carrying any of the given tags"""
+        with self._lock:
+            if len(self._generations) + len(tags) > CACHE_MAX_GENERATIONS:
+                self._generations.clear()
+                self._epoch += 1
+            for tag in tags:
+                self._generations[tag] = self._generations.get(tag, 0) + 1
+                for key in self._tags.pop(tag, ()):
+                    if key in self._entries:
+                        self._remove(key)
+                        self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tags.clear()
+            self._bytes = 0
+
+    def _remove(self, key):
+        _, size, tags, _, _ = self._entries.pop(key)
+        self._bytes -= size
+        for tag in tags:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "ttl_seconds": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+
+class CachedDatabase:
+    """Drop-in wrapper around simple_db / postgres_db adding a read-through cache
+
+    Reads are tagged with what they depend on; writes invalidate the tag of
+    the affected plate plus the "recent" listings. Rows are copied on the way
+    out, so callers may modify what they get back; the *_json variants hand
+    back the cached rows themselves, for callers that only send the body.
+    """
+
+    def __init__(self, db, cache=None):
+        self.db = db
+        self.cache = cache or QueryCache()
+
+    def __getattr__(self, name):
+        return getattr(self.db, name)
+
+    def _read(self, key, tags, loader):
+        """(value, body), with value shared with the cache; do not modify it"""
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
+        generation = self.cache.generation(tags)
+        value = loader()
+        body = json.dumps(value, default=str).encode("utf-8")
+        self.cache.put(key, value, body, tags, generation=generation)
+        return value, body
+
+    # ---- reads ----
+    def get_vehicle_detections(self, limit=50):
+        """Get recent vehicle detections"""
+        return copy.deepcopy(self.get_vehicle_detections_json(limit)[0])
+
+    def get_vehicle_detections_json(self, limit=50):
+        """Recent vehicle detections as (rows, serialized JSON body)"""
+        return self._read(("detections", limit), ("detections",),
+                          lambda: self.db.get_vehicle_detections(limit=limit))
+
+    def get_vehicle_by_plate(self, plate):
+        """Get all detections for a specific plate"""
+        return copy.deepcopy(self.get_vehicle_by_plate_json(plate)[0])
+
+    def get_vehicle_by_plate_json(self, plate):
+        """Detections for a plate as (rows, serialized JSON body)"""
+        return self._read(("plate", plate), ("plate:" + str(plate),),
+                          lambda: self.db.get_vehicle_by_plate(plate))
+
+    def get_webhook_events(self, limit=20):
+        """Get recent webhook events"""
+        return copy.deepcopy(self.get_webhook_events_json(limit)[0])
+
+    def get_webhook_events_json(self, limit=20):
+        """Recent webhook events as (rows, serialized JSON body)"""
+        return self._read(("webhook_events", limit), ("webhook_events",),
+                          lambda: self.db.get_webhook_events(limit=limit))
+
+    # ---- writes ----
+    def add_vehicle_detection(self, event_id, license_plate, detection_data, image_url, vehicle_type=None, confidence=None,
+                              camera=None):
+        """Add a vehicle detection record and invalidate dependent reads"""
+        try:
+            return self.db.add_vehicle_detection(event_id, license_plate, detection_data, image_url,
+                                                 vehicle_type=vehicle_type, confidence=confidence, camera=camera)
+        finally:
+            self.cache.invalidate("detections", "plate:" + str(license_plate))
+
+    def add_webhook_event(self, event_id, event_type, data, vehicle_data=None, image_filename=None):
+        """Add a webhook event and invalidate dependent reads"""
+        try:
+            return self.db.add_webhook_event(event_id, event_type, data,
+                                             vehicle_data=vehicle_data, image_filename=image_filename)
+        finally:
+            self.cache.invalidate("webhook_events")
+
+    def cache_stats(self):
+        return self.cache.stats()
@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+"""
+Cam1 / Cam2 Reconciliation
+Joins the two camera detection streams on a sliding time window with
+OCR-tolerant plate matching, and reports matched / cam1-only / cam2-only
+events with per-hour miss rates.
+
+Runs in real time (StreamReconciler, fed by the ingest server) or in batch
+over historic logs or DB rows:
+    python reconcile.py logs [--paths test logs] [--window 5] [--show-misses]
+    python reconcile.py db [--since 2026-02-01] [--until 2026-02-08] [--window 5]
+"""
+import os
+import sys
+import threading
+from collections import deque
+from datetime import datetime, timedelta
+
+from records import camera_number
+
+DEFAULT_WINDOW_MS = 5000
+DEFAULT_MAX_DISTANCE = 1
+HOURS_KEPT = 48
+
+# Characters ANPR engines commonly confuse, folded to one canonical symbol
+OCR_FOLD = str.maketrans({
+    'O': '0', 'D': '0', 'Q': '0',
+    'I': '1', 'L': '1', 'J': '1',
+    'Z': '2', 'S': '5', 'G': '6', 'T': '7', 'B': '8',
+})
+
+
+def normalize_plate(plate):
+    """Upper-case, drop separators and fold OCR look-alikes"""
+    if not plate:
+        return ""
+    return "".join(ch for ch in plate.upper() if ch.isalnum()).translate(OCR_FOLD)
+
+
+def plate_distance(a, b, max_distance=DEFAULT_MAX_DISTANCE):
+    """Levenshtein distance, or max_distance + 1 as soon as it is exceeded"""
+    if a == b:
+        return 0
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    prev = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        cur = [i]
+        best = i
+        for j, cb in enumerate(b, 1):
+            cost = min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + (ca != cb))
+            cur.append(cost)
+            best = min(best, cost)
+        if best > max_distance:
+            return max_distance + 1
+        prev = cur
+    return prev[-1]
+
+
+def wall_clock_ms(ts=None):
+    """Local wall-clock time as ms, the same convention as the log timestamps"""
+    ts = ts or datetime.now()
+    return int((ts - datetime(1970, 1, 1)).total_seconds() * 1000)
+
+
+def hour_of(ts_ms):
+    return datetime.utcfromtimestamp(ts_ms // 1000).strftime('%Y-%m-%d %H:00')
+
+
+class HourlyStats:
+    """matched / cam1_only / cam2_only counters per hour bucket"""
+
+    def __init__(self, max_hours=None):
+        self.max_hours = max_hours
+        self.hours = {}
+
+    def add(self, outcome, ts_ms):
+        key = hour_of(ts_ms)
+        bucket = self.hours.get(key)
+        if bucket is None:
+            bucket = self.hours[key] = {"matched": 0, "cam1_only": 0, "cam2_only": 0}
+            if self.max_hours and len(self.hours) > self.max_hours:
+                del self.hours[min(self.hours)]
+        bucket[outcome] += 1
+
+    def report(self):
+        rows = []
+        for hour in sorted(self.hours):
+            b = self.hours[hour]
+            seen1 = b["matched"] + b["cam1_only"]
+            seen2 = b["matched"] + b["cam2_only"]
+            rows.append({
+                "hour": hour,
+                **b,
+                # cam2 missed what only cam1 saw, and vice versa
+                "cam1_miss_rate": round(b["cam2_only"] / seen2, 4) if seen2 else 0.0,
+                "cam2_miss_rate": round(b["cam1_only"] / seen1, 4) if seen1 else 0.0,
+            })
+        return rows
+
+
+# =========================
+# BATCH
+# =========================
+def reconcile(cam1_events, cam2_events, window_ms=DEFAULT_WINDOW_MS, max_distance=DEFAULT_MAX_DISTANCE):
+    """Match two event lists of (ts_ms, plate, ref)
+
+    Both lists are sorted once (O(n log n)); each cam1 event is then compared
+    only with the cam2 events inside its time window. Returns
+    (matched, cam1_only, cam2_only, HourlyStats) where matched holds
+    (cam1_event, cam2_event, distance) tuples.
+    """
+    a = sorted(cam1_events, key=lambda e: e[0])
+    b = sorted(cam2_events, key=lambda e: e[0])
+    b_norm = [normalize_plate(e[1]) for e in b]
+    used = [False] * len(b)
+    matched, cam1_only = [], []
+    stats = HourlyStats()
+    lo = 0
+    for ev in a:
+        ts = ev[0]
+        while lo < len(b) and b[lo][0] < ts - window_ms:
+            lo += 1
+        norm = normalize_plate(ev[1])
+        best = None
+        j = lo
+        while j < len(b) and b[j][0] <= ts + window_ms:
+            if not used[j]:
+                d = plate_distance(norm, b_norm[j], max_distance)
+                if d <= max_distance:
+                    key = (d, abs(b[j][0] - ts))
+                    if best is None or key < best[0]:
+                        best = (key, j)
+            j += 1
+        if best is None:
+            cam1_only.append(ev)
+            stats.add("cam1_only", ts)
+        else:
+            j = best[1]
+            used[j] = True
+            matched.append((ev, b[j], best[0][0]))
+            stats.add("matched", ts)
+    cam2_only = [e for e, u in zip(b, used) if not u]
+    for ev in cam2_only:
+        stats.add("cam2_only", ev[0])
+    return matched, cam1_only, cam2_only, stats
+
+
+# =========================
+# REAL TIME
+# =========================
+class StreamReconciler:
+    """Incremental reconciler for live ingest
+
+    add() matches an event against the other camera's pending events in
+    the window; pending events older than the window are emitted as
+    one-camera misses. on_result(outcome, event, other) is called for
+    every decision, with outcome in matched / cam1_only / cam2_only.
+    """
+
+    def __init__(self, window_ms=DEFAULT_WINDOW_MS, max_distance=DEFAULT_MAX_DISTANCE, on_result=None):
+        self.window_ms = window_ms
+        self.max_distance = max_distance
+        self.on_result = on_result
+        self.pending = {1: deque(), 2: deque()}   # (ts_ms, plate, ref, normalized)
+        self.stats = HourlyStats(max_hours=HOURS_KEPT)
+        self._lock = threading.Lock()
+
+    def add(self, camera, ts_ms, plate, ref=None):
+        results = []
+        with self._lock:
+            self._expire(ts_ms, results)
+            other = 2 if camera == 1 else 1
+            norm = normalize_plate(plate)
+            best = None
+            for i, ev in enumerate(self.pending[other]):
+                if abs(ev[0] - ts_ms) > self.window_ms:
+                    continue
+                d = plate_distance(norm, ev[3], self.max_distance)
+                if d <= self.max_distance:
+                    key = (d, abs(ev[0] - ts_ms))
+                    if best is None or key < best[0]:
+                        best = (key, i)
+            event = (ts_ms, plate, ref, norm)
+            if best is None:
+                self.pending[camera].append(event)
+            else:
+                match = self.pending[other][best[1]]
+                del self.pending[other][best[1]]
+                pair = (event, match) if camera == 1 else (match, event)
+                self.stats.add("matched", pair[0][0])
+                results.append(("matched",) + pair)
+        self._emit(results)
+
+    def expire(self, now_ms):
+        results = []
+        with self._lock:
+            self._expire(now_ms, results)
+        self._emit(results)
+
+    def _expire(self, now_ms, results):
+        for camera, outcome in ((1, "cam1_only"), (2, "cam2_only")):
+            queue = self.pending[camera]
+            while queue and queue[0][0] < now_ms - self.window_ms:
+                ev = queue.popleft()
+                self.stats.add(outcome, ev[0])
+                results.append((outcome, ev, None))
+
+    def _emit(self, results):
+        if self.on_result:
+            for outcome, ev, other in results:
+                self.on_result(outcome, ev, other)
+
+    def report(self):
+        with self._lock:
+            return {
+                "window_ms": self.window_ms,
+                "pending": {f"cam{c}": len(q) for c, q in self.pending.items()},
+                "hours": self.stats.report(),
+            }
+
+
+# =========================
+# SOURCES
+# =========================
+def events_from_logs(paths=None):
+    """(cam1_events, cam2_events) from the indexed camera logs"""
+    from log_analytics import load_indexes, iter_rows
+    cams = {1: [], 2: []}
+    for ts, cam, seq, plate, path in iter_rows(load_indexes(paths)):
+        if cam in cams:
+            cams[cam].append((ts, plate, f"{path}#{seq}"))
+    return cams[1], cams[2]
+
+
+def camera_of_row(row):
+    """Camera number of a vehicle_detections row: its camera column, else the folder naming"""
+    if row.get("camera"):
+        try:
+            return camera_number(row["camera"])
+        except ValueError:
+            return None
+    url = (row.get("image_url") or "").upper()
+    if "_CAM2_" in url:
+        return 2
+    if "_CAM1_" in url:
+        return 1
+    return None
+
+
+def events_from_db(db, since=None, until=None):
+    """(cam1_events, cam2_events) from vehicle_detections rows in [since, until)"""
+    cams = {1: [], 2: []}
+    rows = db.iter_vehicle_detections(since=since, until=until, batch_size=5000, records=True,
+                                      columns=("event_id", "license_plate", "image_url", "camera", "created_at"))
+    for row in rows:
+        cam = camera_of_row({"image_url": row.image_url, "camera": row.camera})
+        created = row.created_at
+        if cam is None or created is None:
+            continue
+        if isinstance(created, str):
+            created = datetime.fromisoformat(created)
+        cams[cam].append((wall_clock_ms(created), row.license_plate, row.event_id))
+    return cams[1], cams[2]
+
+
+# =========================
+# CLI
+# =========================
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="Reconcile cam1 and cam2 detections")
+    parser.add_argument('source', choices=['logs', 'db'])
+    parser.add_argument('--paths', nargs='*', default=None, help="log files or directories (default: test/ logs/)")
+    parser.add_argument('--since', type=datetime.fromisoformat, default=None, help="DB rows from (default: last 24h)")
+    parser.add_argument('--until', type=datetime.fromisoformat, default=None, help="DB rows before")
+    parser.add_argument('--window', type=float, default=DEFAULT_WINDOW_MS / 1000, help="match window in seconds")
+    parser.add_argument('--max-distance', type=int, default=DEFAULT_MAX_DISTANCE)
+    parser.add_argument('--show-misses', action='store_true')
+    args = parser.parse_args(argv)
+
+    if args.source == 'logs':
+        cam1, cam2 = events_from_logs(args.paths)
+    else:
+        if os.getenv('DB_TYPE', 'postgres').lower() == 'sqlite':
+            from simple_db import db
+        else:
+            from postgres_db import db
+        since = args.since or datetime.now() - timedelta(days=1)
+        cam1, cam2 = events_from_db(db, since, args.until)
+
+    matched, cam1_only, cam2_only, stats = reconcile(cam1, cam2, int(args.window * 1000), args.max_distance)
+    print(f"matched={len(matched)} cam1_only={len(cam1_only)} cam2_only={len(cam2_only)}")
+    print("hour".ljust(18) + "matched".rjust(9) + "cam1only".rjust(10) + "cam2only".rjust(10)
+          + "cam1miss".rjust(10) + "cam2miss".rjust(10))
+    for r in stats.report():
+        print(r["hour"].ljust(18) + str(r["matched"]).rjust(9) + str(r["cam1_only"]).rjust(10)
+              + str(r["cam2_only"]).rjust(10) + f"{r['cam1_miss_rate']:.1%}".rjust(10)
+              + f"{r['cam2_miss_rate']:.1%}".rjust(10))
+    if args.show_misses:
+        for label, events in (("cam1 only", cam1_only), ("cam2 only", cam2_only)):
+            for ts, plate, ref in events:
+                print(f"{label}: {datetime.utcfromtimestamp(ts / 1000):%Y-%m-%d %H:%M:%S} {plate} {ref}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,82 @@
+"""
+Row Records and Filters for the DB Adapters
+Column lists, lightweight record types and the range / camera / plate
+filters shared by the iter_* APIs of simple_db and postgres_db.
+"""
+from collections import namedtuple
+from functools import lru_cache
+
+DETECTION_COLUMNS = ('id', 'event_id', 'license_plate', 'vehicle_type', 'confidence',
+                     'detection_data', 'image_url', 'camera', 'created_at')
+WEBHOOK_COLUMNS = ('id', 'event_id', 'timestamp', 'event_type', 'data',
+                   'image_filename', 'vehicle_data', 'created_at')
+JOURNEY_COLUMNS = ('journey_id', 'plate', 'plate_key', 'status', 'entry_event_id', 'exit_event_id',
+                   'entry_plate', 'exit_plate', 'entry_device', 'exit_device', 'entry_time',
+                   'exit_time', 'ended_at', 'dwell_seconds', 'match_distance')
+
+
+@lru_cache(maxsize=64)
+def record_type(columns):
+    """Tuple subclass with named fields and no per-row __dict__ (namedtuple sets __slots__ = ())"""
+    return namedtuple('Record', columns)
+
+
+def select_columns(columns, allowed):
+    """Requested columns that exist, in request order; all of them if none given"""
+    if not columns:
+        return tuple(allowed)
+    cols = tuple(c for c in columns if c in allowed)
+    if not cols:
+        raise ValueError(f"no valid columns in {list(columns)}")
+    return cols
+
+
+def camera_number(camera):
+    """1 / 2 from 1, '2', 'camera1', 'cam2'; None for no filter"""
+    if camera is None or camera == '':
+        return None
+    digits = ''.join(ch for ch in str(camera) if ch.isdigit())
+    if not digits:
+        raise ValueError(f"unknown camera {camera!r}")
+    return int(digits)
+
+
+def build_filters(mark, since=None, until=None, camera=None, plate=None):
+    """(where_sql, params) with mark as the driver's placeholder ('?' or '%s')
+
+    camera matches the camera column ('camera1' / 'camera2') the ingest
+    servers store with each detection.
+    """
+    where, params = [], []
+    if since is not None:
+        where.append(f'created_at >= {mark}')
+        params.append(since)
+    if until is not None:
+        where.append(f'created_at < {mark}')
+        params.append(until)
+    cam = camera_number(camera)
+    if cam is not None:
+        where.append(f'camera = {mark}')
+        params.append(f'camera{cam}')
+    if plate is not None:
+        where.append(f'license_plate = {mark}')
+        params.append(plate)
+    return (' WHERE ' + ' AND '.join(where) if where else ''), params
+
+
+def journey_filters(mark, since=None, until=None, plate_key=None, status=None):
+    """(where_sql, params) for the journeys table; the time range applies to ended_at"""
+    where, params = [], []
+    if since is not None:
+        where.append(f'ended_at >= {mark}')
+        params.append(since)
+    if until is not None:
+        where.append(f'ended_at < {mark}')
+        params.append(until)
+    if plate_key is not None:
+        where.append(f'plate_key = {mark}')
+        params.append(plate_key)
+    if status is not None:
+        where.append(f'status = {mark}')
+        params.append(status)
+    return (' WHERE ' + ' AND '.join(where) if where else ''), params
@@ -0,0 +1,514 @@
+#!/usr/bin/env python3
+"""
+Segment Store for Event Images
+Packs images into large append-only segment files instead of one directory
+plus 1-3 small files per event, which on SD/eMMC edge storage costs more in
+inode and metadata writes than the ~9 KB cutouts themselves. Used as the
+STORAGE_BACKEND=segment store (storage_backends.SegmentStorage).
+
+  seg_000042.dat   records framed and checksummed like the spool:
+                   op | key length | key | image bytes
+  seg_000042.idx   written when the segment is sealed: entries sorted by a
+                   hash of the event folder (the key up to its last "/"),
+                   mmap'd and binary-searched, never loaded into memory
+
+Only the segment being written has an in-memory index, rebuilt from its
+data file after a crash. Reads return a memoryview over the mmap'd segment
+(view) or go socket-ward with os.sendfile (sendfile) without copying.
+Deletes append a tombstone; when a segment fills up, sealed segments with
+more than SEGMENT_STORE_COMPACT_RATIO dead bytes are compacted in the
+background and, with SEGMENT_STORE_MAX_BYTES set, the oldest segments are
+dropped to stay under it.
+
+One process owns a store at a time: opening it takes an exclusive flock on
+<root>/LOCK, and a second opener (the CLI against a running server's
+store, a second server) gets StoreLocked instead of appending to, or
+truncating, the owner's active segment.
+
+    python segment_store.py stats ./segments/downloads
+    python segment_store.py compact ./segments/downloads [--ratio 0.3]
+    python segment_store.py pack ./downloads ./segments/downloads   import existing event folders
+"""
+import hashlib
+import json
+import mmap
+import os
+import struct
+import sys
+import threading
+import zlib
+
+from metrics import Counter
+from spool import RECORD_HEADER, RECORD_MAGIC, read_records
+
+try:
+    import fcntl
+except ImportError:   # not POSIX: no cross-process lock
+    fcntl = None
+
+SEGMENT_STORE_SEGMENT_BYTES = int(os.getenv('SEGMENT_STORE_SEGMENT_BYTES', str(128 * 1024 * 1024)))
+SEGMENT_STORE_COMPACT_RATIO = float(os.getenv('SEGMENT_STORE_COMPACT_RATIO', '0.5'))
+SEGMENT_STORE_MAX_BYTES = int(os.getenv('SEGMENT_STORE_MAX_BYTES', '0'))   # 0 = no limit
+
+# Record payload after the spool record header: op | key length, then key and data
+ENTRY_HEADER = struct.Struct('<BH')
+OP_PUT, OP_DELETE = 1, 2
+# Index file: magic | version | entry count, then fixed-size entries sorted by group hash
+INDEX_HEADER = struct.Struct('<4sHxxQ')
+INDEX_ENTRY = struct.Struct('<QQIB3x')   # group hash | record offset | data length | op
+INDEX_MAGIC = b'SIDX'
+INDEX_VERSION = 1
+
+COMPACTED_BYTES = Counter("anpr_segment_compacted_bytes_total", "Dead bytes reclaimed by segment compaction")
+EVICTED_SEGMENTS = Counter("anpr_segment_evicted_total", "Segments dropped to stay under SEGMENT_STORE_MAX_BYTES")
+
+
+class StoreLocked(Exception):
+    """Another process has the segment store open"""
+
+
+def group_of(key):
+    """Event part of a key ("FOLDER/cutout.jpg" -> "FOLDER"); a loose image is its own group"""
+    return key.rsplit("/", 1)[0] if "/" in key else key
+
+
+def group_hash(group):
+    return int.from_bytes(hashlib.blake2b(group.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+def read_key(buf, offset):
+    """(key, op, data offset) of the record at offset in a segment buffer"""
+    start = offset + RECORD_HEADER.size
+    op, key_len = ENTRY_HEADER.unpack_from(buf, start)
+    key_start = start + ENTRY_HEADER.size
+    return str(buf[key_start:key_start + key_len], "utf-8"), op, key_start + key_len
+
+
+def _map(path):
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return b""
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class Segment:
+    """A sealed data file and its sorted index, both mmap'd read-only"""
+
+    def __init__(self, seq, data_path, index_path):
+        self.seq = seq
+        self.data_path = data_path
+        self.index_path = index_path
+        self.size = os.path.getsize(data_path)
+        self.data = _map(data_path)
+        self.index = _map(index_path)
+        magic, version, self.count = INDEX_HEADER.unpack_from(self.index, 0)
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            raise ValueError(f"bad segment index {index_path}")
+
+    def _hash_at(self, i):
+        return INDEX_ENTRY.unpack_from(self.index, INDEX_HEADER.size + i * INDEX_ENTRY.size)[0]
+
+    def find(self, h):
+        """(record offset, data length, op) of every entry of group hash h"""
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._hash_at(mid) < h:
+                lo = mid + 1
+            else:
+                hi = mid
+        found = []
+        while lo < self.count:
+            entry_hash, offset, length, op = INDEX_ENTRY.unpack_from(
+                self.index, INDEX_HEADER.size + lo * INDEX_ENTRY.size)
+            if entry_hash != h:
+                break
+            found.append((offset, length, op))
+            lo += 1
+        return found
+
+    def entries(self):
+        for i in range(self.count):
+            yield INDEX_ENTRY.unpack_from(self.index, INDEX_HEADER.size + i * INDEX_ENTRY.size)[1:]
+
+
+class SegmentStore:
+    """Rolling append-only segments of keyed blobs with mmap'd indexes"""
+
+    def __init__(self, root, segment_bytes=SEGMENT_STORE_SEGMENT_BYTES, fsync=False,
+                 compact_ratio=SEGMENT_STORE_COMPACT_RATIO, max_bytes=SEGMENT_STORE_MAX_BYTES):
+        self.root = root
+        self.segment_bytes = segment_bytes
+        self.fsync = fsync
+        self.compact_ratio = compact_ratio
+        self.max_bytes = max_bytes
+        self._lock = threading.RLock()
+        self._maintaining = threading.Lock()
+        self._sealed = []            # oldest first; replaced, never mutated, so readers can snapshot it
+        self._active = {}            # key -> (record offset, data offset, data length, op)
+        self._active_map = None
+        self._maintainer = None
+        os.makedirs(root, exist_ok=True)
+        self._lock_file = self._take_lock()
+        self._open()
+
+    def _take_lock(self):
+        f = open(os.path.join(self.root, "LOCK"), "a+")
+        if fcntl is not None:
+            try:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                f.close()
+                raise StoreLocked(f"{self.root} is in use by another process")
+            f.seek(0)
+            f.truncate()
+            f.write(f"{os.getpid()}\n")
+            f.flush()
+        return f
+
+    def _path(self, seq, ext):
+        return os.path.join(self.root, f"seg_{seq:06d}.{ext}")
+
+    # =========================
+    # OPEN / RECOVER
+    # =========================
+    def _scan(self, seq):
+        """In-segment index of a data file and the offset where its valid records end"""
+        entries, end = {}, 0
+        path = self._path(seq, "dat")
+        if not os.path.exists(path):
+            return entries, end
+        for payload, next_offset in read_records(path):
+            offset = next_offset - RECORD_HEADER.size - len(payload)
+            op, key_len = ENTRY_HEADER.unpack_from(payload)
+            key = payload[ENTRY_HEADER.size:ENTRY_HEADER.size + key_len].decode("utf-8")
+            data_offset = offset + RECORD_HEADER.size + ENTRY_HEADER.size + key_len
+            entries[key] = (offset, data_offset, next_offset - data_offset, op)
+            end = next_offset
+        return entries, end
+
+    def _write_index(self, seq, entries):
+        rows = sorted((group_hash(group_of(k)), e[0], e[2], e[3]) for k, e in entries.items())
+        tmp = self._path(seq, "idx.tmp")
+        with open(tmp, "wb") as f:
+            f.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, len(rows)))
+            f.write(b"".join(INDEX_ENTRY.pack(*row) for row in rows))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self._path(seq, "idx"))
+
+    def _open(self):
+        seqs = sorted(int(n[4:-4]) for n in os.listdir(self.root) if n.startswith("seg_") and n.endswith(".dat"))
+        active = seqs[-1] if seqs else 1
+        if seqs and os.path.exists(self._path(active, "idx")):
+            active += 1   # crashed right after sealing, before the next segment was created
+        sealed = []
+        for seq in seqs:
+            if seq == active:
+                continue
+            if not os.path.exists(self._path(seq, "idx")):
+                self._write_index(seq, self._scan(seq)[0])
+            sealed.append(Segment(seq, self._path(seq, "dat"), self._path(seq, "idx")))
+        self._sealed = sealed
+        self._active_seq = active
+        self._active, end = self._scan(active)
+        self._file = open(self._path(active, "dat"), "ab")
+        if self._file.tell() > end:
+            self._file.truncate(end)   # drop a torn record left by a crash
+            self._file.seek(end)
+        self._size = end
+
+    # =========================
+    # WRITES
+    # =========================
+    def _append(self, op, key, data=b""):
+        raw = key.encode("utf-8")
+        head = ENTRY_HEADER.pack(op, len(raw)) + raw
+        length = len(head) + len(data)
+        # Two writes instead of concatenating: the image is never copied
+        header = RECORD_HEADER.pack(RECORD_MAGIC, length, zlib.crc32(data, zlib.crc32(head)))
+        with self._lock:
+            if self._size and self._size + RECORD_HEADER.size + length > self.segment_bytes:
+                self._roll()
+            offset = self._size
+            self._file.write(header + head)
+            self._file.write(data)
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+            self._size += RECORD_HEADER.size + length
+            self._active[key] = (offset, offset + RECORD_HEADER.size + len(head), len(data), op)
+
+    def put(self, key, data):
+        self._append(OP_PUT, key, data)
+        return len(data)
+
+    def delete(self, key):
+        if self._find(key) is None:
+            return False
+        self._append(OP_DELETE, key)
+        return True
+
+    def _roll(self):
+        """Seal the active segment and start the next one; caller holds the lock"""
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        seq = self._active_seq
+        self._write_index(seq, self._active)
+        self._sealed = self._sealed + [Segment(seq, self._path(seq, "dat"), self._path(seq, "idx"))]
+        self._active_seq = seq + 1
+        self._active = {}
+        self._active_map = None
+        self._file = open(self._path(self._active_seq, "dat"), "ab")
+        self._size = 0
+        if self._maintainer is None or not self._maintainer.is_alive():
+            self._maintainer = threading.Thread(target=self.maintain, name="segment-compact", daemon=True)
+            self._maintainer.start()
+
+    def flush(self):
+        with self._lock:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    # =========================
+    # READS
+    # =========================
+    def _find(self, key, before=None, puts_only=False):
+        """(segment or None for the active one, record offset, data offset, length) of the
+        newest live version of key, or None if it is absent or deleted
+
+        before limits the search to sealed segments older than that seq.
+        """
+        if before is None:
+            with self._lock:
+                entry = self._active.get(key)
+                sealed = self._sealed
+            if entry is not None:
+                if entry[3] == OP_DELETE:
+                    return None
+                return None, entry[0], entry[1], entry[2]
+        else:
+            sealed = [s for s in self._sealed if s.seq < before]
+        h = group_hash(group_of(key))
+        for segment in reversed(sealed):
+            for offset, length, op in segment.find(h):
+                found, _, data_offset = read_key(segment.data, offset)
+                if found != key:
+                    continue
+                if op == OP_DELETE:
+                    if puts_only:
+                        break
+                    return None
+                return segment, offset, data_offset, length
+        return None
+
+    def _active_buffer(self, end):
+        """mmap of the active segment covering end bytes; remapped as it grows"""
+        with self._lock:
+            if self._active_map is None or len(self._active_map) < end:
+                self._file.flush()
+                self._active_map = _map(self._path(self._active_seq, "dat"))
+            return self._active_map
+
+    def view(self, key):
+        """memoryview of the stored bytes straight out of the page cache, or None"""
+        with self._lock:   # the active segment must not roll between the lookup and the map
+            found = self._find(key)
+            if found is None:
+                return None
+            segment, _, data_offset, length = found
+            buf = segment.data if segment is not None else self._active_buffer(data_offset + length)
+        return memoryview(buf)[data_offset:data_offset + length]
+
+    def get(self, key):
+        view = self.view(key)
+        return None if view is None else view.tobytes()
+
+    def exists(self, key):
+        return self._find(key) is not None
+
+    def locate(self, key):
+        """(segment file path, offset, length) for callers that send the range themselves"""
+        with self._lock:
+            found = self._find(key)
+            if found is None:
+                return None
+            segment, _, data_offset, length = found
+            if segment is None:
+                self._file.flush()
+                return self._path(self._active_seq, "dat"), data_offset, length
+            return segment.data_path, data_offset, length
+
+    def sendfile(self, key, out_fd):
+        """Copy the stored bytes to a socket / file descriptor in the kernel; bytes sent or None"""
+        where = self.locate(key)
+        if where is None:
+            return None
+        path, offset, length = where
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            sent = 0
+            while sent < length:
+                n = os.sendfile(out_fd, fd, offset + sent, length - sent)
+                if n == 0:
+                    break
+                sent += n
+            return sent
+        finally:
+            os.close(fd)
+
+    def keys(self, prefix=""):
+        """Sorted live keys starting with prefix; "FOLDER/" prefixes use the index, others scan"""
+        with self._lock:
+            candidates = set(self._active)
+            sealed = self._sealed
+        if prefix.endswith("/"):
+            group = prefix[:-1]
+            candidates = {k for k in candidates if group_of(k) == group}
+            h = group_hash(group)
+            for segment in sealed:
+                candidates.update(read_key(segment.data, offset)[0] for offset, _, _ in segment.find(h))
+        else:
+            for segment in sealed:
+                candidates.update(read_key(segment.data, offset)[0] for offset, _, _ in segment.entries())
+        return sorted(k for k in candidates if k.startswith(prefix) and self.exists(k))
+
+    # =========================
+    # COMPACTION / RETENTION
+    # =========================
+    def _is_live(self, segment, key, offset, op):
+        """Whether an entry still decides what key reads as"""
+        if op == OP_PUT:
+            found = self._find(key)
+            return found is not None and found[0] is segment and found[1] == offset
+        # A tombstone matters while it is the newest word on the key and an older put still exists
+        newest = self._active.get(key)
+        if newest is not None:
+            return False
+        for later in reversed(self._sealed):
+            if later.seq <= segment.seq:
+                break
+            if any(read_key(later.data, o)[0] == key for o, _, _ in later.find(group_hash(group_of(key)))):
+                return False
+        return self._find(key, before=segment.seq, puts_only=True) is not None
+
+    def compact_segment(self, segment):
+        """Copy the live entries of a sealed segment forward and drop it; dead bytes reclaimed"""
+        copied = 0
+        for offset, length, op in list(segment.entries()):
+            key, _, data_offset = read_key(segment.data, offset)
+            with self._lock:
+                # re-checked under the lock so a concurrent put of the same key is never overwritten
+                if self._is_live(segment, key, offset, op):
+                    self._append(op, key, memoryview(segment.data)[data_offset:data_offset + length])
+                    copied += RECORD_HEADER.size + (data_offset - offset - RECORD_HEADER.size) + length
+        self._drop(segment)
+        reclaimed = max(segment.size - copied, 0)
+        COMPACTED_BYTES.inc(reclaimed)
+        return reclaimed
+
+    def _drop(self, segment):
+        with self._lock:
+            if segment not in self._sealed:
+                return
+            self._sealed = [s for s in self._sealed if s is not segment]
+        # The maps are left to the GC: callers may still hold memoryviews into them
+        for path in (segment.index_path, segment.data_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def dead_ratio(self, segment):
+        live = 0
+        for offset, length, op in segment.entries():
+            key, _, data_offset = read_key(segment.data, offset)
+            with self._lock:
+                if self._is_live(segment, key, offset, op):
+                    live += data_offset - offset + length
+        return 1.0 - live / segment.size if segment.size else 1.0
+
+    def compact(self, ratio=None):
+        """Compact every sealed segment whose dead share is at least ratio; bytes reclaimed"""
+        ratio = self.compact_ratio if ratio is None else ratio
+        reclaimed = 0
+        for segment in list(self._sealed):
+            if self.dead_ratio(segment) >= ratio:
+                reclaimed += self.compact_segment(segment)
+        return reclaimed
+
+    def enforce_limit(self):
+        """Drop the oldest sealed segments while the store is over max_bytes"""
+        while self.max_bytes and self._sealed and self.total_bytes() > self.max_bytes:
+            EVICTED_SEGMENTS.inc()
+            self._drop(self._sealed[0])
+
+    def maintain(self):
+        """Retention then compaction; a no-op while another pass is running"""
+        if not self._maintaining.acquire(blocking=False):
+            return
+        try:
+            self.enforce_limit()
+            self.compact()
+        except Exception as e:
+            print(f"[ERROR] Segment maintenance {self.root}: {e}")
+        finally:
+            self._maintaining.release()
+
+    def total_bytes(self):
+        return sum(s.size for s in self._sealed) + self._size
+
+    def stats(self):
+        return {
+            "root": self.root,
+            "segments": len(self._sealed) + 1,
+            "bytes": self.total_bytes(),
+            "active_entries": len(self._active),
+            "sealed_entries": sum(s.count for s in self._sealed),
+        }
+
+
+def pack_folders(src, store):
+    """Import an existing downloads-style directory (event folders and loose images)"""
+    count = 0
+    for dirpath, _, filenames in os.walk(src):
+        rel = os.path.relpath(dirpath, src).replace(os.sep, "/")
+        for name in sorted(filenames):
+            with open(os.path.join(dirpath, name), "rb") as f:
+                store.put(name if rel == "." else f"{rel}/{name}", f.read())
+            count += 1
+    store.flush()
+    return count
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="Segment store maintenance")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    stats = sub.add_parser("stats", help="segment count and sizes")
+    stats.add_argument('root')
+    compact = sub.add_parser("compact", help="rewrite segments with dead entries")
+    compact.add_argument('root')
+    compact.add_argument('--ratio', type=float, default=SEGMENT_STORE_COMPACT_RATIO)
+    pack = sub.add_parser("pack", help="import event folders into a store")
+    pack.add_argument('src')
+    pack.add_argument('root')
+    args = parser.parse_args(argv)
+
+    try:
+        store = SegmentStore(args.root)
+    except StoreLocked as e:
+        print(f"[ERROR] {e}; stop the server using it first")
+        return 1
+    if args.cmd == "stats":
+        print(json.dumps(store.stats(), indent=2))
+    elif args.cmd == "compact":
+        print(f"[OK] reclaimed {store.compact(args.ratio)} bytes")
+    else:
+        print(f"[OK] packed {pack_folders(args.src, store)} files into {args.root}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
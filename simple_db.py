@@ -5,99 +5,157 @@ Without ORM complexity - using direct SQL
 import sqlite3
 import json
 import os
+import glob
+import queue
+import re
+import threading
 from datetime import datetime
 from contextlib import contextmanager
+from migrations import run_migrations, SQLITE_MIGRATIONS
+from metrics import Gauge, DB_CONNECTIONS_OPENED, DB_ERRORS
+from records import (DETECTION_COLUMNS, WEBHOOK_COLUMNS, JOURNEY_COLUMNS, record_type, select_columns,
+                     build_filters, journey_filters)
 
 DB_FILE = "vehicle_detection.db"
 
+# Tuned mode: WAL journal, synchronous=NORMAL and long-lived pooled
+# connections. Set SQLITE_TUNED=0 to get the old connect-per-call behaviour.
+SQLITE_TUNED = os.getenv('SQLITE_TUNED', '1') != '0'
+SQLITE_POOL_SIZE = int(os.getenv('SQLITE_POOL_SIZE', '8'))
+SQLITE_CACHE_KB = int(os.getenv('SQLITE_CACHE_KB', '20000'))
+SQLITE_MMAP_BYTES = int(os.getenv('SQLITE_MMAP_BYTES', str(256 * 1024 * 1024)))
+
+# SQLITE_LAYOUT=monthly stores one DB file per month under SQLITE_DIR and
+# deletes files older than SQLITE_RETENTION_MONTHS (0 = keep forever).
+SQLITE_LAYOUT = os.getenv('SQLITE_LAYOUT', 'single')
+SQLITE_DIR = os.getenv('SQLITE_DIR', '.')
+SQLITE_RETENTION_MONTHS = int(os.getenv('SQLITE_RETENTION_MONTHS', '0'))
+
+def _sqlite_ts(value):
+    """datetime -> the 'YYYY-MM-DD HH:MM:SS' text CURRENT_TIMESTAMP produces"""
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+    return value
+
 class Database:
-    def __init__(self, db_file=DB_FILE):
+    def __init__(self, db_file=DB_FILE, tuned=SQLITE_TUNED, pool_size=SQLITE_POOL_SIZE):
         self.db_file = db_file
-        self.init_db()
+        self.tuned = tuned
+        # Idle connections, reused LIFO so the hottest statement caches stay warm.
+        # Flask runs each request on a fresh thread, so a per-thread connection
+        # would be opened and thrown away per request; a shared pool is not.
+        self._pool = queue.LifoQueue(maxsize=pool_size)
+        # Migrations run on first use, so importing this module opens no file
+        self._ready = False
+        self._init_lock = threading.Lock()
+    
+    def _connect(self):
+        """Open a connection, applying the tuned PRAGMAs when enabled"""
+        DB_CONNECTIONS_OPENED.inc(backend="sqlite")
+        if not self.tuned:
+            conn = sqlite3.connect(self.db_file)
+            conn.row_factory = sqlite3.Row
+            return conn
+        conn = sqlite3.connect(self.db_file, timeout=30, check_same_thread=False,
+                               cached_statements=256)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        conn.execute(f'PRAGMA cache_size=-{SQLITE_CACHE_KB}')
+        conn.execute(f'PRAGMA mmap_size={SQLITE_MMAP_BYTES}')
+        return conn
     
     @contextmanager
     def get_connection(self):
-        """Context manager for database connections"""
-        conn = sqlite3.connect(self.db_file)
-        conn.row_factory = sqlite3.Row
+        """Context manager for database connections (one commit per block)"""
+        if not self._ready:
+            self.ensure_ready()
+        with self._connection() as conn:
+            yield conn
+    
+    @contextmanager
+    def _connection(self):
+        if self.tuned:
+            try:
+                conn = self._pool.get_nowait()
+            except queue.Empty:
+                conn = self._connect()
+        else:
+            conn = self._connect()
         try:
             yield conn
             conn.commit()
         except Exception as e:
             conn.rollback()
+            DB_ERRORS.inc(backend="sqlite", op="transaction")
             raise e
         finally:
-            conn.close()
+            if self.tuned:
+                try:
+                    self._pool.put_nowait(conn)
+                except queue.Full:
+                    conn.close()
+            else:
+                conn.close()
     
-    def init_db(self):
-        """Create tables if they don't exist"""
+    def ping(self):
+        """Round-trip a trivial query; raises if the DB is unusable"""
         with self.get_connection() as conn:
-            cursor = conn.cursor()
-            
-            # WebhookEvents table
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS webhook_events (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    event_id TEXT UNIQUE NOT NULL,
-                    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-                    event_type TEXT,
-                    data TEXT,
-                    image_filename TEXT,
-                    vehicle_data TEXT,
-                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-            
-            # VehicleDetections table
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS vehicle_detections (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    event_id TEXT NOT NULL,
-                    license_plate TEXT,
-                    vehicle_type TEXT,
-                    confidence REAL,
-                    detection_data TEXT,
-                    image_url TEXT,
-                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-            
-            # ServerLogs table
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS server_logs (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    level TEXT NOT NULL,
-                    message TEXT NOT NULL,
-                    endpoint TEXT,
-                    status_code INTEGER,
-                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-            
-            conn.commit()
+            conn.execute('SELECT 1').fetchone()
+    
+    def close(self):
+        """Close all pooled connections"""
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                break
+    
+    def init_db(self):
+        """Apply pending schema migrations (tables are never dropped)"""
+        with self._connection() as conn:
+            run_migrations(conn, SQLITE_MIGRATIONS, 'sqlite')
             print(f"Database initialized: {self.db_file}")
     
+    def ensure_ready(self):
+        """Run init_db once, on the first use of the database"""
+        with self._init_lock:
+            if not self._ready:
+                self.init_db()
+                self._ready = True
+    
     def add_webhook_event(self, event_id, event_type, data, vehicle_data=None, image_filename=None):
-        """Add a webhook event"""
+        """Add a webhook event; an event_id already stored (a camera resend) is ignored"""
         with self.get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute('''
-                INSERT INTO webhook_events (event_id, event_type, data, vehicle_data, image_filename)
+                INSERT OR IGNORE INTO webhook_events (event_id, event_type, data, vehicle_data, image_filename)
                 VALUES (?, ?, ?, ?, ?)
             ''', (event_id, event_type, json.dumps(data) if data else None, 
                   json.dumps(vehicle_data) if vehicle_data else None, image_filename))
-            conn.commit()
     
-    def add_vehicle_detection(self, event_id, license_plate, detection_data, image_url, vehicle_type=None, confidence=None):
-        """Add a vehicle detection record"""
+    def add_vehicle_detection(self, event_id, license_plate, detection_data, image_url, vehicle_type=None, confidence=None,
+                              camera=None):
+        """Add a vehicle detection record; an event_id already stored (a camera resend) is ignored"""
         with self.get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute('''
-                INSERT INTO vehicle_detections (event_id, license_plate, vehicle_type, confidence, detection_data, image_url)
-                VALUES (?, ?, ?, ?, ?, ?)
+                INSERT OR IGNORE INTO vehicle_detections (event_id, license_plate, vehicle_type, confidence, detection_data, image_url, camera)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
             ''', (event_id, license_plate, vehicle_type, confidence, 
-                  json.dumps(detection_data) if detection_data else None, image_url))
-            conn.commit()
+                  json.dumps(detection_data) if detection_data else None, image_url, camera))
+    
+    def add_vehicle_detections_bulk(self, rows):
+        """Insert many vehicle detections in one transaction; duplicate event_ids are ignored"""
+        with self.get_connection() as conn:
+            conn.executemany('''
+                INSERT OR IGNORE INTO vehicle_detections
+                    (event_id, license_plate, vehicle_type, confidence, detection_data, image_url, camera, created_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP))
+            ''', [(r["event_id"], r.get("license_plate"), r.get("vehicle_type"), r.get("confidence"),
+                   json.dumps(r["detection_data"], default=str) if r.get("detection_data") else None,
+                   r.get("image_url"), r.get("camera"), _sqlite_ts(r.get("created_at"))) for r in rows])
     
     def get_webhook_events(self, limit=20):
         """Get recent webhook events"""
@@ -108,8 +166,7 @@ class Database:
                 ORDER BY created_at DESC
                 LIMIT ?
             ''', (limit,))
-            rows = cursor.fetchall()
-            return [dict(row) for row in rows]
+            return [dict(row) for row in cursor]
     
     def get_vehicle_detections(self, limit=50):
         """Get recent vehicle detections"""
@@ -120,8 +177,46 @@ class Database:
                 ORDER BY created_at DESC
                 LIMIT ?
             ''', (limit,))
-            rows = cursor.fetchall()
-            return [dict(row) for row in rows]
+            return [dict(row) for row in cursor]
+    
+    def _iter_query(self, sql, params, columns, batch_size, records):
+        """Run a SELECT and yield plain tuples (or records) batch_size rows at a time"""
+        make = record_type(columns)._make if records else None
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.row_factory = None   # plain tuples, cheaper than sqlite3.Row
+            try:
+                cursor.execute(sql, params)
+                while True:
+                    rows = cursor.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    if make is None:
+                        yield from rows
+                    else:
+                        for row in rows:
+                            yield make(row)
+            finally:
+                cursor.close()
+    
+    def iter_vehicle_detections(self, since=None, until=None, camera=None, batch_size=1000,
+                                columns=None, plate=None, records=False):
+        """Yield detections in created_at order without materializing the result
+
+        Rows are tuples in columns order, or namedtuple records with
+        records=True; until is exclusive.
+        """
+        columns = select_columns(columns, DETECTION_COLUMNS)
+        where, params = build_filters('?', _sqlite_ts(since), _sqlite_ts(until), camera, plate)
+        sql = f"SELECT {', '.join(columns)} FROM vehicle_detections{where} ORDER BY created_at, id"
+        return self._iter_query(sql, params, columns, batch_size, records)
+    
+    def iter_webhook_events(self, since=None, until=None, batch_size=1000, columns=None, records=False):
+        """Yield webhook events in created_at order without materializing the result"""
+        columns = select_columns(columns, WEBHOOK_COLUMNS)
+        where, params = build_filters('?', _sqlite_ts(since), _sqlite_ts(until))
+        sql = f"SELECT {', '.join(columns)} FROM webhook_events{where} ORDER BY created_at, id"
+        return self._iter_query(sql, params, columns, batch_size, records)
     
     def get_vehicle_by_plate(self, plate):
         """Get all detections for a specific plate"""
@@ -132,8 +227,30 @@ class Database:
                 WHERE license_plate = ?
                 ORDER BY created_at DESC
             ''', (plate,))
-            rows = cursor.fetchall()
-            return [dict(row) for row in rows]
+            return [dict(row) for row in cursor]
+    
+    def get_watchlist(self):
+        """All watchlist entries"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT plate, list_type, note FROM watchlist ORDER BY id')
+            return [dict(row) for row in cursor]
+    
+    def add_journeys(self, rows):
+        """Insert completed journeys; journeys already stored are ignored"""
+        with self.get_connection() as conn:
+            conn.executemany(f'''
+                INSERT OR IGNORE INTO journeys ({', '.join(JOURNEY_COLUMNS)})
+                VALUES ({', '.join('?' * len(JOURNEY_COLUMNS))})
+            ''', [tuple(_sqlite_ts(r.get(c)) for c in JOURNEY_COLUMNS) for r in rows])
+    
+    def get_journeys(self, since=None, until=None, plate_key=None, status=None, limit=100):
+        """Most recently ended journeys first"""
+        where, params = journey_filters('?', _sqlite_ts(since), _sqlite_ts(until), plate_key, status)
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f"SELECT * FROM journeys{where} ORDER BY ended_at DESC LIMIT ?", params + [limit])
+            return [dict(row) for row in cursor]
     
     def add_server_log(self, level, message, endpoint=None, status_code=None):
         """Add a server log"""
@@ -143,7 +260,167 @@ class Database:
                 INSERT INTO server_logs (level, message, endpoint, status_code)
                 VALUES (?, ?, ?, ?)
             ''', (level, message, endpoint, status_code))
-            conn.commit()
+
+class MonthlyDatabase:
+    """One SQLite file per month: vehicle_detection_YYYYMM.db
+
+    Writes go to the current month's file, reads walk the files newest
+    first, and retention deletes whole expired files instead of rows. The
+    watchlist is not time series data, so it lives in a file that never
+    rotates: vehicle_detection_watchlist.db
+    """
+    FILE_RE = re.compile(r'_(\d{6})\.db$')
+
+    def __init__(self, db_dir=SQLITE_DIR, prefix="vehicle_detection", retention_months=SQLITE_RETENTION_MONTHS):
+        self.db_dir = db_dir
+        self.prefix = prefix
+        self.retention_months = retention_months
+        self._dbs = {}
+        self._current_month = None
+        self._lock = threading.Lock()
+        os.makedirs(db_dir, exist_ok=True)
+        self.watchlist_db = Database(os.path.join(db_dir, f"{prefix}_watchlist.db"))
+        self.current()
+    
+    def _path(self, month):
+        return os.path.join(self.db_dir, f"{self.prefix}_{month}.db")
+    
+    def _month(self, month):
+        with self._lock:
+            if month not in self._dbs:
+                self._dbs[month] = Database(self._path(month))
+            return self._dbs[month]
+    
+    def current(self):
+        """Database for the current month; rolling over also applies retention"""
+        month = datetime.now().strftime('%Y%m')
+        if month != self._current_month:
+            self._current_month = month
+            self.drop_expired()
+        return self._month(month)
+    
+    def months(self):
+        """Months that have a DB file, newest first"""
+        found = set()
+        for path in glob.glob(os.path.join(self.db_dir, f"{self.prefix}_*.db")):
+            m = self.FILE_RE.search(path)
+            if m:
+                found.add(m.group(1))
+        return sorted(found, reverse=True)
+    
+    def _collect(self, fetch, limit=None):
+        rows = []
+        for month in self.months():
+            remaining = None if limit is None else limit - len(rows)
+            if remaining is not None and remaining <= 0:
+                break
+            rows.extend(fetch(self._month(month), remaining))
+        return rows
+    
+    def drop_expired(self):
+        """Delete month files older than the retention window"""
+        if self.retention_months <= 0:
+            return []
+        now = datetime.now()
+        oldest = (now.year * 12 + now.month - 1) - self.retention_months
+        dropped = []
+        for month in self.months():
+            if int(month[:4]) * 12 + int(month[4:]) - 1 < oldest:
+                with self._lock:
+                    old = self._dbs.pop(month, None)
+                if old:
+                    old.close()
+                for suffix in ("", "-wal", "-shm"):
+                    if os.path.exists(self._path(month) + suffix):
+                        os.remove(self._path(month) + suffix)
+                dropped.append(month)
+        if dropped:
+            print(f"Dropped expired month files: {dropped}")
+        return dropped
+    
+    def ping(self):
+        """Round-trip a trivial query on the current month's file"""
+        self.current().ping()
+    
+    def add_webhook_event(self, event_id, event_type, data, vehicle_data=None, image_filename=None):
+        """Add a webhook event"""
+        self.current().add_webhook_event(event_id, event_type, data, vehicle_data, image_filename)
+    
+    def add_vehicle_detection(self, event_id, license_plate, detection_data, image_url, vehicle_type=None, confidence=None,
+                              camera=None):
+        """Add a vehicle detection record"""
+        self.current().add_vehicle_detection(event_id, license_plate, detection_data, image_url, vehicle_type, confidence,
+                                             camera)
+    
+    def add_vehicle_detections_bulk(self, rows):
+        """Insert many vehicle detections, each into the file of its created_at month"""
+        by_month = {}
+        for r in rows:
+            created = r.get("created_at")
+            month = created.strftime('%Y%m') if created else datetime.now().strftime('%Y%m')
+            by_month.setdefault(month, []).append(r)
+        for month, month_rows in by_month.items():
+            self._month(month).add_vehicle_detections_bulk(month_rows)
+    
+    def get_watchlist(self):
+        """All watchlist entries (kept in the fixed watchlist file)"""
+        return self.watchlist_db.get_watchlist()
+    
+    def add_journeys(self, rows):
+        """Insert journeys, each into the file of the month it ended in"""
+        by_month = {}
+        for r in rows:
+            by_month.setdefault(r["ended_at"].strftime('%Y%m'), []).append(r)
+        for month, month_rows in by_month.items():
+            self._month(month).add_journeys(month_rows)
+    
+    def get_journeys(self, since=None, until=None, plate_key=None, status=None, limit=100):
+        """Most recently ended journeys first, newest month first"""
+        rows = []
+        for month in reversed(self._months_between(since, until)):
+            if len(rows) >= limit:
+                break
+            rows.extend(self._month(month).get_journeys(since, until, plate_key, status, limit - len(rows)))
+        return rows
+    
+    def add_server_log(self, level, message, endpoint=None, status_code=None):
+        """Add a server log"""
+        self.current().add_server_log(level, message, endpoint, status_code)
+    
+    def get_webhook_events(self, limit=20):
+        """Get recent webhook events"""
+        return self._collect(lambda d, n: d.get_webhook_events(limit=n), limit)
+    
+    def get_vehicle_detections(self, limit=50):
+        """Get recent vehicle detections"""
+        return self._collect(lambda d, n: d.get_vehicle_detections(limit=n), limit)
+    
+    def _months_between(self, since, until):
+        """Month files overlapping [since, until), oldest first"""
+        first = since.strftime('%Y%m') if since else None
+        last = until.strftime('%Y%m') if until else None
+        return [m for m in reversed(self.months())
+                if not (first and m < first) and not (last and m > last)]
+    
+    def iter_vehicle_detections(self, since=None, until=None, camera=None, batch_size=1000,
+                                columns=None, plate=None, records=False):
+        """Yield detections oldest month first, skipping files outside [since, until)"""
+        for month in self._months_between(since, until):
+            yield from self._month(month).iter_vehicle_detections(
+                since, until, camera, batch_size, columns, plate, records)
+    
+    def iter_webhook_events(self, since=None, until=None, batch_size=1000, columns=None, records=False):
+        """Yield webhook events oldest month first"""
+        for month in self._months_between(since, until):
+            yield from self._month(month).iter_webhook_events(since, until, batch_size, columns, records)
+    
+    def get_vehicle_by_plate(self, plate):
+        """Get all detections for a specific plate"""
+        return self._collect(lambda d, n: d.get_vehicle_by_plate(plate))
 
 # Initialize global database instance
-db = Database()
+if SQLITE_LAYOUT == 'monthly':
+    db = MonthlyDatabase()
+else:
+    db = Database()
+    Gauge("anpr_sqlite_pool_idle_connections", "Idle pooled SQLite connections", func=db._pool.qsize)
@@ -0,0 +1,272 @@
+"""
+Write-ahead Spool for Vehicle Detection
+Append-only, checksummed segment files that hold events while the DB is
+unavailable, plus a background replayer that drains them in batches
+"""
+import json
+import os
+import struct
+import threading
+import time
+import zlib
+
+SPOOL_DIR = os.getenv('SPOOL_DIR', './spool')
+SPOOL_SEGMENT_BYTES = int(os.getenv('SPOOL_SEGMENT_BYTES', str(64 * 1024 * 1024)))
+SPOOL_FSYNC = os.getenv('SPOOL_FSYNC', '1') != '0'
+
+# Record layout: magic (2) | payload length (4) | crc32 of payload (4) | payload
+RECORD_HEADER = struct.Struct('<2sII')
+RECORD_MAGIC = b'SP'
+
+
+def encode_record(payload):
+    return RECORD_HEADER.pack(RECORD_MAGIC, len(payload), zlib.crc32(payload)) + payload
+
+
+def read_records(path, offset=0, limit=None):
+    """Yield (payload, next_offset) for each valid record from offset
+
+    Stops at the first truncated or corrupt record, which after a crash can
+    only be a torn write at the tail of the segment.
+    """
+    count = 0
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        while limit is None or count < limit:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            magic, length, crc = RECORD_HEADER.unpack(header)
+            if magic != RECORD_MAGIC:
+                return
+            payload = f.read(length)
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                return
+            offset += RECORD_HEADER.size + length
+            count += 1
+            yield payload, offset
+
+
+class Spool:
+    """Durable FIFO of JSON records backed by rolling segment files
+
+    The read position is kept in a checkpoint file that is only advanced
+    after the consumer has committed a batch, so a crash replays at most
+    the last uncommitted batch; consumers must be idempotent.
+    """
+
+    def __init__(self, spool_dir=SPOOL_DIR, segment_bytes=SPOOL_SEGMENT_BYTES, fsync=SPOOL_FSYNC):
+        self.spool_dir = spool_dir
+        self.segment_bytes = segment_bytes
+        self.fsync = fsync
+        self.checkpoint_file = os.path.join(spool_dir, 'checkpoint')
+        self.rejected_file = os.path.join(spool_dir, 'rejected.jsonl')
+        self._lock = threading.Lock()
+        self._writer = None
+        self._write_seq = None
+        os.makedirs(spool_dir, exist_ok=True)
+        self._read_seq, self._read_offset = self._load_checkpoint()
+
+    def _segment_path(self, seq):
+        return os.path.join(self.spool_dir, f"segment_{seq:012d}.log")
+
+    def segments(self):
+        seqs = []
+        for name in os.listdir(self.spool_dir):
+            if name.startswith('segment_') and name.endswith('.log'):
+                try:
+                    seqs.append(int(name[8:-4]))
+                except ValueError:
+                    pass
+        return sorted(seqs)
+
+    def _load_checkpoint(self):
+        try:
+            with open(self.checkpoint_file) as f:
+                seq, offset = f.read().split()
+                return int(seq), int(offset)
+        except (OSError, ValueError):
+            segments = self.segments()
+            return (segments[0] if segments else 0), 0
+
+    def _save_checkpoint(self, seq, offset):
+        tmp = self.checkpoint_file + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(f"{seq} {offset}")
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+        os.replace(tmp, self.checkpoint_file)
+
+    # ---- producer ----
+    def append(self, record):
+        """Durably append one JSON-serializable record"""
+        self.append_bytes(json.dumps(record, default=str).encode('utf-8'))
+
+    def append_bytes(self, payload):
+        self.append_many([payload])
+
+    def append_many(self, payloads):
+        """Append several encoded payloads with one write and one fsync (group commit)"""
+        data = b''.join(encode_record(p) for p in payloads)
+        if not data:
+            return
+        with self._lock:
+            if self._writer is None or self._writer.tell() + len(data) > self.segment_bytes:
+                self._roll()
+            self._writer.write(data)
+            self._writer.flush()
+            if self.fsync:
+                os.fsync(self._writer.fileno())
+
+    def _roll(self):
+        if self._writer is not None:
+            self._writer.close()
+        segments = self.segments()
+        # Always start a fresh segment: an existing tail may end in a torn record
+        self._write_seq = max(segments[-1] + 1 if segments else 0, self._read_seq)
+        self._writer = open(self._segment_path(self._write_seq), 'ab')
+
+    # ---- consumer ----
+    def read_batch(self, max_records=500):
+        """Return (payloads, position) from the checkpoint onwards, without consuming them"""
+        payloads = []
+        seq, offset = self._read_seq, self._read_offset
+        for s in self.segments():
+            if s < seq:
+                continue
+            if s > seq:
+                seq, offset = s, 0
+            path = self._segment_path(s)
+            for payload, offset in read_records(path, offset, max_records - len(payloads)):
+                payloads.append(payload)
+            if len(payloads) >= max_records:
+                break
+            # Only move past a segment once the writer has moved on from it
+            with self._lock:
+                if s == self._write_seq:
+                    break
+        return payloads, (seq, offset)
+
+    def commit(self, position):
+        """Mark everything before position as consumed and delete drained segments"""
+        seq, offset = position
+        self._save_checkpoint(seq, offset)
+        self._read_seq, self._read_offset = seq, offset
+        for s in self.segments():
+            if s < seq:
+                try:
+                    os.remove(self._segment_path(s))
+                except OSError:
+                    pass
+
+    def backlog_bytes(self):
+        """Bytes not yet committed by the consumer"""
+        total = 0
+        for s in self.segments():
+            if s < self._read_seq:
+                continue
+            try:
+                size = os.path.getsize(self._segment_path(s))
+            except OSError:
+                continue
+            total += size - (self._read_offset if s == self._read_seq else 0)
+        return total
+
+    # ---- dead letters ----
+    def reject(self, payloads):
+        """Set aside records that can never be applied, one JSON line each, for inspection"""
+        with self._lock:
+            with open(self.rejected_file, 'ab') as f:
+                f.write(b'\n'.join(payloads) + b'\n')
+                f.flush()
+                if self.fsync:
+                    os.fsync(f.fileno())
+
+    def close(self):
+        with self._lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+
+
+class SpoolReplayer:
+    """Background thread that drains a spool into a sink in large batches
+
+    sink(records) receives decoded records and must raise on failure; the
+    batch is then retried with exponential backoff. With transient(error)
+    given, only failures it accepts are retried: a batch failing any other
+    way is split until the records causing it are found, and those are set
+    aside with spool.reject() so they cannot block the records behind them.
+    """
+
+    def __init__(self, spool, sink, batch_size=500, idle_interval=2.0, max_backoff=60.0, decode=json.loads,
+                 transient=None):
+        self.spool = spool
+        self.sink = sink
+        self.batch_size = batch_size
+        self.idle_interval = idle_interval
+        self.max_backoff = max_backoff
+        self.decode = decode
+        self.transient = transient
+        self.replayed = 0
+        self.rejected = 0
+        self.failures = 0
+        self.last_error = None
+        self._wake = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="spool-replayer", daemon=True)
+            self._thread.start()
+        return self
+
+    def wake(self):
+        self._wake.set()
+
+    def drain_once(self):
+        """Replay one batch; returns the number of records committed"""
+        payloads, position = self.spool.read_batch(self.batch_size)
+        if not payloads:
+            return 0
+        rejected = self.rejected
+        self._deliver(payloads)
+        self.spool.commit(position)
+        self.replayed += len(payloads) - (self.rejected - rejected)
+        return len(payloads)
+
+    def _deliver(self, payloads):
+        # Halves of a batch that already went in are sent again if the other
+        # half then fails transiently; sinks are idempotent (see Spool)
+        try:
+            self.sink([self.decode(p) for p in payloads])
+            return
+        except Exception as e:
+            if self.transient is None or self.transient(e):
+                raise
+            if len(payloads) == 1:
+                self.spool.reject(payloads)
+                self.rejected += 1
+                print(f"[SPOOL] Record set aside in {self.spool.rejected_file}: {e}")
+                return
+        mid = len(payloads) // 2
+        self._deliver(payloads[:mid])
+        self._deliver(payloads[mid:])
+
+    def _run(self):
+        backoff = self.idle_interval
+        while True:
+            try:
+                if self.drain_once():
+                    backoff = self.idle_interval
+                    continue
+            except Exception as e:
+                self.failures += 1
+                self.last_error = str(e)
+                print(f"[SPOOL] Replay failed, retrying in {backoff:.0f}s: {e}")
+                time.sleep(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+                continue
+            self._wake.wait(self.idle_interval)
+            self._wake.clear()
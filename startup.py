@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""
+Startup Budget
+After a crash the cameras keep sending, and everything they send before the
+listener is up is lost, so a server module's own startup must stay under
+STARTUP_BUDGET_MS. Nothing on that path may wait on the network:
+  - postgres_db / simple_db migrate on first use; a background warm-up does
+    it for Postgres, and writes before it finishes go to the spool
+  - CLI-only and S3-only modules are imported where they are used
+The budget covers everything but the third-party packages the server module
+imports itself (flask, dotenv): those cost the same whatever the server
+does, and are reported separately. StartupTimer marks the phases of a
+server's import and reports the total (anpr_startup_seconds); over budget it
+names the slowest phases. The CLI imports a server in a fresh interpreter,
+takes the same phases out of -X importtime, and fails when over budget:
+
+    python startup.py anpr_server_combined
+"""
+import importlib.util
+import os
+import sys
+import time
+
+STARTUP_BUDGET_MS = float(os.getenv('STARTUP_BUDGET_MS', '200'))
+
+
+class StartupTimer:
+    """Wall-clock phases of a server module's import"""
+
+    def __init__(self, name, budget_ms=STARTUP_BUDGET_MS):
+        self.name = name
+        self.budget_ms = budget_ms
+        self.started = self._last = time.perf_counter()
+        self.phases = []   # (phase, ms, budgeted)
+
+    def mark(self, phase, budgeted=True):
+        """End a phase; budgeted=False for the server's own third-party imports"""
+        now = time.perf_counter()
+        self.phases.append((phase, (now - self._last) * 1000, budgeted))
+        self._last = now
+
+    def done(self):
+        """Report the total and the budgeted part; returns the budgeted ms"""
+        from metrics import Gauge
+        total = (time.perf_counter() - self.started) * 1000
+        external = sum(ms for _, ms, budgeted in self.phases if not budgeted)
+        own = total - external
+        Gauge("anpr_startup_seconds", "Time from import to ready to serve",
+              func=lambda: round(total / 1000, 4))
+        if own <= self.budget_ms:
+            print(f"[OK] {self.name} ready in {total:.0f} ms ({own:.0f} ms own, budget {self.budget_ms:.0f} ms)")
+        else:
+            slowest = sorted((p for p in self.phases if p[2]), key=lambda p: p[1], reverse=True)[:3]
+            print(f"[ERROR] {self.name} took {own:.0f} ms to start (budget {self.budget_ms:.0f} ms); slowest: "
+                  + ", ".join(f"{phase} {ms:.0f} ms" for phase, ms, _ in slowest))
+        return own
+
+
+def is_third_party(module):
+    """True for a module from an installed package (site-packages), not stdlib or this repo"""
+    top = module.split(".")[0]
+    if top in sys.builtin_module_names:
+        return False
+    try:
+        spec = importlib.util.find_spec(top)
+    except (ImportError, ValueError):
+        return False
+    origin = (spec.origin or "") if spec else ""
+    return "site-packages" in origin or "dist-packages" in origin
+
+
+def import_profile(module, cwd=None):
+    """Import module in a fresh interpreter
+
+    Returns (total ms, {third-party package imported by module itself: ms},
+    [(self ms, cumulative ms, name)]).
+    """
+    import subprocess
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            cwd=cwd, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1] if result.stderr.strip() else "import failed")
+    rows, total, children = [], None, []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        own, cumulative, name = line[len("import time:"):].split("|", 2)
+        # Children are listed before their importer, one level deeper
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        rows.append((int(own) / 1000, int(cumulative) / 1000, name.strip()))
+        children.append((depth, name.strip(), int(cumulative) / 1000))
+        if name.strip() == module:
+            total = int(cumulative) / 1000
+            direct = {}
+            for d, child, ms in reversed(children[:-1]):
+                if d <= depth:
+                    break
+                if d == depth + 1 and is_third_party(child):
+                    direct[child] = ms
+    return total, direct, rows
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="Check a server's import time against the startup budget")
+    parser.add_argument('module', nargs='?', default='anpr_server_combined')
+    parser.add_argument('--budget-ms', type=float, default=STARTUP_BUDGET_MS)
+    parser.add_argument('--top', type=int, default=10, help="slowest imports to list")
+    args = parser.parse_args(argv)
+
+    try:
+        total, external, rows = import_profile(args.module)
+    except RuntimeError as e:
+        print(f"[ERROR] import {args.module}: {e}")
+        return 2
+    for own, cumulative, name in sorted(rows, reverse=True)[:args.top]:
+        print(f"  {own:8.1f} ms self {cumulative:8.1f} ms total  {name}")
+    own = total - sum(external.values())
+    excluded = ", ".join(f"{name} {ms:.0f} ms" for name, ms in sorted(external.items(), key=lambda e: -e[1]))
+    print(f"  {total:.0f} ms in all; not budgeted: {excluded or 'nothing'}")
+    if own > args.budget_ms:
+        print(f"[ERROR] {args.module} imports in {own:.0f} ms, over the {args.budget_ms:.0f} ms budget")
+        return 1
+    print(f"[OK] {args.module} imports in {own:.0f} ms (budget {args.budget_ms:.0f} ms)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
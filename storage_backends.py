@@ -0,0 +1,682 @@
+#!/usr/bin/env python3
+"""
+Storage Backends for Images and JSON Archives
+One put/get/list interface over wherever the ingest writers keep their
+files, chosen with STORAGE_BACKEND:
+  local     one file per object under the existing directories (default)
+  segment   objects packed into rolling segment files under STORAGE_SEGMENT_DIR
+            (segment_store.py); for edge boxes, where creating a directory and
+            a file per image costs more than writing the image
+  s3        an S3-compatible bucket (S3_ENDPOINT, S3_BUCKET, S3_ACCESS_KEY,
+            S3_SECRET_KEY, S3_REGION), SigV4-signed over keep-alive
+            connections; objects over S3_PART_SIZE go up as multipart uploads
+
+Keys are "/"-separated paths relative to the directory the server used to
+write into, e.g. "MH12AB1234_CAM1_1a2b3c/cutout.jpg"; on S3 they are
+prefixed with that directory ("downloads/MH12AB1234_CAM1_1a2b3c/cutout.jpg").
+The S3 backend is wrapped in an UploaderPool, so the camera ack never waits
+on the network.
+
+    python storage_backends.py s3-standin [--port 9000] [--root ./s3_standin]   local S3 stand-in
+    python storage_backends.py ls downloads [--prefix MH12]
+"""
+import hashlib
+import hmac
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from urllib.parse import parse_qsl, quote, unquote, urlsplit
+
+from forwarder import HTTPPool
+from metrics import Counter, Gauge, Histogram
+from segment_store import SegmentStore
+
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'local').lower()
+STORAGE_SEGMENT_DIR = os.getenv('STORAGE_SEGMENT_DIR', './segments')
+STORAGE_UPLOAD_WORKERS = int(os.getenv('STORAGE_UPLOAD_WORKERS', '4'))
+STORAGE_UPLOAD_QUEUE = int(os.getenv('STORAGE_UPLOAD_QUEUE', '256'))
+STORAGE_UPLOAD_RETRIES = int(os.getenv('STORAGE_UPLOAD_RETRIES', '3'))
+# Uploads that still fail after the retries land here and are re-sent at the next start
+STORAGE_UPLOAD_FALLBACK_DIR = os.getenv('STORAGE_UPLOAD_FALLBACK_DIR', './upload_failed')
+
+S3_ENDPOINT = os.getenv('S3_ENDPOINT', 'http://127.0.0.1:9000')
+S3_BUCKET = os.getenv('S3_BUCKET', 'anpr')
+S3_ACCESS_KEY = os.getenv('S3_ACCESS_KEY', '')
+S3_SECRET_KEY = os.getenv('S3_SECRET_KEY', '')
+S3_REGION = os.getenv('S3_REGION', 'us-east-1')
+# S3 requires every part but the last to be at least 5 MiB
+S3_PART_SIZE = max(int(os.getenv('S3_PART_SIZE', str(8 * 1024 * 1024))), 5 * 1024 * 1024)
+S3_POOL_SIZE = int(os.getenv('S3_POOL_SIZE', '8'))
+S3_TIMEOUT = float(os.getenv('S3_TIMEOUT', '10'))
+UNSIGNED_PAYLOAD = "UNSIGNED-PAYLOAD"
+EMPTY_SHA256 = hashlib.sha256(b"").hexdigest()
+
+STORAGE_PUTS = Counter("anpr_storage_puts_total", "Objects written by the upload pool", ("backend", "outcome"))
+STORAGE_PUT_SECONDS = Histogram("anpr_storage_put_seconds", "Time to upload one object", ("backend",),
+                                buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0))
+_POOLS = []
+UPLOADS_PENDING = Gauge("anpr_storage_uploads_pending", "Uploads queued or in flight", ("store",),
+                        func=lambda: {(p.name,): p.pending for p in _POOLS})
+
+_CONTENT_TYPES = {".jpg": "image/jpeg", ".jpeg": "image/jpeg", ".png": "image/png", ".gif": "image/gif",
+                  ".webp": "image/webp", ".json": "application/json"}
+
+
+class StorageError(Exception):
+    """A backend refused or failed a read or write"""
+
+
+def check_key(key):
+    """key unchanged if it is a relative "/"-separated path without . or .. parts"""
+    if not key or key.startswith("/") or "\\" in key or any(p in ("", ".", "..") for p in key.split("/")):
+        raise ValueError(f"invalid storage key {key!r}")
+    return key
+
+
+def store_name(root):
+    """Name of the store for a server directory: its path relative to the working directory"""
+    rel = os.path.relpath(root).replace(os.sep, "/")
+    return os.path.basename(os.path.abspath(root)) if rel.startswith("..") else rel
+
+
+def _content_type(key):
+    return _CONTENT_TYPES.get(os.path.splitext(key)[1].lower(), "application/octet-stream")
+
+
+def _read_full(stream, size):
+    """Up to size bytes; file objects (sockets, werkzeug streams) may return short reads"""
+    chunks, left = [], size
+    while left > 0:
+        chunk = stream.read(left)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        left -= len(chunk)
+    return b"".join(chunks)
+
+
+class Storage:
+    """put/get/exists/delete/list over "/"-separated keys; subclasses do the I/O"""
+    kind = "base"
+    name = ""
+
+    def put(self, key, data):
+        """Store bytes under key, replacing any previous object; returns the size"""
+        raise NotImplementedError
+
+    def put_stream(self, key, stream, size=None):
+        """Store a file object (e.g. a multipart form upload) read in chunks; returns the size"""
+        return self.put(key, stream.read())
+
+    def get(self, key):
+        """Bytes stored under key, or None"""
+        raise NotImplementedError
+
+    def exists(self, key):
+        return self.get(key) is not None
+
+    def delete(self, key):
+        """True if an object was removed"""
+        raise NotImplementedError
+
+    def list(self, prefix=""):
+        """Sorted keys starting with prefix"""
+        raise NotImplementedError
+
+    def local_path(self, key):
+        """Path of key when it is a plain file on this machine (quota accounting), else None"""
+        return None
+
+    def flush(self, timeout=None):
+        """Wait for buffered writes; True when nothing is left pending"""
+        return True
+
+
+# =========================
+# LOCAL FILESYSTEM
+# =========================
+class LocalStorage(Storage):
+    """One file per key under root, as the servers have always written"""
+    kind = "local"
+
+    def __init__(self, root, fsync=False):
+        self.root = root
+        self.name = store_name(root)
+        self.fsync = fsync
+        os.makedirs(root, exist_ok=True)
+
+    def local_path(self, key):
+        return os.path.join(self.root, *check_key(key).split("/"))
+
+    def _target(self, key):
+        path = self.local_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    def put(self, key, data):
+        with open(self._target(key), "wb") as f:
+            f.write(data)
+            if self.fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        return len(data)
+
+    def put_stream(self, key, stream, size=None):
+        with open(self._target(key), "wb") as f:
+            shutil.copyfileobj(stream, f, 1024 * 1024)
+            if self.fsync:
+                f.flush()
+                os.fsync(f.fileno())
+            return f.tell()
+
+    def get(self, key):
+        try:
+            with open(self.local_path(key), "rb") as f:
+                return f.read()
+        except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+            return None
+
+    def exists(self, key):
+        return os.path.isfile(self.local_path(key))
+
+    def delete(self, key):
+        try:
+            os.remove(self.local_path(key))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def list(self, prefix=""):
+        # Only walk the directory the prefix points into
+        start = os.path.join(self.root, *prefix.split("/")[:-1]) if "/" in prefix else self.root
+        keys = []
+        for dirpath, _, filenames in os.walk(start):
+            rel = os.path.relpath(dirpath, self.root).replace(os.sep, "/")
+            for name in filenames:
+                key = name if rel == "." else f"{rel}/{name}"
+                if key.startswith(prefix):
+                    keys.append(key)
+        return sorted(keys)
+
+
+# =========================
+# SEGMENT FILES
+# =========================
+class SegmentStorage(Storage):
+    """Objects packed into rolling segment files (segment_store.SegmentStore)"""
+    kind = "segment"
+
+    def __init__(self, root, fsync=False):
+        self.root = root
+        self.name = os.path.basename(os.path.normpath(root))
+        self.store = SegmentStore(root, fsync=fsync)
+
+    def put(self, key, data):
+        return self.store.put(check_key(key), data)
+
+    def get(self, key):
+        return self.store.get(key)
+
+    def view(self, key):
+        """Zero-copy memoryview of the object, or None"""
+        return self.store.view(key)
+
+    def exists(self, key):
+        return self.store.exists(key)
+
+    def delete(self, key):
+        return self.store.delete(key)
+
+    def list(self, prefix=""):
+        return self.store.keys(prefix)
+
+    def flush(self, timeout=None):
+        self.store.flush()
+        return True
+
+
+# =========================
+# S3-COMPATIBLE OBJECT STORE
+# =========================
+def canonical_query(query):
+    return "&".join(f"{quote(str(k), safe='-_.~')}={quote(str(v), safe='-_.~')}"
+                    for k, v in sorted((query or {}).items()))
+
+
+def sign_v4(method, host, path, query, headers, payload_hash, access_key, secret_key, region,
+            service="s3", now=None):
+    """headers plus Host, x-amz-date, x-amz-content-sha256 and an AWS Signature V4 Authorization
+
+    path must already be URI-encoded, as sent on the wire; query holds the raw values.
+    """
+    now = now or datetime.now(timezone.utc)
+    amz_date = now.strftime("%Y%m%dT%H%M%SZ")
+    scope = f"{amz_date[:8]}/{region}/{service}/aws4_request"
+    headers = dict(headers or {}, Host=host)
+    headers["x-amz-date"] = amz_date
+    headers["x-amz-content-sha256"] = payload_hash
+    canonical = {k.lower(): " ".join(str(v).split()) for k, v in headers.items()}
+    signed = ";".join(sorted(canonical))
+    request = "\n".join([method, path, canonical_query(query),
+                         "".join(f"{k}:{canonical[k]}\n" for k in sorted(canonical)), signed, payload_hash])
+    to_sign = "\n".join(["AWS4-HMAC-SHA256", amz_date, scope, hashlib.sha256(request.encode()).hexdigest()])
+    key = ("AWS4" + secret_key).encode()
+    for part in (amz_date[:8], region, service, "aws4_request"):
+        key = hmac.new(key, part.encode(), hashlib.sha256).digest()
+    signature = hmac.new(key, to_sign.encode(), hashlib.sha256).hexdigest()
+    headers["Authorization"] = (f"AWS4-HMAC-SHA256 Credential={access_key}/{scope}, "
+                                f"SignedHeaders={signed}, Signature={signature}")
+    return headers
+
+
+def _escape(text):
+    """XML-escape a key or ETag (what xml.sax.saxutils.escape does, without importing urllib.request)"""
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+
+def _xml_texts(body, tag):
+    """Text of every element named tag, ignoring XML namespaces"""
+    if not body:
+        return []
+    from xml.etree import ElementTree   # only S3 responses need it
+    root = ElementTree.fromstring(body)
+    return [el.text or "" for el in root.iter() if el.tag.rsplit("}", 1)[-1] == tag]
+
+
+class S3Storage(Storage):
+    """Objects in an S3-compatible bucket (path-style URLs, as MinIO and Ceph expect)"""
+    kind = "s3"
+
+    def __init__(self, prefix="", bucket=S3_BUCKET, endpoint=S3_ENDPOINT, access_key=S3_ACCESS_KEY,
+                 secret_key=S3_SECRET_KEY, region=S3_REGION, part_size=S3_PART_SIZE,
+                 pool_size=S3_POOL_SIZE, timeout=S3_TIMEOUT):
+        self.prefix = prefix
+        self.name = prefix.rstrip("/") or bucket
+        self.bucket = bucket
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.region = region
+        self.part_size = part_size
+        self.pool = HTTPPool(endpoint, size=pool_size, timeout=timeout)
+        self.base = urlsplit(endpoint).path.rstrip("/")
+
+    def _request(self, method, key=None, query=None, body=b"", headers=None, ok=(200,)):
+        """(status, headers, body); raises StorageError for a status not in ok"""
+        path = f"{self.base}/{self.bucket}"
+        if key is not None:
+            path += "/" + quote(self.prefix + check_key(key), safe="/-_.~")
+        headers = dict(headers or {})
+        if self.secret_key:
+            payload_hash = hashlib.sha256(body).hexdigest() if body else EMPTY_SHA256
+            headers = sign_v4(method, self.pool.netloc, path, query, headers, payload_hash,
+                              self.access_key, self.secret_key, self.region)
+        qs = canonical_query(query)
+        status, resp_headers, data = self.pool.request(method, path + (f"?{qs}" if qs else ""),
+                                                       body or None, headers)
+        if status not in ok:
+            code = (_xml_texts(data, "Code") or [""])[0] if data[:1] == b"<" else ""
+            raise StorageError(f"S3 {method} {key or self.bucket}: HTTP {status} {code}".rstrip())
+        return status, resp_headers, data
+
+    def put(self, key, data):
+        data = bytes(data)
+        self._request("PUT", key, body=data, headers={"Content-Type": _content_type(key)})
+        return len(data)
+
+    def put_stream(self, key, stream, size=None):
+        """Single PUT when the object fits in one part, otherwise a multipart upload
+
+        Only one part is held in memory at a time; a failed upload is aborted
+        so the bucket does not keep billing for orphaned parts.
+        """
+        chunk = _read_full(stream, self.part_size)
+        if len(chunk) < self.part_size:
+            return self.put(key, chunk)
+        _, _, body = self._request("POST", key, {"uploads": ""}, headers={"Content-Type": _content_type(key)})
+        upload_id = _xml_texts(body, "UploadId")[0]
+        parts, total = [], 0
+        try:
+            while chunk:
+                number = len(parts) + 1
+                _, headers, _ = self._request("PUT", key, {"partNumber": number, "uploadId": upload_id}, chunk)
+                parts.append((number, headers.get("ETag") or headers.get("etag", "")))
+                total += len(chunk)
+                chunk = _read_full(stream, self.part_size)
+            manifest = "".join(f"<Part><PartNumber>{n}</PartNumber><ETag>{_escape(etag)}</ETag></Part>"
+                               for n, etag in parts)
+            _, _, body = self._request("POST", key, {"uploadId": upload_id},
+                                       f"<CompleteMultipartUpload>{manifest}</CompleteMultipartUpload>".encode())
+            # S3 can answer 200 and still fail the completion in the body
+            if _xml_texts(body, "Code"):
+                raise StorageError(f"S3 complete {key}: {_xml_texts(body, 'Code')[0]}")
+        except Exception:
+            try:
+                self._request("DELETE", key, {"uploadId": upload_id}, ok=(200, 204, 404))
+            except Exception as e:
+                print(f"[ERROR] Abort of multipart upload {key}: {e}")
+            raise
+        return total
+
+    def get(self, key):
+        status, _, data = self._request("GET", key, ok=(200, 404))
+        return data if status == 200 else None
+
+    def exists(self, key):
+        status, _, _ = self._request("HEAD", key, ok=(200, 404))
+        return status == 200
+
+    def delete(self, key):
+        self._request("DELETE", key, ok=(200, 204, 404))
+        return True
+
+    def list(self, prefix=""):
+        keys, token = [], None
+        while True:
+            query = {"list-type": 2, "prefix": self.prefix + prefix}
+            if token:
+                query["continuation-token"] = token
+            _, _, body = self._request("GET", query=query)
+            keys.extend(k[len(self.prefix):] for k in _xml_texts(body, "Key"))
+            token = (_xml_texts(body, "NextContinuationToken") or [None])[0]
+            if not token:
+                return sorted(keys)
+
+
+# =========================
+# UPLOADER POOL
+# =========================
+class UploaderPool(Storage):
+    """Writes through a bounded thread pool so a remote put never blocks the request
+
+    put() queues the bytes and returns; with STORAGE_UPLOAD_QUEUE uploads
+    already pending it blocks instead, so a stalled backend slows the camera
+    rather than growing memory without limit. Reads see queued writes. An
+    upload that still fails after its retries is written under
+    STORAGE_UPLOAD_FALLBACK_DIR and re-sent when the pool next starts.
+    """
+
+    def __init__(self, backend, workers=STORAGE_UPLOAD_WORKERS, max_pending=STORAGE_UPLOAD_QUEUE,
+                 retries=STORAGE_UPLOAD_RETRIES, fallback_dir=STORAGE_UPLOAD_FALLBACK_DIR):
+        self.backend = backend
+        self.kind = backend.kind
+        self.name = backend.name
+        self.retries = retries
+        self.fallback = LocalStorage(os.path.join(fallback_dir, self.name.replace("/", "_")))
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._pending = {}   # key -> data (bytes or a spooled temp file)
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"upload-{self.kind}")
+        _POOLS.append(self)
+        self._executor.submit(self._resend)
+
+    @property
+    def pending(self):
+        return len(self._pending)
+
+    def _submit(self, key, data, resend=False):
+        self._slots.acquire()
+        with self._lock:
+            self._pending[key] = data
+        self._executor.submit(self._upload, key, data, resend)
+
+    def _resend(self):
+        for key in self.fallback.list():
+            self._submit(key, self.fallback.get(key), resend=True)
+
+    def _upload(self, key, data, resend):
+        try:
+            for attempt in range(self.retries + 1):
+                try:
+                    with STORAGE_PUT_SECONDS.time(backend=self.kind):
+                        if hasattr(data, "read"):
+                            data.seek(0)
+                            self.backend.put_stream(key, data)
+                        else:
+                            self.backend.put(key, data)
+                    STORAGE_PUTS.inc(backend=self.kind, outcome="ok")
+                    if resend:
+                        self.fallback.delete(key)
+                    return
+                except Exception as e:
+                    if attempt < self.retries:
+                        time.sleep(min(30.0, 0.5 * 2 ** attempt))
+                        continue
+                    STORAGE_PUTS.inc(backend=self.kind, outcome="failed")
+                    print(f"[ERROR] Upload {self.name}/{key}: {e}")
+            if not resend:
+                if hasattr(data, "read"):
+                    data.seek(0)
+                    self.fallback.put_stream(key, data)
+                else:
+                    self.fallback.put(key, data)
+        except Exception as e:
+            print(f"[ERROR] Upload fallback {self.name}/{key}: {e}")
+        finally:
+            with self._lock:
+                if self._pending.get(key) is data:
+                    del self._pending[key]
+                self._idle.notify_all()
+            self._slots.release()
+            if hasattr(data, "close"):
+                data.close()
+
+    def put(self, key, data):
+        self._submit(check_key(key), bytes(data))
+        return len(data)
+
+    def put_stream(self, key, stream, size=None):
+        # The request stream is gone once the handler returns; small bodies
+        # stay in memory, large ones spill to a temp file
+        spooled = tempfile.SpooledTemporaryFile(max_size=S3_PART_SIZE)
+        shutil.copyfileobj(stream, spooled, 1024 * 1024)
+        total = spooled.tell()
+        self._submit(check_key(key), spooled)
+        return total
+
+    def get(self, key):
+        data = self._pending.get(key)
+        if data is None:
+            return self.backend.get(key)
+        if hasattr(data, "read"):
+            return None   # a large upload still spooling; served once it has landed
+        return data
+
+    def exists(self, key):
+        return key in self._pending or self.backend.exists(key)
+
+    def delete(self, key):
+        return self.backend.delete(key)
+
+    def list(self, prefix=""):
+        return sorted(set(self.backend.list(prefix)) | {k for k in list(self._pending) if k.startswith(prefix)})
+
+    def flush(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._lock:
+            while self._pending:
+                left = None if deadline is None else deadline - time.monotonic()
+                if left is not None and left <= 0:
+                    return False
+                self._idle.wait(left)
+        return True
+
+
+def open_storage(root, fsync=False, backend=None):
+    """The STORAGE_BACKEND store for what a server used to write under root"""
+    backend = (backend or STORAGE_BACKEND).lower()
+    if backend == "local":
+        return LocalStorage(root, fsync=fsync)
+    if backend == "segment":
+        return SegmentStorage(os.path.join(STORAGE_SEGMENT_DIR, store_name(root)), fsync=fsync)
+    if backend == "s3":
+        return UploaderPool(S3Storage(prefix=store_name(root) + "/"))
+    raise ValueError(f"unknown STORAGE_BACKEND {backend!r}")
+
+
+# =========================
+# LOCAL S3 STAND-IN
+# =========================
+def run_standin(port, root, access_key=S3_ACCESS_KEY, secret_key=S3_SECRET_KEY, region=S3_REGION):
+    """Minimal S3 (PUT/GET/HEAD/DELETE, ListObjectsV2, multipart) over files under root
+
+    Verifies SigV4 signatures when a secret key is configured, so the client
+    signing is exercised the same way a real store would.
+    """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    uploads_dir = os.path.join(root, ".uploads")
+    os.makedirs(uploads_dir, exist_ok=True)
+
+    class StandinHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _parse(self):
+            path, _, qs = self.path.partition("?")
+            bucket, _, key = unquote(path).lstrip("/").partition("/")
+            return path, dict(parse_qsl(qs, keep_blank_values=True)), bucket, key
+
+        def _reply(self, status, body=b"", headers=None):
+            self.send_response(status)
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            if self.command != "HEAD":
+                self.wfile.write(body)
+
+        def _error(self, status, code):
+            self._reply(status, f"<Error><Code>{code}</Code></Error>".encode(), {"Content-Type": "application/xml"})
+
+        def _authorized(self, path, query, body):
+            if not secret_key:
+                return True
+            auth = self.headers.get("Authorization", "")
+            fields = dict(p.strip().split("=", 1) for p in auth.partition(" ")[2].split(",") if "=" in p)
+            try:
+                now = datetime.strptime(self.headers["x-amz-date"], "%Y%m%dT%H%M%SZ").replace(tzinfo=timezone.utc)
+            except (KeyError, TypeError, ValueError):
+                return False
+            payload_hash = self.headers.get("x-amz-content-sha256", "")
+            if payload_hash != UNSIGNED_PAYLOAD and payload_hash != hashlib.sha256(body).hexdigest():
+                return False
+            signed = {h: self.headers.get(h, "") for h in fields.get("SignedHeaders", "").split(";")
+                      if h not in ("host", "x-amz-date", "x-amz-content-sha256")}
+            expected = sign_v4(self.command, self.headers.get("Host", ""), path, query, signed, payload_hash,
+                               access_key, secret_key, region, now=now)["Authorization"]
+            return hmac.compare_digest(expected, auth)
+
+        def _object(self, bucket, key):
+            return os.path.join(root, bucket, *check_key(key).split("/"))
+
+        def _handle(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            path, query, bucket, key = self._parse()
+            if not bucket or bucket.startswith("."):
+                return self._error(400, "InvalidBucketName")
+            if not self._authorized(path, query, body):
+                return self._error(403, "SignatureDoesNotMatch")
+            try:
+                target = self._object(bucket, key) if key else None
+            except ValueError:
+                return self._error(400, "InvalidArgument")
+            upload_id = query.get("uploadId")
+            upload_dir = os.path.join(uploads_dir, os.path.basename(upload_id)) if upload_id else None
+
+            if self.command == "PUT":
+                if upload_dir:
+                    if not os.path.isdir(upload_dir):
+                        return self._error(404, "NoSuchUpload")
+                    with open(os.path.join(upload_dir, f"{int(query['partNumber']):05d}"), "wb") as f:
+                        f.write(body)
+                else:
+                    os.makedirs(os.path.dirname(target), exist_ok=True)
+                    with open(target + ".part", "wb") as f:
+                        f.write(body)
+                    os.replace(target + ".part", target)
+                return self._reply(200, headers={"ETag": f'"{hashlib.md5(body).hexdigest()}"'})
+
+            if self.command == "POST":
+                if "uploads" in query:
+                    new_id = uuid.uuid4().hex
+                    os.makedirs(os.path.join(uploads_dir, new_id))
+                    xml = (f"<InitiateMultipartUploadResult><Bucket>{bucket}</Bucket><Key>{_escape(key)}</Key>"
+                           f"<UploadId>{new_id}</UploadId></InitiateMultipartUploadResult>")
+                    return self._reply(200, xml.encode(), {"Content-Type": "application/xml"})
+                if not upload_dir or not os.path.isdir(upload_dir):
+                    return self._error(404, "NoSuchUpload")
+                numbers = [int(n) for n in _xml_texts(body, "PartNumber")]
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                with open(target + ".part", "wb") as out:
+                    for n in numbers:
+                        with open(os.path.join(upload_dir, f"{n:05d}"), "rb") as f:
+                            shutil.copyfileobj(f, out)
+                os.replace(target + ".part", target)
+                shutil.rmtree(upload_dir, ignore_errors=True)
+                xml = f"<CompleteMultipartUploadResult><Key>{_escape(key)}</Key></CompleteMultipartUploadResult>"
+                return self._reply(200, xml.encode(), {"Content-Type": "application/xml"})
+
+            if self.command == "DELETE":
+                if upload_dir:
+                    shutil.rmtree(upload_dir, ignore_errors=True)
+                elif target and os.path.isfile(target):
+                    os.remove(target)
+                return self._reply(204)
+
+            if key:   # GET / HEAD object
+                if not os.path.isfile(target):
+                    return self._error(404, "NoSuchKey")
+                with open(target, "rb") as f:
+                    data = f.read()
+                return self._reply(200, data, {"Content-Type": _content_type(key)})
+
+            # ListObjectsV2; everything in one page
+            prefix = query.get("prefix", "")
+            base = os.path.join(root, bucket)
+            keys = []
+            for dirpath, _, filenames in os.walk(base):
+                rel = os.path.relpath(dirpath, base).replace(os.sep, "/")
+                keys.extend(n if rel == "." else f"{rel}/{n}" for n in filenames if not n.endswith(".part"))
+            contents = "".join(f"<Contents><Key>{_escape(k)}</Key></Contents>"
+                               for k in sorted(keys) if k.startswith(prefix))
+            xml = f"<ListBucketResult><Name>{bucket}</Name><IsTruncated>false</IsTruncated>{contents}</ListBucketResult>"
+            return self._reply(200, xml.encode(), {"Content-Type": "application/xml"})
+
+        do_PUT = do_POST = do_GET = do_HEAD = do_DELETE = _handle
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("0.0.0.0", port), StandinHandler)
+    print(f"S3 stand-in on {port}, objects under {root}")
+    server.serve_forever()
+
+
+def main(argv=None):
+    import argparse   # CLI only; kept off the server's import path
+    parser = argparse.ArgumentParser(description="Image / JSON storage backends")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    standin = sub.add_parser("s3-standin", help="run a local S3-compatible server for testing")
+    standin.add_argument('--port', type=int, default=9000)
+    standin.add_argument('--root', default='./s3_standin')
+    ls = sub.add_parser("ls", help="list keys of a store through STORAGE_BACKEND")
+    ls.add_argument('root', help="server directory the store replaces, e.g. downloads")
+    ls.add_argument('--prefix', default='')
+    args = parser.parse_args(argv)
+
+    if args.cmd == "s3-standin":
+        run_standin(args.port, args.root)
+    else:
+        for key in open_storage(args.root).list(args.prefix):
+            print(key)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,331 @@
+"""
+Disk Usage Quotas and Eviction for Image and JSON Archives
+Keeps a running byte count per directory, camera and kind, updated by the
+ingest writers instead of du scans, and frees space before a write could
+hit ENOSPC or a directory quota.
+
+Eviction order: JSON archives first, then VehiclePic, then NormalPic, then
+cutouts (the plate crop is the last thing we want to lose), oldest first
+within each kind. Files younger than STORAGE_EVICT_MIN_AGE are never
+evicted.
+  STORAGE_QUOTAS="./downloads=20G,./json_data=2G"   per-directory quotas
+  STORAGE_MIN_FREE_MB=2048                          free space to keep on the disk
+"""
+import os
+import threading
+import time
+from collections import deque
+
+from metrics import Counter, Gauge
+
+STORAGE_QUOTAS = os.getenv('STORAGE_QUOTAS', '')
+STORAGE_MIN_FREE_MB = int(os.getenv('STORAGE_MIN_FREE_MB', '2048'))
+STORAGE_HIGH_WATERMARK = float(os.getenv('STORAGE_HIGH_WATERMARK', '0.9'))
+STORAGE_EVICT_MIN_AGE = float(os.getenv('STORAGE_EVICT_MIN_AGE', '3600'))
+STORAGE_CHECK_INTERVAL = float(os.getenv('STORAGE_CHECK_INTERVAL', '10'))
+STORAGE_RESCAN_INTERVAL = float(os.getenv('STORAGE_RESCAN_INTERVAL', str(6 * 3600)))
+
+# Evicted first -> evicted last
+EVICTION_ORDER = ("json", "vehicle", "normal", "image", "cutout")
+
+EVICTED_BYTES = Counter("anpr_storage_evicted_bytes_total", "Bytes deleted to stay under quota", ("kind",))
+REJECTED_WRITES = Counter("anpr_storage_rejected_writes_total", "Writes skipped because no space could be freed",
+                          ("kind",))
+
+_UNITS = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+
+
+class StorageFull(Exception):
+    """No space could be freed for a write"""
+
+
+def parse_size(text):
+    """'20G' / '512M' / '1048576' -> bytes"""
+    text = text.strip().upper().rstrip("B")
+    if text and text[-1] in _UNITS:
+        return int(float(text[:-1]) * _UNITS[text[-1]])
+    return int(text)
+
+
+def parse_quotas(spec):
+    quotas = {}
+    for item in spec.split(","):
+        if "=" in item:
+            path, size = item.split("=", 1)
+            quotas[os.path.abspath(path.strip())] = parse_size(size)
+    return quotas
+
+
+def kind_of(path):
+    """json / vehicle / normal / cutout / image, from the file naming the servers use"""
+    name = os.path.basename(path).lower()
+    if name.endswith(".json"):
+        return "json"
+    if "vehicle" in name:
+        return "vehicle"
+    if "normal" in name:
+        return "normal"
+    if "cutout" in name or "plate" in name:
+        return "cutout"
+    return "image"
+
+
+def camera_of(path):
+    upper = path.upper()
+    if "_CAM2_" in upper or "CAMERA2" in upper or "CAM2" in upper:
+        return "camera2"
+    if "_CAM1_" in upper or "CAMERA1" in upper or "CAM1" in upper:
+        return "camera1"
+    return "unknown"
+
+
+class StorageManager:
+    """Incremental usage ledger with quota enforcement for a set of root directories"""
+
+    def __init__(self, roots, quotas=None, min_free_mb=STORAGE_MIN_FREE_MB, evict_min_age=STORAGE_EVICT_MIN_AGE):
+        self.roots = [os.path.abspath(r) for r in roots]
+        self.quotas = quotas if quotas is not None else parse_quotas(STORAGE_QUOTAS)
+        self.min_free = min_free_mb * 1024 * 1024
+        self.evict_min_age = evict_min_age
+        self._lock = threading.Lock()
+        self._queues = {k: deque() for k in EVICTION_ORDER}   # (mtime, path, size, root, camera)
+        self.by_root = {r: 0 for r in self.roots}
+        self.by_camera = {}
+        self.by_kind = {k: 0 for k in EVICTION_ORDER}
+        self.files = 0
+        self._free = None            # bytes free at the last statvfs
+        self._written_since = 0      # bytes written since then
+        self._thread = None
+        self.scanned_at = None
+
+    def _root_of(self, path):
+        path = os.path.abspath(path)
+        for root in self.roots:
+            if path == root or path.startswith(root + os.sep):
+                return root
+        return None
+
+    # =========================
+    # LEDGER
+    # =========================
+    def _add(self, path, size, mtime, root):
+        kind = kind_of(path)
+        camera = camera_of(path)
+        self._queues[kind].append((mtime, path, size, root, camera))
+        self.by_root[root] += size
+        self.by_camera[camera] = self.by_camera.get(camera, 0) + size
+        self.by_kind[kind] += size
+        self.files += 1
+
+    def record(self, path, size):
+        """Account a file the caller just wrote; O(1)"""
+        root = self._root_of(path)
+        with self._lock:
+            self._written_since += size
+            if root is not None:
+                self._add(os.path.abspath(path), size, time.time(), root)
+
+    def scan(self):
+        """Full inventory, run once at start and then rarely to correct drift
+        (files removed by other tools, e.g. image tiering)"""
+        found = []
+        for root in self.roots:
+            for dirpath, _, filenames in os.walk(root):
+                for name in filenames:
+                    path = os.path.join(dirpath, name)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    found.append((st.st_mtime, path, st.st_size, root))
+        found.sort()
+        with self._lock:
+            self._queues = {k: deque() for k in EVICTION_ORDER}
+            self.by_root = {r: 0 for r in self.roots}
+            self.by_camera = {}
+            self.by_kind = {k: 0 for k in EVICTION_ORDER}
+            self.files = 0
+            for mtime, path, size, root in found:
+                self._add(path, size, mtime, root)
+            self.scanned_at = time.time()
+        self.refresh_free()
+
+    def refresh_free(self):
+        try:
+            st = os.statvfs(self.roots[0] if self.roots else ".")
+            free = st.f_bavail * st.f_frsize
+        except (OSError, AttributeError):
+            free = None
+        with self._lock:
+            self._free = free
+            self._written_since = 0
+
+    def free_bytes(self):
+        """Free disk space estimated from the last statvfs minus bytes written since"""
+        if self._free is None:
+            return None
+        return self._free - self._written_since
+
+    # =========================
+    # ENFORCEMENT
+    # =========================
+    def _needed(self, root, nbytes, watermark=1.0):
+        """Bytes to free for a write of nbytes under root"""
+        need = 0
+        free = self.free_bytes()
+        if free is not None:
+            need = max(need, self.min_free + nbytes - free)
+        quota = self.quotas.get(root)
+        if quota:
+            need = max(need, self.by_root.get(root, 0) + nbytes - int(quota * watermark))
+        return need
+
+    def _evict(self, need, root=None):
+        """Delete oldest files in EVICTION_ORDER until need bytes are freed; returns bytes freed
+
+        Only successful deletes count: a file already gone (moved by tiering)
+        leaves the ledger but frees nothing here, so eviction moves on.
+        """
+        freed = 0
+        cutoff = time.time() - self.evict_min_age
+        while freed < need:
+            victims = self._pick_victims(need - freed, cutoff, root)
+            if not victims:
+                break
+            for path, size, entry_root, camera, kind in victims:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    continue
+                except OSError as e:
+                    # Still on disk: put it back in the totals (not the queue, it would be picked again)
+                    print(f"[ERROR] Could not evict {path}: {e}")
+                    with self._lock:
+                        self.by_root[entry_root] += size
+                        self.by_camera[camera] += size
+                        self.by_kind[kind] += size
+                        self.files += 1
+                    continue
+                freed += size
+                EVICTED_BYTES.inc(size, kind=kind)
+                folder = os.path.dirname(path)
+                try:
+                    if folder not in self.roots and not os.listdir(folder):
+                        os.rmdir(folder)
+                except OSError:
+                    pass
+        if freed:
+            with self._lock:
+                self._written_since -= freed
+        return freed
+
+    def _pick_victims(self, need, cutoff, root):
+        """Take the oldest evictable entries worth need bytes off the ledger"""
+        picked = 0
+        victims = []
+        with self._lock:
+            for kind in EVICTION_ORDER:
+                queue = self._queues[kind]
+                skipped = []
+                while queue and picked < need and queue[0][0] < cutoff:
+                    entry = queue.popleft()
+                    if root is not None and entry[3] != root:
+                        skipped.append(entry)
+                        continue
+                    mtime, path, size, entry_root, camera = entry
+                    self.by_root[entry_root] -= size
+                    self.by_camera[camera] -= size
+                    self.by_kind[kind] -= size
+                    self.files -= 1
+                    picked += size
+                    victims.append((path, size, entry_root, camera, kind))
+                queue.extendleft(reversed(skipped))
+                if picked >= need:
+                    break
+        return victims
+
+    def ensure(self, path, nbytes, kind=None):
+        """Make room for nbytes at path; raises StorageFull if that is impossible
+
+        The fast path is two comparisons against the ledger, no syscalls.
+        """
+        root = self._root_of(path)
+        need = self._needed(root, nbytes)
+        if need <= 0:
+            return
+        quota_need = 0
+        quota = self.quotas.get(root)
+        if quota:
+            quota_need = self.by_root.get(root, 0) + nbytes - quota
+        if quota_need > 0:
+            self._evict(quota_need, root)
+        need = self._needed(root, nbytes)
+        if need > 0:
+            self._evict(need)
+            need = self._needed(root, nbytes)
+        if need > 0:
+            REJECTED_WRITES.inc(kind=kind or kind_of(path))
+            raise StorageFull(f"no space for {nbytes} bytes at {path} ({need} bytes short)")
+
+    def put(self, store, key, data, kind=None):
+        """store.put(key, data) after making room; raises StorageFull (nothing written)
+
+        Only stores with local files are checked and accounted.
+        """
+        path = store.local_path(key)
+        if path:
+            self.ensure(path, len(data), kind)
+        store.put(key, data)
+        if path:
+            self.record(path, len(data))
+
+    def maintain(self):
+        """Background pass: refresh free space and evict down to the high watermark"""
+        self.refresh_free()
+        for root in self.roots:
+            need = self._needed(root, 0, STORAGE_HIGH_WATERMARK)
+            if need > 0:
+                self._evict(need, root if self.quotas.get(root) else None)
+
+    def start(self, interval=STORAGE_CHECK_INTERVAL):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, args=(interval,), name="storage-quota", daemon=True)
+            self._thread.start()
+        return self
+
+    def _run(self, interval):
+        while True:
+            try:
+                if self.scanned_at is None or time.time() - self.scanned_at > STORAGE_RESCAN_INTERVAL:
+                    self.scan()
+                self.maintain()
+            except Exception as e:
+                print(f"[ERROR] Storage manager: {e}")
+            time.sleep(interval)
+
+    def usage(self):
+        free = self.free_bytes()
+        with self._lock:
+            return {
+                "files": self.files,
+                "free_bytes": free,
+                "min_free_bytes": self.min_free,
+                "directories": {r: {"bytes": b, "quota": self.quotas.get(r)} for r, b in self.by_root.items()},
+                "cameras": dict(self.by_camera),
+                "kinds": dict(self.by_kind),
+                "scanned_at": self.scanned_at,
+            }
+
+    def init_app(self, app):
+        """Add /storage/usage and usage gauges to a Flask app"""
+        from flask import jsonify
+
+        Gauge("anpr_storage_bytes", "Bytes used per directory", ("directory",),
+              func=lambda: {(r,): b for r, b in list(self.by_root.items())})
+        Gauge("anpr_storage_free_bytes", "Estimated free disk bytes", func=lambda: self.free_bytes() or 0)
+
+        @app.route("/storage/usage")
+        def storage_usage():
+            return jsonify(self.usage())
+
+        return app
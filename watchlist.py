@@ -0,0 +1,316 @@
+"""
+Plate Watchlist with Instant Alerts
+Black/white-listed plates from WATCHLIST_FILE (CSV: plate,list,note) and/or
+the watchlist table, checked inline in the TollgateInfo handlers before any
+disk I/O. Matching is a dict lookup on the OCR-folded plate plus a
+deletion-neighbourhood index for one-edit misreads, so a check costs
+microseconds (tens for a fuzzy miss) however long the list is.
+
+Matches are published on an in-process bus and delivered off the request
+thread: to SSE clients on /watchlist/stream and, when WATCHLIST_WEBHOOK_URL
+is set, as a JSON POST.
+"""
+import csv
+import json
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+
+from metrics import Counter
+from reconcile import normalize_plate, plate_distance
+
+WATCHLIST_FILE = os.getenv('WATCHLIST_FILE', './watchlist.csv')
+WATCHLIST_FROM_DB = os.getenv('WATCHLIST_FROM_DB', '1') != '0'
+WATCHLIST_RELOAD_INTERVAL = float(os.getenv('WATCHLIST_RELOAD_INTERVAL', '5'))
+WATCHLIST_DB_RELOAD_INTERVAL = float(os.getenv('WATCHLIST_DB_RELOAD_INTERVAL', '60'))
+WATCHLIST_FUZZY = os.getenv('WATCHLIST_FUZZY', '1') != '0'
+WATCHLIST_WEBHOOK_URL = os.getenv('WATCHLIST_WEBHOOK_URL', '')
+WATCHLIST_WEBHOOK_TIMEOUT = float(os.getenv('WATCHLIST_WEBHOOK_TIMEOUT', '3'))
+# Shorter plates get too many one-edit neighbours to be useful
+FUZZY_MIN_LENGTH = 5
+
+WATCHLIST_MATCHES = Counter("anpr_watchlist_matches_total", "Watchlist hits", ("list", "match", "camera"))
+
+
+class WatchEntry:
+    __slots__ = ("plate", "list_type", "note", "norm")
+
+    def __init__(self, plate, list_type="black", note=None):
+        self.plate = plate
+        self.list_type = (list_type or "black").lower()
+        self.note = note
+        self.norm = normalize_plate(plate)
+
+
+def _deletes(norm):
+    return {norm[:i] + norm[i + 1:] for i in range(len(norm))}
+
+
+class WatchIndex:
+    """Immutable exact + fuzzy index; rebuilt and swapped whole on reload"""
+
+    def __init__(self, entries, fuzzy=WATCHLIST_FUZZY):
+        self.exact = {}
+        self.variants = {}   # one-deletion variant -> entries
+        self.size = 0
+        for entry in entries:
+            if not entry.norm:
+                continue
+            self.exact[entry.norm] = entry
+            self.size += 1
+            if fuzzy and len(entry.norm) >= FUZZY_MIN_LENGTH:
+                for v in _deletes(entry.norm):
+                    self.variants.setdefault(v, []).append(entry)
+
+    def match(self, plate):
+        """(entry, "exact" | "fuzzy", distance) or None"""
+        norm = normalize_plate(plate)
+        if not norm:
+            return None
+        entry = self.exact.get(norm)
+        if entry is not None:
+            return entry, "exact", 0
+        if not self.variants or len(norm) < FUZZY_MIN_LENGTH - 1:
+            return None
+        # One edit apart <=> the plates share a one-deletion variant, or one
+        # plate is a one-deletion variant of the other
+        candidates = list(self.variants.get(norm, ()))
+        for v in _deletes(norm):
+            hit = self.exact.get(v)
+            if hit is not None:
+                candidates.append(hit)
+            candidates.extend(self.variants.get(v, ()))
+        best = None
+        for entry in candidates:
+            d = plate_distance(norm, entry.norm, 1)
+            if d <= 1 and (best is None or (entry.list_type == "black" and best.list_type != "black")):
+                best = entry
+        return (best, "fuzzy", 1) if best else None
+
+
+def load_file(path):
+    """Entries from a CSV of plate[,list[,note]]; '#' lines and a header row are skipped"""
+    entries = []
+    with open(path, newline="", encoding="utf-8") as f:
+        for row in csv.reader(f):
+            if not row or not row[0].strip() or row[0].lstrip().startswith("#"):
+                continue
+            if row[0].strip().lower() == "plate":
+                continue
+            entries.append(WatchEntry(row[0].strip(), row[1].strip() if len(row) > 1 else "black",
+                                      row[2].strip() if len(row) > 2 else None))
+    return entries
+
+
+class AlertBus:
+    """In-process pub/sub; publish() only enqueues, a dispatcher thread fans out"""
+
+    def __init__(self, maxsize=10000):
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._subscribers = []
+        self._lock = threading.Lock()
+        self.dropped = 0
+        self._thread = threading.Thread(target=self._run, name="watchlist-alerts", daemon=True)
+        self._thread.start()
+
+    def subscribe(self, callback):
+        with self._lock:
+            self._subscribers.append(callback)
+        return callback
+
+    def unsubscribe(self, callback):
+        with self._lock:
+            if callback in self._subscribers:
+                self._subscribers.remove(callback)
+
+    def publish(self, event):
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        while True:
+            event = self._queue.get()
+            with self._lock:
+                subscribers = list(self._subscribers)
+            for callback in subscribers:
+                try:
+                    callback(event)
+                except Exception as e:
+                    print(f"[ERROR] Watchlist subscriber: {e}")
+
+
+class WebhookSubscriber:
+    """Bus callback that queues each alert for its own thread to POST as JSON to url
+
+    A slow or unreachable endpoint then only delays its own queue, never the
+    bus's other subscribers (SSE clients, the log).
+    """
+
+    def __init__(self, url, timeout=WATCHLIST_WEBHOOK_TIMEOUT, maxsize=1000):
+        self.url = url
+        self.timeout = timeout
+        self._queue = queue.Queue(maxsize=maxsize)
+        self.dropped = 0
+        self._thread = threading.Thread(target=self._run, name="watchlist-webhook", daemon=True)
+        self._thread.start()
+
+    def __call__(self, event):
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        import urllib.request   # only when a webhook is configured
+        while True:
+            event = self._queue.get()
+            req = urllib.request.Request(self.url, data=json.dumps(event).encode("utf-8"),
+                                         headers={"Content-Type": "application/json"}, method="POST")
+            try:
+                with urllib.request.urlopen(req, timeout=self.timeout) as resp:
+                    resp.read()
+            except Exception as e:
+                print(f"[ERROR] Watchlist webhook: {e}")
+
+
+class Watchlist:
+    """Hot-reloaded watchlist; check() is the inline entry point"""
+
+    def __init__(self, path=WATCHLIST_FILE, db=None, bus=None, webhook_url=WATCHLIST_WEBHOOK_URL):
+        self.path = path
+        self.db = db
+        self.bus = bus or AlertBus()
+        self.index = WatchIndex([])
+        self.loaded_at = None
+        self._mtime = None
+        self._file_entries = []
+        self._db_entries = []
+        self._db_signature = None
+        self._db_checked = None
+        self._thread = None
+        self.webhook = None
+        if webhook_url:
+            self.webhook = self.bus.subscribe(WebhookSubscriber(webhook_url))
+        # Only the file here: the table is first read by start()'s thread, so
+        # constructing a Watchlist never waits on the database
+        self.reload(with_db=False)
+
+    def reload(self, force=False, with_db=True):
+        """Rebuild the index when the file or the table changed; returns True if rebuilt
+
+        The file is checked by mtime on every call, the table at most every
+        WATCHLIST_DB_RELOAD_INTERVAL seconds.
+        """
+        changed = force or self.loaded_at is None
+        try:
+            mtime = os.path.getmtime(self.path) if self.path else None
+        except OSError:
+            mtime = None
+        if changed or mtime != self._mtime:
+            self._file_entries = load_file(self.path) if mtime is not None else []
+            self._mtime = mtime
+            changed = True
+        if with_db and self.db is not None and (
+                changed or self._db_checked is None
+                or time.monotonic() - self._db_checked >= WATCHLIST_DB_RELOAD_INTERVAL):
+            self._db_checked = time.monotonic()
+            try:
+                rows = [(r["plate"], r.get("list_type"), r.get("note")) for r in self.db.get_watchlist()]
+                signature = hash(tuple(rows))
+                if signature != self._db_signature:
+                    self._db_entries = [WatchEntry(*r) for r in rows]
+                    self._db_signature = signature
+                    changed = True
+            except Exception as e:
+                print(f"[ERROR] Watchlist table: {e}")
+        if not changed:
+            return False
+        # One reference swap; readers never see a partial index
+        self.index = WatchIndex(self._file_entries + self._db_entries)
+        self.loaded_at = datetime.now()
+        return True
+
+    def check(self, plate, camera=None, ref=None):
+        """Match a plate; on a hit publish an alert and return it, else None"""
+        result = self.index.match(plate)
+        if result is None:
+            return None
+        entry, how, distance = result
+        WATCHLIST_MATCHES.inc(list=entry.list_type, match=how, camera=camera or "")
+        alert = {
+            "plate": plate,
+            "matched": entry.plate,
+            "list": entry.list_type,
+            "match": how,
+            "distance": distance,
+            "note": entry.note,
+            "camera": camera,
+            "ref": ref,
+            "time": datetime.now().isoformat(),
+        }
+        self.bus.publish(alert)
+        return alert
+
+    def start(self, interval=WATCHLIST_RELOAD_INTERVAL):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, args=(interval,), name="watchlist-reload", daemon=True)
+            self._thread.start()
+        return self
+
+    def _run(self, interval):
+        while True:
+            try:
+                self.reload()
+            except Exception as e:
+                print(f"[ERROR] Watchlist reload: {e}")
+            time.sleep(interval)
+
+    def init_app(self, app):
+        """Add /watchlist, /watchlist/reload and the /watchlist/stream SSE feed"""
+        from flask import Response, jsonify, stream_with_context
+
+        @app.route("/watchlist")
+        def watchlist_status():
+            return jsonify(entries=self.index.size, fuzzy_keys=len(self.index.variants),
+                           loaded_at=self.loaded_at.isoformat() if self.loaded_at else None,
+                           dropped_alerts=self.bus.dropped,
+                           dropped_webhooks=self.webhook.dropped if self.webhook else 0)
+
+        @app.route("/watchlist/reload", methods=["POST"])
+        def watchlist_reload():
+            self.reload(force=True)
+            return jsonify(entries=self.index.size)
+
+        @app.route("/watchlist/stream")
+        def watchlist_stream():
+            client = queue.Queue(maxsize=1000)
+
+            def enqueue(event):
+                try:
+                    client.put_nowait(event)
+                except queue.Full:
+                    pass
+
+            self.bus.subscribe(enqueue)
+
+            def events():
+                try:
+                    yield ": connected\n\n"
+                    while True:
+                        try:
+                            event = client.get(timeout=15)
+                        except queue.Empty:
+                            yield ": keep-alive\n\n"
+                            continue
+                        yield f"event: watchlist\ndata: {json.dumps(event)}\n\n"
+                finally:
+                    self.bus.unsubscribe(enqueue)
+
+            return Response(stream_with_context(events()), mimetype="text/event-stream",
+                            headers={"Cache-Control": "no-cache"})
+
+        return app